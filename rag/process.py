@@ -1,18 +1,15 @@
+"""
+RAG feedback on log clusters, backed by a Milvus vector store and OpenAI.
+llama_index, the vector store connection and the query engine are heavy and need network, so none of them is created on
+import - they are created on first use by the get_xxx() accessors below.
+"""
 import json
 from json import JSONDecodeError
+from threading import RLock
 from typing import Tuple
 
-from llama_index.core import StorageContext, VectorStoreIndex, ChatPromptTemplate, SimpleDirectoryReader
-from llama_index.core.extractors import TitleExtractor
-from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core.schema import TextNode
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.vector_stores.milvus import MilvusVectorStore
-
 from log_structure import LogCluster
-from config import log_metadata, TRA_TYPE_domain_knowledge, TRA_TYPE_most_frequent_tokens
+from config import log_metadata, milvus_uri, milvus_collection, TRA_TYPE_domain_knowledge, TRA_TYPE_most_frequent_tokens
 
 
 
@@ -60,48 +57,98 @@ examples:
 \t...
 '''
 
-chat_text_qa_msgs = [
-    ChatMessage(
-        role=MessageRole.SYSTEM,
-        content=system_template_str,
-    ),
-    ChatMessage(
-        role=MessageRole.USER,
-        content=question_template_str,
-    ),
-]
-chat_text_qa_tmpl = ChatPromptTemplate(chat_text_qa_msgs)
-
-# Attu client addr: http://10.58.137.244:8888/
-vector_store = MilvusVectorStore(uri='http://10.58.137.244:19530', dim=1536, collection_name='scale_ad_collection')
-storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-embed_model = OpenAIEmbedding()
-
-# connect directly to vector database
-pipeline = IngestionPipeline(
-    transformations=[
-        SentenceSplitter(chunk_size=100, chunk_overlap=0),
-        TitleExtractor(),
-        OpenAIEmbedding(),
-    ]
-)
-
-# nodes = pipeline.run(documents=SimpleDirectoryReader(input_files=['rag/data/log-info.log']).load_data())
-
-# Create your index
-index = VectorStoreIndex.from_vector_store(vector_store)
-
-# index.insert_nodes(nodes)
-
-query_engine = index.as_query_engine()
+_lazy_objects = dict()  # name -> object created by an accessor
+_lazy_lock = RLock()  # reentrant, an accessor may call another accessor while creating its object
+
+
+def _lazy(name: str, create):
+    """
+    return the object cached under name, create it on first use
+    """
+    if name not in _lazy_objects:
+        with _lazy_lock:
+            if name not in _lazy_objects:
+                _lazy_objects[name] = create()
+    return _lazy_objects[name]
+
+
+def get_chat_text_qa_tmpl():
+    def create():
+        from llama_index.core import ChatPromptTemplate
+        from llama_index.core.llms import ChatMessage, MessageRole
+        chat_text_qa_msgs = [
+            ChatMessage(
+                role=MessageRole.SYSTEM,
+                content=system_template_str,
+            ),
+            ChatMessage(
+                role=MessageRole.USER,
+                content=question_template_str,
+            ),
+        ]
+        return ChatPromptTemplate(chat_text_qa_msgs)
+    return _lazy('chat_text_qa_tmpl', create)
+
+
+def get_vector_store():
+    def create():
+        from llama_index.vector_stores.milvus import MilvusVectorStore
+        return MilvusVectorStore(uri=milvus_uri, dim=1536, collection_name=milvus_collection)
+    return _lazy('vector_store', create)
+
+
+def get_storage_context():
+    def create():
+        from llama_index.core import StorageContext
+        return StorageContext.from_defaults(vector_store=get_vector_store())
+    return _lazy('storage_context', create)
+
+
+def get_embed_model():
+    def create():
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        return OpenAIEmbedding()
+    return _lazy('embed_model', create)
+
+
+def get_pipeline():
+    """
+    connect directly to vector database
+    """
+    def create():
+        from llama_index.core.extractors import TitleExtractor
+        from llama_index.core.ingestion import IngestionPipeline
+        from llama_index.core.node_parser import SentenceSplitter
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        return IngestionPipeline(
+            transformations=[
+                SentenceSplitter(chunk_size=100, chunk_overlap=0),
+                TitleExtractor(),
+                OpenAIEmbedding(),
+            ]
+        )
+    # nodes = get_pipeline().run(documents=SimpleDirectoryReader(input_files=['rag/data/log-info.log']).load_data())
+    # get_index().insert_nodes(nodes)
+    return _lazy('pipeline', create)
+
+
+def get_index():
+    def create():
+        from llama_index.core import VectorStoreIndex
+        return VectorStoreIndex.from_vector_store(get_vector_store())
+    return _lazy('index', create)
+
+
+def get_query_engine():
+    return _lazy('query_engine', lambda: get_index().as_query_engine())
 
 
 def rag_feedback(log_cluster: LogCluster) -> Tuple[int, int, str]:
-    template = chat_text_qa_tmpl.partial_format(log_metadata=f'Environment: {log_metadata}; Level: {log_cluster.metadata[TRA_TYPE_domain_knowledge]}; Most Frequent Tokens: {log_cluster.metadata[TRA_TYPE_most_frequent_tokens]}',
+    template = get_chat_text_qa_tmpl().partial_format(log_metadata=f'Environment: {log_metadata}; Level: {log_cluster.metadata[TRA_TYPE_domain_knowledge]}; Most Frequent Tokens: {log_cluster.metadata[TRA_TYPE_most_frequent_tokens]}',
                                                 log_cluster=log_cluster.template,
                                                 samples='\n\t'.join(log_cluster.get_log_messages()[0:10]),
                                                 output_sample='{result:yes, score: 0.7, reason:the reason is ...')
+    query_engine = get_query_engine()
     query_engine.update_prompts({"response_synthesizer:text_qa_template": template})
     response = query_engine.query('Does this type of log message indicate an anomaly?')
     # FIXME: llm sometimes is stupid, the response is not in pure json:
@@ -117,6 +164,8 @@ def rag_feedback(log_cluster: LogCluster) -> Tuple[int, int, str]:
 
 
 def rag_insert(log_cluster: LogCluster):
+    from llama_index.core.schema import TextNode
+
     metadata = {
         "log cluster's template": log_cluster.template,
         'log level': log_cluster.metadata[TRA_TYPE_domain_knowledge],
@@ -129,8 +178,8 @@ def rag_insert(log_cluster: LogCluster):
                                                 reason=log_cluster.feedback.reason,
                                                 template=log_cluster.template,
                                                 samples=samples)
-    node = TextNode(id_=hash(log_cluster.template),
+    node = TextNode(id_=f'log_cluster_{log_cluster.cluster_id}',
                     text=node_content,
                     metadata=metadata,
-                    embedding=embed_model.get_text_embedding(node_content))
-    index.insert_nodes([node])
+                    embedding=get_embed_model().get_text_embedding(node_content))
+    get_index().insert_nodes([node])
@@ -1,8 +1,9 @@
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
 from django.http.request import HttpRequest
+from django.utils.http import parse_etags
 import json
-from tda.server_apis import render_echarts_api, expert_feedback_api
-from tda.process_tda import root, logMessages
+from tda.server_apis import render_echarts_json, trie_diff_api, trie_etag, expert_feedback_api
+import tda.process_tda as tda_process
 
 
 def api_test(request):
@@ -10,28 +11,72 @@ def api_test(request):
 
 
 def trie_display_graph(request: HttpRequest):
-    render_type = request.GET.get('render_type')
-    result = render_echarts_api(root, render_type)
-    result = json.dumps(result)
-    return HttpResponse(result)
+    """
+    ?render_type=<graph|tree>: trie rendered for echarts, see render_echarts_api
+    ?since=<version>: only trie nodes and log clusters changed since version, see trie_diff_api
+    served with an ETag, 304 when the client's one is still current
+    """
+    snapshot = tda_process.root.snapshot  # read once, body and ETag are of the same version
+    since = request.GET.get('since')
+    if since is None:
+        result, etag = render_echarts_json(snapshot, request.GET.get('render_type'))
+    else:
+        try:
+            since = int(since)
+        except ValueError:
+            return HttpResponseBadRequest('since must be an integer')
+        result = json.dumps(trie_diff_api(snapshot, since))
+        etag = trie_etag(snapshot, f'since{since}')
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(result)
+    response['ETag'] = etag
+    return response
 
 
 def log_feedback(request: HttpRequest):
-    data = expert_feedback_api(root)
+    data = expert_feedback_api(tda_process.root.snapshot)
     data = json.dumps(data)
     return HttpResponse(data)
 
 
+LOGS_LIMIT = 100  # log messages of a /logs/ page by default
+LOGS_MAX_LIMIT = 1000
+
+
 def log_messages_result(request: HttpRequest):
     """
-
+    a page of the most recent log messages, oldest first: ?cursor=<seq>&limit=<n>&decision=<decision>
+    cursor: sequence number to start from, the oldest kept log message by default
+    decision: only log messages whose log cluster has this expert decision
+    every log message has its sequence number 'seq', header X-Next-Cursor is the cursor of the next page.
+    In sharded mode log messages are the ones sent back by shard workers with their snapshots, see sharding.ShardMessage
     """
-    data = [
-        {
-            'log': log_message.line,
-            'decision': log_message.parent.feedback.decision,
-            'reason': log_message.parent.feedback.reason,
-            'committer': log_message.parent.feedback.committer,
-        } for log_message in logMessages]
-    data = json.dumps(data)
-    return HttpResponse(data)
+    log_messages = tda_process.logMessages
+    try:
+        cursor = int(request.GET.get('cursor', log_messages.oldest))
+        limit = max(0, min(int(request.GET.get('limit', LOGS_LIMIT)), LOGS_MAX_LIMIT))
+        decision = request.GET.get('decision')
+        decision = None if decision is None else int(decision)
+    except ValueError:
+        return HttpResponseBadRequest('cursor, limit and decision must be integers')
+    predicate = None if decision is None else (lambda log_message: log_message.parent.feedback.decision == decision)
+    page, next_cursor = log_messages.page(cursor, limit, predicate)
+
+    def stream():
+        yield '['
+        for i, (seq, log_message) in enumerate(page):
+            feedback = log_message.parent.feedback  # replaced by LogCluster.set_feedback, read it once
+            yield (',' if i else '') + json.dumps({
+                'seq': seq,
+                'log': log_message.line,
+                'decision': feedback.decision,
+                'reason': feedback.reason,
+                'committer': feedback.committer,
+            })
+        yield ']'
+
+    response = StreamingHttpResponse(stream(), content_type='application/json')
+    response['X-Next-Cursor'] = str(next_cursor)
+    return response
@@ -1,15 +1,18 @@
 import numpy as np
-import pandas as pd
-from scipy.stats import genextreme
-from streamad.model import SpotDetector
-from streamad.util import CustomDS, StreamGenerator, plot
 
 from log_structure import LogCluster, FeedBack
+from snapshot import ClusterSnapshot
 from rag.process import rag_insert, rag_feedback
 
 
-def detect_cdf(log_clusters: list[LogCluster]):
-    data = [len(log_cluster.logMessagesCache) for log_cluster in log_clusters]
+def detect_cdf(log_clusters: list[ClusterSnapshot]):
+    """
+    log_clusters: snapshots of recently used log clusters (see snapshot.py), read while log messages are inserted.
+    feedback is written back to the live log clusters by LogCluster.set_feedback
+    """
+    from scipy.stats import genextreme
+
+    data = [len(log_cluster.log_messages) for log_cluster in log_clusters]
     c = -0.5
     query_threshold = 0.0
     cdfs = genextreme.cdf(data, c)
@@ -25,12 +28,17 @@ def detect_cdf(log_clusters: list[LogCluster]):
         if tp > query_threshold:
             # result, score, reason = openai_feedback(log_cluster)
             decision, score, reason = rag_feedback(log_cluster)
-            log_cluster.feedback.decision, log_cluster.feedback.ep, log_cluster.feedback.reason, log_cluster.feedback.tp \
-                = decision, score, reason, tp
-            log_cluster.feedback.committer = 'gpt.3.5'
+            feedback = FeedBack(decision=-1, ep=-1, tp=-1)
+            feedback.decision, feedback.ep, feedback.reason, feedback.tp = decision, score, reason, tp
+            feedback.committer = 'gpt.3.5'
+            log_cluster.cluster.set_feedback(feedback)
 
 
 def detect_streamad(log_clusters: list[LogCluster]):
+    import pandas as pd
+    from streamad.model import SpotDetector
+    from streamad.util import CustomDS, StreamGenerator, plot
+
     data = {'values': [len(log_cluster.logMessagesCache) for log_cluster in log_clusters],
             # 'col': [log_cluster.template for log_cluster in log_clusters],
             'label': [1 if log_cluster.feedback.decision == 1 else 0 for log_cluster in log_clusters]
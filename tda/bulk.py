@@ -0,0 +1,111 @@
+"""
+Offline bulk parsing of large log archives, e.g. the whole bgl2 dataset.
+
+The file is memory-mapped and split on line boundaries into chunks. Worker processes only receive the byte range of a
+chunk: each one maps the file itself and slices its lines out of the mapping, so no line is sent to a worker. Workers
+match the log pattern and compute traverse tokens (the nlp step), and send back compact results, no line nor log
+message: per parsed line its byte span in the file, the span of CONTENT in the line, and indexes into tables of the
+distinct LEVELs and traverse tokens of the chunk. The parent slices lines out of its own mapping and rebuilds lazy log
+messages (see LogMessage.parsed), in input order, ready to be inserted into trie (see process_tda.ingest). CONTENT is
+tokenized by the inserting process only when needed, e.g. not for hot line cache hits.
+"""
+import mmap
+import re
+from array import array
+from multiprocessing import Pool
+from typing import Iterator, Optional
+
+from config import nlp_batch_size
+from exceptions import LogError
+from log_structure import LogMessage, get_traverse_tokens, tag_log_messages
+
+_pattern: Optional[re.Pattern] = None  # compiled once in every worker process
+
+FIELDS = 6  # ints per parsed line in ParsedChunk.spans: line start, line end, CONTENT start, CONTENT end, LEVEL, tokens
+
+# spans, LEVELs table, traverse tokens table (as item tuples)
+ParsedChunk = tuple[array, list[str], list[tuple[tuple[str, str], ...]]]
+
+
+def chunk_bounds(file_path: str, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    [start, end) byte ranges of about chunk_size bytes, ending right after a line break (or at the end of file)
+    """
+    with open(file_path, 'rb') as f:
+        size = f.seek(0, 2)
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bounds, start = [], 0
+            while start < size:
+                end = mm.find(b'\n', min(start + chunk_size, size) - 1)
+                end = size if end < 0 else end + 1
+                bounds.append((start, end))
+                start = end
+            return bounds
+
+
+def iter_spans(mm: mmap.mmap, start: int, end: int) -> Iterator[tuple[int, int]]:
+    """
+    [start, stop) byte ranges of the lines of mm[start:end], line breaks included
+    """
+    while start < end:
+        stop = mm.find(b'\n', start, end)
+        stop = end if stop < 0 else stop + 1
+        yield start, stop
+        start = stop
+
+
+def decode_line(mm: mmap.mmap, start: int, stop: int) -> str:
+    """
+    line of mm[start:stop], like reading a text file: \\r\\n is read as \\n
+    """
+    line = mm[start:stop].decode('utf-8', errors='replace')
+    return line[:-2] + '\n' if line.endswith('\r\n') else line
+
+
+def _init_worker(pattern_re: str):
+    global _pattern
+    _pattern = re.compile(pattern_re)
+
+
+def parse_chunk(args: tuple[str, int, int]) -> ParsedChunk:
+    file_path, start, end = args
+    spans, log_messages = array('q'), []
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line_start, line_stop in iter_spans(mm, start, end):
+            try:
+                log_message = LogMessage(_pattern, decode_line(mm, line_start, line_stop), tag=False, lazy=True)
+            except (LogError, ValueError) as e:
+                print(e)
+                continue
+            spans.extend((line_start, line_stop, *log_message.content_span(), 0, 0))
+            log_messages.append(log_message)
+    if nlp_batch_size > 0:
+        tag_log_messages(log_messages, nlp_batch_size)
+    else:
+        for log_message in log_messages:
+            log_message.traverse_tokens = get_traverse_tokens(log_message.get_content())
+
+    levels, tokens = dict(), dict()  # distinct values -> index in their table
+    for i, log_message in enumerate(log_messages):
+        spans[i * FIELDS + 4] = levels.setdefault(log_message.get_level(), len(levels))
+        spans[i * FIELDS + 5] = tokens.setdefault(tuple(log_message.traverse_tokens.items()), len(tokens))
+    return spans, list(levels), list(tokens)
+
+
+def parse_file(file_path: str, pattern_re: str, n_process: int, chunk_size: int) -> Iterator[LogMessage]:
+    """
+    parsed and tagged lazy log messages of a file, in input order. Chunks are parsed by n_process worker processes
+    """
+    chunks = [(file_path, start, end) for start, end in chunk_bounds(file_path, chunk_size)]
+    if not chunks:
+        return
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            Pool(n_process, initializer=_init_worker, initargs=(pattern_re,)) as pool:
+        for spans, levels, tokens in pool.imap(parse_chunk, chunks):
+            traverse_tokens = [dict(items) for items in tokens]  # shared by log messages, like memoized ones
+            for i in range(0, len(spans), FIELDS):
+                line_start, line_stop, content_start, content_end, level, token = spans[i:i + FIELDS]
+                yield LogMessage.parsed(decode_line(mm, line_start, line_stop).replace('\n', ''), content_start,
+                                        content_end, levels[level], traverse_tokens[token])
@@ -0,0 +1,108 @@
+"""
+Checkpoints of a trie for warm restarts: trie nodes, log clusters (template tokens, traverse tokens, template version,
+usage, feedback, metadata and cached log messages), their usage order and the most frequent tokens model. A restart
+loads them instead of sampling and learning all templates again, and keeps expert feedback.
+
+A checkpoint is written from a published snapshot (see snapshot.py): the write lock is only held to publish and to copy
+the most frequent tokens counters, encoding and writing don't pause inserting.
+
+File format: MAGIC, FORMAT_VERSION (big-endian uint16), then a zlib compressed pickle of builtin types only. Loading a
+checkpoint of another format version raises ValueError. Only load checkpoints written by TDA, like any pickle.
+"""
+import os
+import pickle
+import struct
+import zlib
+from typing import Iterable
+
+from log_structure import FeedBack, LogCluster, LogMessage
+from snapshot import NodeSnapshot, TrieSnapshot
+from trie import Trie, frequent_tokens
+from vocabulary import vocabulary
+
+MAGIC = b'TDAC'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>4sH')
+
+
+def _encode_node(node: NodeSnapshot) -> tuple:
+    return (node.name, node.node_type, node.isEnd, [_encode_node(child) for child in node.children],
+            [c.cluster_id for c in node.clusters])
+
+
+def encode(snapshot: TrieSnapshot, state: dict) -> dict:
+    clusters = []
+    for c in snapshot.clusters:
+        feedback = c.feedback
+        clusters.append((c.cluster_id, vocabulary.decode(c.template_ids), c.traverse_tokens, c.version,
+                         c.recent_used_timestamp,
+                         (feedback.decision, feedback.ep, feedback.tp, feedback.p, feedback.reason, feedback.committer),
+                         c.metadata, [(m.line, *m.content_span()) for m in c.log_messages]))
+    return dict(state, root=_encode_node(snapshot.root), clusters=clusters,
+                recent=[c.cluster_id for c in snapshot.recent])
+
+
+def save_checkpoint(root: Trie, path: str, recent: Iterable[LogCluster] = (), level=1) -> int:
+    """
+    publish root, then write its checkpoint to path, atomically. Should be called on root.
+    recent: recently used log clusters restored by load_checkpoint, e.g. the ones used for anomaly detection
+    level: zlib compression level
+    returns size of the checkpoint in bytes
+    """
+    with root.write_lock:
+        snapshot = root.publish(recent)
+        state = {'frequent_tokens': frequent_tokens.state(), 'lru': root.clusters.recent_ids(),
+                 'next_id': root.clusters.next_id}
+    data = HEADER.pack(MAGIC, FORMAT_VERSION) + zlib.compress(
+        pickle.dumps(encode(snapshot, state), protocol=pickle.HIGHEST_PROTOCOL), level)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)  # a crash while writing keeps the former checkpoint
+    return len(data)
+
+
+def _decode_node(encoded: tuple, parent: Trie, clusters: dict[int, LogCluster]):
+    name, node_type, is_end, children, cluster_ids = encoded
+    for child in children:
+        trie_node = parent.children[child[0]] = Trie(child[0], parent, child[1])
+        _decode_node(child, trie_node, clusters)
+    parent.isEnd = is_end
+    for cluster_id in cluster_ids:
+        parent.attach(clusters[cluster_id])
+
+
+def load_checkpoint(path: str) -> tuple[Trie, list[LogCluster]]:
+    """
+    trie written by save_checkpoint, and its recently used log clusters. The most frequent tokens model is restored too
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, format_version = HEADER.unpack_from(data)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise ValueError(f'{path} is not a TDA checkpoint of format version {FORMAT_VERSION}')
+    checkpoint = pickle.loads(zlib.decompress(data[HEADER.size:]))
+
+    clusters = dict()
+    for cluster_id, tokens, traverse_tokens, version, timestamp, feedback, metadata, log_messages in checkpoint['clusters']:
+        log_cluster = LogCluster(tokens, traverse_tokens)
+        log_cluster.cluster_id, log_cluster.version, log_cluster.recent_used_timestamp = cluster_id, version, timestamp
+        log_cluster.feedback = FeedBack(decision=-1, ep=-1, tp=-1)
+        (log_cluster.feedback.decision, log_cluster.feedback.ep, log_cluster.feedback.tp, log_cluster.feedback.p,
+         log_cluster.feedback.reason, log_cluster.feedback.committer) = feedback
+        log_cluster.metadata = metadata  # rebuilt the same by attach below
+        for line, content_start, content_end in log_messages:
+            log_message = LogMessage.released(line, content_start, content_end)
+            log_message.parent = log_cluster
+            log_cluster.logMessagesCache.insert(log_message)
+        clusters[cluster_id] = log_cluster
+
+    name, node_type = checkpoint['root'][:2]
+    root = Trie(name, None, node_type)
+    _decode_node(checkpoint['root'], root, clusters)  # log clusters keep their order in leaf nodes
+    root.clusters.sort()
+    for cluster_id in checkpoint['lru']:
+        root.clusters.touch(clusters[cluster_id])
+    root.clusters.reserve_ids(checkpoint['next_id'])
+    frequent_tokens.load_state(checkpoint['frequent_tokens'])
+    return root, [clusters[cluster_id] for cluster_id in checkpoint['recent']]
@@ -0,0 +1,348 @@
+"""
+Index of log clusters under a trie leaf node, used by Trie.match instead of scanning all clusters of the leaf.
+
+Exact matching is token level: templates without wildcards are looked up by the whole template, templates with wildcards
+are bucketed by their literal first and last tokens (similar to the fixed-depth tree in Drain, but wildcards here may span
+several tokens, so token count is not a key). Only clusters in buckets the line can fall into are checked by the compiled
+matcher, in a deterministic order: most specific bucket first, then insertion order.
+
+Partial matching is pruned by an inverted index from template words to log clusters: only the clusters sharing the most
+words with the line are fuzzy scored. Words are normalized the way fuzz.token_set_ratio does before comparing (case and
+punctuation are ignored), so pruning never drops a cluster only differing in those.
+
+Template merging (see subsumed_pairs) uses the same token index: a template can only subsume templates that contain all
+of its literal tokens, so only those are checked with the compiled matcher instead of all pairs.
+"""
+import heapq
+import re
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+from log_structure import LogCluster, tokenize
+
+ANY_TOKEN = None  # bucket key of a template whose first(last) token is not a fixed literal
+
+_whitespace = re.compile(r'\s')
+_non_word = re.compile(r'\W')  # replaced by whitespace before fuzzy scoring, see thefuzz.utils.full_process
+_WILDCARD_SENTINEL = '\x00'  # stands for <*> of a template when matched by another template, no template literal matches it
+
+
+def literal_tokens(tokenized_template: list[str]) -> frozenset[str]:
+    """
+    distinct tokens of a template that are neither whitespace nor wildcard
+    """
+    return frozenset(token for token in tokenized_template if token and not token.isspace() and '<*>' not in token)
+
+
+def fuzzy_words(text: str) -> frozenset[str]:
+    """
+    distinct words of a text as compared by fuzz.token_set_ratio: lowercase, split on non-word characters.
+    wildcards of a template are no words
+    """
+    return frozenset(_non_word.sub(' ', text).lower().split())
+
+
+def edge_tokens(template: str) -> tuple[Optional[str], Optional[str]]:
+    """
+    literal first and last token every CONTENT matching the template must have, ANY_TOKEN if not fixed.
+    a token is fixed only if the literal text before the first(after the last) <*> contains whitespace
+    """
+    head = template[:template.find('<*>')]
+    tail = template[template.rfind('<*>') + 3:]
+    head_parts = _whitespace.split(head, maxsplit=1)
+    tail_parts = _whitespace.split(tail)
+    return head_parts[0] if len(head_parts) > 1 else ANY_TOKEN, tail_parts[-1] if len(tail_parts) > 1 else ANY_TOKEN
+
+
+def subsumes(general: LogCluster, log_cluster: LogCluster) -> bool:
+    """
+    True if every CONTENT matching log_cluster's template also matches general's template.
+    wildcards of log_cluster are replaced by a sentinel only general's wildcards can match, so that general's literals must
+    match log_cluster's literals
+    """
+    return general.matcher.fullmatch(log_cluster.template.replace('<*>', _WILDCARD_SENTINEL)) is not None
+
+
+def subsumed_pairs(log_clusters: list[LogCluster]) -> list[tuple[LogCluster, LogCluster]]:
+    """
+    (log cluster, the more general log cluster it should be merged into) for every log cluster subsumed by another one.
+    a template subsuming another has a subset of its literal tokens, candidates are found by an inverted index of those.
+    Of two equivalent templates the one with the smaller id (or listed first) is kept. Targets are never merged themselves.
+    """
+    order = {log_cluster: i for i, log_cluster in enumerate(log_clusters)}
+    tokens = {log_cluster: literal_tokens(tokenize(log_cluster.template)) for log_cluster in log_clusters}
+    inverted: dict[str, list[LogCluster]] = dict()
+    tokenless = []  # templates without literal tokens, candidates of every template
+    for log_cluster in log_clusters:
+        for token in tokens[log_cluster]:
+            inverted.setdefault(token, []).append(log_cluster)
+        if not tokens[log_cluster]:
+            tokenless.append(log_cluster)
+
+    def rank(log_cluster: LogCluster) -> tuple:
+        return log_cluster.cluster_id is None, log_cluster.cluster_id or 0, order[log_cluster]
+
+    def dominates(general: LogCluster, log_cluster: LogCluster) -> bool:
+        if not subsumes(general, log_cluster):
+            return False
+        return not subsumes(log_cluster, general) or rank(general) < rank(log_cluster)
+
+    dominators: dict[LogCluster, LogCluster] = dict()
+    for log_cluster in log_clusters:
+        shared: dict[LogCluster, int] = dict()
+        for token in tokens[log_cluster]:
+            for general in inverted[token]:
+                shared[general] = shared.get(general, 0) + 1
+        candidates = [general for general, n in shared.items() if n == len(tokens[general])] + tokenless
+        # most general candidates first, they are the likely merge targets
+        candidates.sort(key=lambda general: (len(tokens[general]), rank(general)))
+        for general in candidates:
+            if general is not log_cluster and dominates(general, log_cluster):
+                dominators[log_cluster] = general
+                break
+
+    pairs = []
+    for log_cluster, general in dominators.items():
+        while general in dominators:  # subsumption is transitive, merge into a template nothing dominates
+            general = dominators[general]
+        pairs.append((log_cluster, general))
+    return pairs
+
+
+class ClusterIndex:
+    """
+    set-like container of log clusters of a leaf node. Iteration is in insertion order.
+    a log cluster must be re-indexed by reindex() when its template changes, LogCluster.set_template does it via parent.
+    """
+
+    def __init__(self):
+        self._clusters: dict[LogCluster, tuple] = dict()  # log cluster -> its index key, in insertion order
+        self._literals: dict[str, dict[LogCluster, None]] = dict()  # template without wildcards -> log clusters
+        self._buckets: dict[tuple[Optional[str], Optional[str]], dict[LogCluster, None]] = dict()  # (first, last) token
+        self._tokens: dict[LogCluster, frozenset[str]] = dict()  # log cluster -> fuzzy_words of its template
+        self._inverted: dict[str, dict[LogCluster, None]] = dict()  # word -> log clusters containing it
+        self._order: dict[LogCluster, int] = dict()  # log cluster -> insertion sequence number, breaks ties
+        self._sequence = 0
+
+    @staticmethod
+    def _key(log_cluster: LogCluster) -> tuple:
+        if '<*>' not in log_cluster.template:
+            return False, log_cluster.template
+        return True, edge_tokens(log_cluster.template)
+
+    def _table(self, wildcard: bool) -> dict:
+        return self._buckets if wildcard else self._literals
+
+    def _index_tokens(self, log_cluster: LogCluster):
+        tokens = self._tokens[log_cluster] = fuzzy_words(log_cluster.template)
+        for token in tokens:
+            self._inverted.setdefault(token, dict())[log_cluster] = None
+
+    def _unindex_tokens(self, log_cluster: LogCluster):
+        for token in self._tokens.pop(log_cluster):
+            del self._inverted[token][log_cluster]
+            if not self._inverted[token]:
+                del self._inverted[token]
+
+    def add(self, log_cluster: LogCluster):
+        if log_cluster in self._clusters:
+            return
+        wildcard, key = self._clusters[log_cluster] = self._key(log_cluster)
+        self._table(wildcard).setdefault(key, dict())[log_cluster] = None
+        self._index_tokens(log_cluster)
+        self._order[log_cluster] = self._sequence
+        self._sequence = self._sequence + 1
+
+    def discard(self, log_cluster: LogCluster):
+        if log_cluster not in self._clusters:
+            return
+        wildcard, key = self._clusters.pop(log_cluster)
+        table = self._table(wildcard)
+        del table[key][log_cluster]
+        if not table[key]:
+            del table[key]
+        self._unindex_tokens(log_cluster)
+        del self._order[log_cluster]
+
+    def remove(self, log_cluster: LogCluster):
+        if log_cluster not in self._clusters:
+            raise KeyError(log_cluster)
+        self.discard(log_cluster)
+
+    def reindex(self, log_cluster: LogCluster):
+        """
+        move a log cluster whose template changed to its new bucket, keeping its insertion order among all clusters
+        """
+        if log_cluster not in self._clusters:
+            return
+        self._unindex_tokens(log_cluster)
+        self._index_tokens(log_cluster)
+        if self._clusters[log_cluster] == self._key(log_cluster):
+            return
+        wildcard, key = self._clusters[log_cluster]
+        table = self._table(wildcard)
+        del table[key][log_cluster]
+        if not table[key]:
+            del table[key]
+        wildcard, key = self._clusters[log_cluster] = self._key(log_cluster)
+        self._table(wildcard).setdefault(key, dict())[log_cluster] = None
+
+    def match_exact(self, content: str, content_tokens: list[str]) -> Optional[LogCluster]:
+        """
+        content_tokens: tokenize(content)
+        """
+        literal = self._literals.get(content)
+        if literal:
+            return next(iter(literal))
+        first, last = content_tokens[0], content_tokens[-1]
+        for key in ((first, last), (first, ANY_TOKEN), (ANY_TOKEN, last), (ANY_TOKEN, ANY_TOKEN)):
+            for log_cluster in self._buckets.get(key, ()):
+                if log_cluster.matcher.fullmatch(content):
+                    return log_cluster
+        return None
+
+    def candidates(self, content: str, top_n: int) -> list[LogCluster]:
+        """
+        log clusters worth fuzzy scoring against a log message: the top_n clusters sharing the most words with it (see
+        fuzzy_words), ties broken by insertion order. top_n <= 0 returns all clusters. A log message sharing no word with
+        any cluster rarely reaches theta_match, it is only scored against the top_n most recently added clusters, so
+        pruning never scores more clusters than scoring all.
+        content: LogMessage.get_content()
+        """
+        if top_n <= 0 or len(self._clusters) <= top_n:
+            return list(self._clusters)
+        shared: dict[LogCluster, int] = dict()
+        for word in fuzzy_words(content):
+            for log_cluster in self._inverted.get(word, ()):
+                shared[log_cluster] = shared.get(log_cluster, 0) + 1
+        if not shared:
+            return list(self._clusters)[-top_n:]
+        if len(shared) <= top_n:
+            return list(shared)
+        return heapq.nsmallest(top_n, shared, key=lambda log_cluster: (-shared[log_cluster], self._order[log_cluster]))
+
+    def __iter__(self) -> Iterator[LogCluster]:
+        return iter(self._clusters)
+
+    def __len__(self) -> int:
+        return len(self._clusters)
+
+    def __contains__(self, log_cluster: LogCluster) -> bool:
+        return log_cluster in self._clusters
+
+
+class ClusterRegistry:
+    """
+    flat registry of all log clusters in a trie, kept by the root node. Log clusters get monotonically increasing ids when
+    first attached to a leaf node, and keep them when moved by reconstruct.
+    indexes: id -> log cluster, leaf node -> log clusters, first level trie node (e.g. LEVEL) -> log clusters.
+    enumeration is in id order and never walks the trie. Usage order is kept for eviction, see touch().
+    """
+
+    def __init__(self):
+        self._clusters: dict[int, LogCluster] = dict()
+        self._recent: OrderedDict[LogCluster, None] = OrderedDict()  # least recently used first
+        self._leaves: dict['Trie', dict[LogCluster, None]] = dict()
+        self._levels: dict['Trie', dict[LogCluster, None]] = dict()
+        self._next_id = 0
+
+    @staticmethod
+    def _level_node(trie_node: 'Trie') -> 'Trie':
+        """
+        ancestor of trie_node in the first level under root, root itself if trie_node is root
+        """
+        while trie_node.parent is not None and trie_node.parent.parent is not None:
+            trie_node = trie_node.parent
+        return trie_node
+
+    @staticmethod
+    def _remove(index: dict, key, log_cluster: LogCluster):
+        del index[key][log_cluster]
+        if not index[key]:
+            del index[key]
+
+    def attach(self, log_cluster: LogCluster, leaf: 'Trie'):
+        """
+        log_cluster has been added to leaf. assigns an id if it has none
+        """
+        if log_cluster.cluster_id is None:
+            log_cluster.cluster_id = self._next_id
+            self._next_id = self._next_id + 1
+        self._clusters[log_cluster.cluster_id] = log_cluster
+        self._recent[log_cluster] = None
+        self._leaves.setdefault(leaf, dict())[log_cluster] = None
+        self._levels.setdefault(self._level_node(leaf), dict())[log_cluster] = None
+
+    def detach(self, log_cluster: LogCluster, leaf: 'Trie'):
+        """
+        log_cluster has been removed from leaf, e.g. to be moved to another leaf. It keeps its id
+        """
+        self._remove(self._leaves, leaf, log_cluster)
+        self._remove(self._levels, self._level_node(leaf), log_cluster)
+
+    def forget(self, log_cluster: LogCluster):
+        """
+        log_cluster has left the trie for good, e.g. evicted
+        """
+        self._clusters.pop(log_cluster.cluster_id, None)
+        self._recent.pop(log_cluster, None)
+
+    def touch(self, log_cluster: LogCluster):
+        """
+        log_cluster has just been used, e.g. matched by a log message
+        """
+        if log_cluster in self._recent:
+            self._recent.move_to_end(log_cluster)
+
+    def least_recently_used(self) -> Optional[LogCluster]:
+        return next(iter(self._recent), None)
+
+    def recent_ids(self) -> list[int]:
+        """
+        ids of log clusters, least recently used first
+        """
+        return [log_cluster.cluster_id for log_cluster in self._recent]
+
+    @property
+    def next_id(self) -> int:
+        return self._next_id
+
+    def reserve_ids(self, next_id: int):
+        """
+        ids below next_id are taken, e.g. by log clusters restored from a checkpoint
+        """
+        self._next_id = max(self._next_id, next_id)
+
+    def sort(self):
+        """
+        enumerate in id order again, after log clusters with ids have been attached out of id order
+        """
+        self._clusters = dict(sorted(self._clusters.items()))
+
+    def get(self, cluster_id: int) -> Optional[LogCluster]:
+        return self._clusters.get(cluster_id)
+
+    def leaves(self) -> list['Trie']:
+        return list(self._leaves)
+
+    def by_leaf(self, leaf: 'Trie') -> list[LogCluster]:
+        return list(self._leaves.get(leaf, ()))
+
+    def under(self, trie_node: 'Trie') -> list[LogCluster]:
+        """
+        log clusters in the subtree of trie_node, in id order
+        """
+        if trie_node.parent is None:
+            return list(self)
+        level_node = self._level_node(trie_node)
+        log_clusters = self._levels.get(level_node, ())
+        if trie_node is not level_node:
+            log_clusters = [log_cluster for log_cluster in log_clusters
+                            if trie_node.path_to(log_cluster.parent) is not None]
+        return sorted(log_clusters, key=lambda log_cluster: log_cluster.cluster_id)
+
+    def __iter__(self) -> Iterator[LogCluster]:
+        return iter(list(self._clusters.values()))
+
+    def __len__(self) -> int:
+        return len(self._clusters)
@@ -8,13 +8,54 @@ bgl_pattern = r'\S+ +\d+ +(?P<DATE>\S+) +\S+ +\S+ +\S+ +\S+ +(?P<COMPONENT>\w+)
 bgl2_path = './data/bgl2'  # total bgl log, 4747963 lines
 bgl2_pattern = bgl_pattern
 
+hdfs_path = './data/HDFS/HDFS_2k.log'
+hdfs_pattern = r'(?P<DATE>\d+) +(?P<TIME>\d+) +(?P<PID>\d+) +(?P<LEVEL>\w+) +(?P<COMPONENT>\S+): +(?P<CONTENT>.+)'
+
+thunderbird_path = './data/Thunderbird/Thunderbird_2k.log'
+thunderbird_pattern = r'(?P<LEVEL>\S+) +\d+ +(?P<DATE>\S+) +\S+ +\S+ +\d+ +\S+ +\S+ +(?P<COMPONENT>\S+?): +(?P<CONTENT>.+)'
+
+java_path = './data/Java/application.log.2024-01-04.0'
+java_pattern = r'(?P<DATE>\S+) +(?P<LEVEL>\w+) +(?P<PID>\d+) +-+ +\[(?P<THREAD>.+?)\] +(?P<CLASS>\S+) +: +(?P<CONTENT>.+)'
+
 jenkins_path = './data/Jenkins/semantic-sdk-release.log'
 jenkins_pattern = r'(?P<DATE>\[\S+\]) +(?P<LEVEL>\w+) +(?P<COMPONENT>\w+) +- +((\[[^\[\]]+\] *)|(.+ -+ ))*(?P<CONTENT>[^\n]+)'
 
 # config interface
-file_path = bgl_path
+file_path = bgl_path  # a path or a glob pattern, e.g. './data/Java/application.log*', see sources.LogSource
 log_pattern_re = bgl2_pattern
 log_metadata = 'Jenkins, groovy, devops'
+nlp_batch_size = 0  # 0 for tagging line by line, otherwise number of lines tagged together by spacy nlp.pipe
+nlp_n_process = 1  # spacy worker processes used in batched tagging
+trie_batch_size = 0  # 0 for inserting log messages one by one, otherwise number of log messages inserted by Trie.insert_batch
+traverse_backend = 'spacy'  # backend computing traverse tokens: 'spacy' (open class words) or 'regex' (spacy-free words filter)
+traverse_cache_capacity = 10000  # max number of digit-masked CONTENTs whose traverse tokens are memoized
+top_n_candidates = 10  # only log clusters sharing the most words with a log message are fuzzy scored, 0 to score all
+max_clusters = 0  # max number of live log clusters in trie, least recently used ones are evicted. 0 for no limit
+max_trie_nodes = 0  # max number of trie nodes, least recently used log clusters are evicted until met. 0 for no limit
+spill_path = None  # evicted log clusters are appended to this file as json lines, e.g. './evicted_clusters.jsonl'
+hot_line_cache_capacity = 1000  # max number of (digit-masked CONTENT, LEVEL) mapped straight to log clusters, 0 to disable
+frequent_tokens_capacity = 10000  # max number of tokens counted by the most frequent tokens model, see trie.FrequentTokens
+rerank_interval = 10000  # log messages between two re-rankings of most frequent tokens, 0 to keep the ranks of sampling
+merge_interval = 0  # seconds between background passes merging subsumed templates, see Trie.plan_merges. 0 to disable
+snapshot_interval = 1.0  # min seconds between two trie snapshots published for detection and APIs, see snapshot.py
+n_shards = 0  # 0 to insert in this process, otherwise number of worker processes owning sub-tries by LEVEL, see sharding.py
+shard_batch_size = 1000  # lines sent to a shard worker at once
+follow = False  # keep reading lines appended to file_path and new matching files, like tail -f
+offsets_path = None  # json file read offsets are saved to and resumed from on restart, e.g. './offsets.json'
+bulk_n_process = 0  # 0 to stream file_path, otherwise processes parsing memory-mapped chunks of it, see bulk.py. Only
+# faster than streaming given 2 CPUs or more, see unit_tests#test_bulk_throughput
+bulk_chunk_size = 1 << 22  # bytes of a chunk parsed by a bulk worker at once
+tcp_port = None  # port receiving newline-delimited log lines over TCP instead of reading file_path (still sampled), see network.py
+udp_port = None  # port receiving syslog-style log datagrams instead of reading file_path. None to disable
+ingest_queue_size = 10000  # max received lines waiting to be inserted into trie
+ingest_drop = False  # drop TCP lines while the queue is full, instead of slowing senders down. UDP lines are always dropped
+checkpoint_path = None  # trie checkpoint loaded at startup if it exists, and written on the way, e.g. './tda.ckpt'
+checkpoint_interval = 0  # seconds between two checkpoints while inserting, 0 to write one only once file_path is read
+log_messages_capacity = 100000  # most recent log messages kept for the /logs/ API
+
+# rag vector database. Attu client addr: http://10.58.137.244:8888/
+milvus_uri = 'http://10.58.137.244:19530'
+milvus_collection = 'scale_ad_collection'
 
 ################################################
 # Constant Variables used cross py files under tda directory
@@ -1,12 +1,21 @@
 import json
 import os
 import random
-from openai import OpenAI
+from typing import Optional
+
 from config import log_metadata
 import re
 from log_structure import LogCluster, FeedBack
 
-client = OpenAI()
+_client: Optional['OpenAI'] = None  # created on first use by get_client()
+
+
+def get_client() -> 'OpenAI':
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI()
+    return _client
 
 
 def openai_feedback(log_cluster: LogCluster):
@@ -22,7 +31,7 @@ def openai_feedback(log_cluster: LogCluster):
                 f'log template: {log_cluster.template[0:25]}\n'
                 f'examples:\n {samples}')
 
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
       model="gpt-3.5-turbo-1106",
       response_format={"type": "json_object"},
       messages=[
@@ -3,20 +3,27 @@ Log Data Structures, including LogMessage(wrapper of each log message. Each line
 
 """
 import re
+from array import array
 from time import time
-from typing import Optional
-
-import en_core_web_sm
+from typing import Iterable, Iterator, Optional
 
+from config import traverse_backend as traverse_backend_name, traverse_cache_capacity
 from config import EXACT_MATCH, NO_MATCH, PARTIAL_MATCH, TRA_TYPE_most_frequent_tokens, TRA_TYPE_prefix_tokens, TRA_TYPE_domain_knowledge
 from exceptions import LogError
+from traverse_backends import TraverseBackend, create_backend
 from utils import LogMessagesCache
+from vocabulary import vocabulary, EMPTY_ID, SPACE, WILD, WILD_HEAD, WILD_TAIL, WILDCARD_ID
 
-nlp = en_core_web_sm.load()  # load a trained pipeline
+traverse_backend: TraverseBackend = create_backend(traverse_backend_name, traverse_cache_capacity)
 
-# refer to https://universaldependencies.org/u/pos/ , to exclude stopwords
-open_class_words = {'ADJ', 'ADV', 'INTJ', 'NOUN', 'PROPN', 'VERB'}
 
+def set_traverse_backend(name: str) -> TraverseBackend:
+    """
+    switch the backend used to compute traverse tokens, e.g. for benchmarks. Tries built by another backend are not affected.
+    """
+    global traverse_backend
+    traverse_backend = create_backend(name, traverse_cache_capacity)
+    return traverse_backend
 
 
 def tokenize(content: str):
@@ -32,45 +39,140 @@ def serialize(tokens: list[str]):
     return ''.join(tokens)
 
 
-def merge_adjacent_wildcards(template_tokens: list[str]) -> [list[str], str]:
+def mask_content(content: str) -> str:
     """
-    merge adjacent <*>s.
-    spaces between '<*>' should be replaced. e.g. ['<*>', ' ', ' \t\t', '<*>'] ---> ['<*>']
+    get rid of numbers, or words that contains numbers, before sending CONTENT to nlp. see LogMessage.__tokenize
     """
-    # FIXME: there's risk on serialize -> tokenize. Ideally, only one traverse direction: tokenize-> serialize
-    template = re.sub(r'<\*>(\s|(<\*>))*<\*>', '<*>', serialize(template_tokens))
-    return tokenize(template), template
+    return re.sub(r'\w*\d+\w*', '', content)
 
 
-def extract_template(log_message: 'LogMessage', tokenized_template: list[str]) -> list[str]:
+def get_traverse_tokens(content: str) -> dict[str, str]:
     """
-    extract a new template between the incoming log cluster and existed template
+    traverse tokens of a CONTENT computed by the configured backend, memoized on its digit-masked form
     """
-    log_message = log_message.content_tokens
-    # identify the common set of tokens shared by both t_i and l_i
-    common_token_set = set(log_message) & set(tokenized_template)
-    common_token_set.discard('')
-    # choose the list that has more tokens between 𝑡ˆ and 𝑙ˆ
-    new_tokenized_template = log_message if len(log_message) > len(tokenized_template) else tokenized_template
-    new_tokenized_template = list(new_tokenized_template)
-    # replace any token in the longer list that is not in the common token set with the placeholder "<*>"
-    for i in range(len(new_tokenized_template)):
-        if new_tokenized_template[i] not in common_token_set:
-            new_tokenized_template[i] = '<*>'
-    return new_tokenized_template
+    return traverse_backend.get(mask_content(content))
+
+
+def tag_log_messages(log_messages: list['LogMessage'], batch_size: int = 256, n_process: int = 1):
+    """
+    batched counterpart of the traverse tokens step in LogMessage.__tokenize. Fill in traverse tokens of log messages
+    created with tag=False in input order; with spacy backend they are tagged by nlp.pipe.
+    n_process: number of spacy worker processes, 1 means tagging in the current process
+    """
+    masked_contents = [mask_content(log_message.get_content()) for log_message in log_messages]
+    for log_message, traverse_tokens in zip(log_messages, traverse_backend.get_batch(masked_contents, batch_size, n_process)):
+        log_message.traverse_tokens = traverse_tokens
+
+
+def parse_lines(pattern: re.Pattern, lines: Iterable[str], batch_size: int = 0, n_process: int = 1,
+                lazy: bool = False) -> Iterator['LogMessage']:
+    """
+    parse log lines into log messages, lines that fail to match the pattern are skipped.
+    batch_size: 0 for per-line tagging; otherwise parsed lines are collected into chunks of batch_size and tagged by
+    tag_log_messages. Either way log messages are yielded in input order.
+    lazy: yield untokenized log messages (see LogMessage), batch_size is ignored
+    """
+    chunk = []
+    for line in lines:
+        try:
+            log_message = LogMessage(pattern, line, tag=batch_size <= 0, lazy=lazy)
+        except (LogError, ValueError) as e:
+            print(e)
+            continue
+        if batch_size <= 0 or lazy:
+            yield log_message
+            continue
+        chunk.append(log_message)
+        if len(chunk) >= batch_size:
+            tag_log_messages(chunk, batch_size, n_process)
+            yield from chunk
+            chunk = []
+    if chunk:
+        tag_log_messages(chunk, batch_size, n_process)
+        yield from chunk
+
+
+def _collapse_wildcards(token: str) -> str:
+    while '<*><*>' in token:
+        token = token.replace('<*><*>', '<*>')
+    return token
+
+
+def generalize_template(template_ids: array, content_ids: array) -> Optional[array]:
+    """
+    new template of a log cluster for a log message, with no serialize -> tokenize round trip (see extract_template in
+    unit_tests for the string based reference): tokens not shared by both arrays are replaced by <*> in the longer one, and <*>s separated only by whitespace are
+    merged in the same pass. Ids are compared as integers, strings are only built (and interned) when merging wildcards
+    joins two tokens. returns the new template ids, None if the template doesn't change
+    template_ids: LogCluster.template_ids
+    content_ids: LogMessage.get_content_ids()
+    """
+    if len(content_ids) > len(template_ids):
+        longer, common = content_ids, set(template_ids)
+    else:
+        longer, common = template_ids, set(content_ids)
+    flags, tokens, intern = vocabulary.flags, vocabulary.tokens, vocabulary.intern
+    new_ids: list[int] = []
+    open_at = None  # index of the last token ending with <*>, if only whitespace tokens follow it
+    last_flags = SPACE  # flags of new_ids[-1], nothing to join with at start
+    for token_id in longer:
+        if token_id == EMPTY_ID or token_id not in common:
+            token_id, token_flags = WILDCARD_ID, WILD | WILD_HEAD | WILD_TAIL
+        else:
+            token_flags = flags[token_id]
+            if token_flags & SPACE:
+                new_ids.append(token_id)
+                last_flags = SPACE
+                continue
+            if token_flags & WILD and '<*><*>' in tokens[token_id]:
+                token_id = intern(_collapse_wildcards(tokens[token_id]))
+                token_flags = flags[token_id]
+        if open_at is not None and token_flags & WILD_HEAD:
+            # <*> (whitespace) <*>... ---> <*>...
+            del new_ids[open_at + 1:]
+            if token_id != WILDCARD_ID:
+                new_ids[open_at] = intern(tokens[new_ids[open_at]] + tokens[token_id][3:])
+        elif not last_flags & SPACE:
+            # a whitespace token between two words was replaced by <*>, they are one token now
+            new_ids[-1] = intern(tokens[new_ids[-1]] + tokens[token_id])
+        else:
+            new_ids.append(token_id)
+        last_flags = flags[new_ids[-1]]
+        open_at = len(new_ids) - 1 if last_flags & WILD_TAIL else None
+    new_ids = array('i', new_ids)
+    return None if new_ids == template_ids else new_ids
+
+
+def filter_traverse_tokens(template: str, traverse_tokens: dict[str, str]) -> dict[str, str]:
+    """
+    traverse tokens that are still words of the template, i.e. not replaced by <*>
+    """
+    literal = template.replace('<*>', ' ')
+    return {token: tag for token, tag in traverse_tokens.items()
+            if re.search(rf'(?<!\w){re.escape(token)}(?!\w)', literal)}
 
 
 class LogCluster:
-    def __init__(self, tokenized_template: list[str]):
-        self.tokenized_template: list[str] = tokenized_template
-        self.template: str = serialize(tokenized_template)
+    """
+    traverse_tokens: derived from the log message that created this log cluster, then filtered on every template change.
+    update_trie routes log clusters by them, with no nlp call.
+    template_ids: template tokens as ids of the shared vocabulary, see vocabulary.py
+    """
+    __slots__ = ('cluster_id', 'template_ids', 'template', 'matcher', 'version', 'traverse_tokens',
+                 'logMessagesCache', 'nWildcard', 'recent_used_timestamp', 'feedback', '_parent', 'metadata')
+
+    def __init__(self, tokenized_template: list[str], traverse_tokens: dict[str, str] = None):
+        self.cluster_id: Optional[int] = None  # assigned by ClusterRegistry of the trie, stable while in the trie
+        self.template: Optional[str] = None
+        self.template_ids: array = array('i')  # held in the vocabulary while the log cluster is in the trie
+        self.version: int = 0  # increased every time the template changes, so that derived data can be invalidated
+        self._parent: Optional['Trie'] = None
+        self.traverse_tokens: dict[str, str] = traverse_tokens if traverse_tokens is not None else dict()
+        self.set_template(tokenized_template)
         self.logMessagesCache: LogMessagesCache = LogMessagesCache(300)
-        self.nWildcard: int = 0  # number of wildcard(<*>) in the template
-        self.ground_truth: float = 0
         self.recent_used_timestamp = None
         self.update_time()
         self.feedback = FeedBack(decision=-1, ep=-1, tp=-1)  # instance of Feedback, default unknown
-        self._parent: Optional['Trie'] = None
         self.metadata: dict[str, str] = dict()  # names from parent to root trie nodes, also includes field 'template' of its own
 
     @property
@@ -78,11 +180,57 @@ class LogCluster:
         return self._parent
 
     @parent.setter
-    def parent(self, trie_node: 'Trie'):
+    def parent(self, trie_node: Optional['Trie']):
         self._parent = trie_node
+        if trie_node is None:  # evicted from trie, keep metadata of its last leaf node
+            return
+        # rebuilt, log cluster may be moved to another leaf node by reconstruct. Replaced at once, it may be read by snapshots
+        metadata = dict()
         while trie_node:
-            self.metadata[trie_node.node_type] = trie_node.name if trie_node.node_type not in self.metadata else self.metadata[trie_node.node_type]+f', {trie_node.name}'
+            metadata[trie_node.node_type] = trie_node.name if trie_node.node_type not in metadata else metadata[trie_node.node_type]+f', {trie_node.name}'
             trie_node = trie_node.parent
+        self.metadata = metadata
+
+    @property
+    def tokenized_template(self) -> list[str]:
+        return vocabulary.decode(self.template_ids)
+
+    def set_template(self, tokenized_template: list[str], template: str = None) -> bool:
+        """
+        set template tokens, and its serialized form if already known. The compiled matcher is rebuilt only if template changes.
+        returns True if template changed
+        """
+        return self.set_template_ids(vocabulary.encode(tokenized_template), template)
+
+    def set_template_ids(self, template_ids: array, template: str = None) -> bool:
+        """
+        set_template by token ids
+        """
+        vocabulary.acquire(template_ids)
+        vocabulary.release(self.template_ids)
+        self.template_ids = template_ids
+        template = serialize(vocabulary.decode(template_ids)) if template is None else template
+        if template == self.template:
+            return False
+        self.template = template
+        self.nWildcard = template_ids.count(WILDCARD_ID)  # number of wildcard(<*>) in the template
+        # translate special characters in template. There's an interesting phenomenon shown in unit_tests#test_translation,
+        # that \t equals \\t in param 'pattern'. Use fullmatch, the whole CONTENT must match the template.
+        self.matcher: re.Pattern = re.compile(re.escape(template).replace(r'<\*>', r'.*'))
+        self.version = self.version + 1
+        if self.version > 1:  # template generalized, its words are a subset of the former template's words
+            self.traverse_tokens = filter_traverse_tokens(template, self.traverse_tokens)
+        if self._parent is not None:
+            self._parent.logClusters.reindex(self)  # leaf node indexes log clusters by template
+        return True
+
+    def release_template_ids(self):
+        """
+        release template ids in the vocabulary once out of the trie, see Trie.evict and Trie.apply_merges. The serialized
+        template and its matcher are kept, e.g. for log messages still referring to this log cluster
+        """
+        vocabulary.release(self.template_ids)
+        self.template_ids = array('i')
 
     def insert_and_update_template(self, log_message: 'LogMessage', match_type: int):
         """
@@ -91,13 +239,45 @@ class LogCluster:
         """
         self.update_time()
         self.logMessagesCache.insert(log_message)
+        if self._parent is not None:
+            self._parent.changed()  # to be published, see Trie.publish
         # exact match, then no need to update template
         if match_type == EXACT_MATCH:
             return
-        # update template based on the new log message
-        self.tokenized_template = extract_template(log_message, self.tokenized_template)
-        # merge adjacent "<*>"s
-        self.tokenized_template, self.template = merge_adjacent_wildcards(self.tokenized_template)
+        # update template based on the new log message, matcher and indexes are only rebuilt if the template changes
+        template_ids = generalize_template(self.template_ids, log_message.get_content_ids())
+        if template_ids is not None:
+            self.set_template_ids(template_ids)
+
+    def absorb(self, log_cluster: 'LogCluster'):
+        """
+        take over log messages and feedback of a log cluster subsumed by this one, see Trie.apply_merges.
+        cached log messages are kept in recency order of both clusters. Of two expert decisions, anomaly(1) wins
+        """
+        log_messages = [self.logMessagesCache.to_list(), log_cluster.logMessagesCache.to_list()]
+        if (log_cluster.recent_used_timestamp or 0) < (self.recent_used_timestamp or 0):
+            log_messages.reverse()
+        self.logMessagesCache.clear()
+        for log_message in log_messages[0] + log_messages[1]:
+            log_message.parent = self
+            self.logMessagesCache.insert(log_message)
+        self.recent_used_timestamp = max(self.recent_used_timestamp or 0, log_cluster.recent_used_timestamp or 0)
+        if self.feedback.decision == -1 or (self.feedback.decision == 0 and log_cluster.feedback.decision == 1):
+            self.feedback = log_cluster.feedback
+
+    def set_feedback(self, feedback: 'FeedBack'):
+        """
+        replace expert feedback, e.g. from the anomaly detection thread. FeedBack objects are never changed in place once
+        set, so readers see either the old or the new one. The change is published with the next snapshot
+        """
+        leaf = self._parent
+        if leaf is None:
+            self.feedback = feedback
+            return
+        with leaf.get_root().write_lock:
+            self.feedback = feedback
+            if self._parent is not None:  # may have been evicted meanwhile
+                self._parent.changed()
 
     def update_time(self):
         self.recent_used_timestamp = int(time())
@@ -108,71 +288,155 @@ class LogCluster:
         """
         return [log_message.get_content() for log_message in self.logMessagesCache.to_list()]
 
+    def to_dict(self) -> dict:
+        """
+        json-friendly summary, e.g. for log clusters spilled to disk when evicted from trie
+        """
+        return {
+            'id': self.cluster_id,
+            'template': self.template,
+            'metadata': self.metadata,
+            'messages': len(self.logMessagesCache),
+            'samples': self.get_log_messages()[0:10],
+            'recent_used_timestamp': self.recent_used_timestamp,
+            'feedback': {'decision': self.feedback.decision, 'ep': self.feedback.ep, 'tp': self.feedback.tp,
+                         'p': self.feedback.p, 'reason': self.feedback.reason, 'committer': self.feedback.committer},
+        }
+
 
 class LogMessage:
-    def __init__(self, pattern: re.Pattern = None, line: str = None, template: str = None) -> None:
+    """
+    data_frame, content_tokens, content_ids and traverse_tokens are only used while inserting into trie. Call release()
+    after insert, a retained log message keeps only its origin line, the span of CONTENT in the line and its log cluster.
+    """
+    __slots__ = ('line', 'data_frame', 'content_tokens', 'content_ids', 'traverse_tokens', 'parent', '_content_start',
+                 '_content_end')
+
+    def __init__(self, pattern: re.Pattern = None, line: str = None, template: str = None, tag: bool = True,
+                 lazy: bool = False) -> None:
         """
         pattern: compiled input log line pattern
         line: origin log line
+        tag: if False, skip nlp, traverse_tokens stays None until tag_log_messages fills it in batch
+        lazy: if True, only parse the data frame, content_tokens and traverse_tokens stay None until ensure_tokens()
         """
-        self.data_frame = dict()
+        self.data_frame: Optional[dict[str, str]] = dict()
         self.traverse_tokens: Optional[dict] = None  # tokens used in traverse internal nodes
         self.content_tokens = list(str())  # tokens generated from CONTEXT
+        self.content_ids: Optional[array] = None  # vocabulary ids of content_tokens, see get_content_ids
         self.parent: Optional[LogCluster] = None  # the log cluster which this log message belongs to
 
-        # update trie process will call it too. in this condition, only requires log cluster template parameter.
+        # log message generated from a log cluster template. in this condition, only requires template parameter.
         if template:
+            self.line = template
+            self._content_start, self._content_end = 0, len(template)
             self.data_frame['CONTENT'] = template
-            self.__tokenize()
+            self.__tokenize(tag)
             return
 
         assert pattern, line
-        self.pattern = pattern
         self.line = line.replace('\n', '')  # origin log message, remove \n
         # preprocess. generate dataframe and tokenize CONTENT field
-        self.__gen_data_frame()
-        self.__tokenize()
+        self.__gen_data_frame(pattern)
+        if lazy:
+            self.content_tokens = None
+            return
+        self.__tokenize(tag)
         # TODO: add context to every log message. maybe 10 log entry before and after this message
 
-    def __gen_data_frame(self):
-        m = self.pattern.match(self.line)
+    def __gen_data_frame(self, pattern: re.Pattern):
+        m = pattern.match(self.line)
         if not m:
-            raise LogError(self.line, str(self.pattern))
+            raise LogError(self.line, str(pattern))
         gd = m.groupdict()
         # check if the data frame CONTENT only contains space or non-words, eg, '--------', ' '.
         if re.fullmatch(r'\W*', gd['CONTENT']):
             raise ValueError(f"field CONTENT: [{gd['CONTENT']}], or LEVEL:[{gd['LEVEL']}] is empty")
         self.data_frame.update(gd)
+        self._content_start, self._content_end = m.span('CONTENT')
 
-    def __tokenize(self):
+    def __tokenize(self, tag: bool = True):
         # remove any characters that are not letters or numbers
         self.content_tokens = tokenize(self.get_content())
-        # generate tokens by nlp, filter out open class words, use these tokens in traverse internal nodes stage
-
-        # FIXME: Spacy defect.
-        #  Filer out Open Class Words is not enough, eg.
-        #    '0x0b85eee0'                                --> PROPN;
-        #    'generating core.2275'                           --> [VERB, PROPN]
-        #    'machine[NOUN] check[NOUN]:[PUNCT] i[PRON]-[VERB]fetch[VERB]......................[PUNCT]0[NUM]'   Possible solution: filter out non-words? like '-' here
-        #  Only words(r'[A-Za-z]+') can be put into traverse tokens? so NLP is not necessary?
+        # generate traverse tokens by the configured backend (see traverse_backends), use these tokens in traverse internal nodes stage
 
         # TODO: Further optimization: here, I just get rid of numbers, or words that contains numbers, e.g.
         #    "CE sym 2, at 0x0b85eee0, mask 0x05, core.3947358" ---> "CE sym , at , mask , core.".
         #    "CioStream socket to 172.16.96.116:33370'"         ---> "CioStream socket to ...:'"
         #  then the traverse tokens won't contain any numbers.
         #  However, this is not an elegant solution. Optimization may be processed after researching Spacy. I think patterns like hex '0x05' can be identified as NUM.
+        if not tag or self.traverse_tokens is not None:  # not tagged now, or tagged already, e.g. by a bulk worker
+            return
+        self.traverse_tokens = get_traverse_tokens(self.get_content())
+
+    def ensure_tokens(self):
+        """
+        tokenize a log message created with lazy=True
+        """
+        if self.content_tokens is None:
+            self.__tokenize()
+
+    def get_content_ids(self) -> array:
+        """
+        vocabulary ids of content tokens, looked up once and only when needed, i.e. not for exact matches
+        """
+        if self.content_ids is None:
+            self.content_ids = vocabulary.lookup(self.content_tokens)
+        return self.content_ids
 
-        # TODO: There may be another way to fix this: remove PROPN from open_class_words?
-        content = re.sub(r'\w*\d+\w*', '', self.get_content())
-        self.traverse_tokens = {token.text: token.pos_ for token in nlp(content) if token.pos_ in open_class_words}
-        pass
+    def release(self):
+        """
+        drop intermediate data once the log message has been inserted into trie and its log cluster
+        """
+        self.data_frame = None
+        self.content_tokens = None
+        self.content_ids = None
+        self.traverse_tokens = None
+
+    @classmethod
+    def parsed(cls, line: str, content_start: int, content_end: int, level: str, traverse_tokens: dict[str, str]) \
+            -> 'LogMessage':
+        """
+        a lazy log message (see __init__) parsed and tagged elsewhere, e.g. by a bulk worker. Its data frame only has
+        CONTENT and LEVEL
+        """
+        log_message = cls.__new__(cls)
+        log_message.line = line
+        log_message._content_start, log_message._content_end = content_start, content_end
+        log_message.data_frame = {'CONTENT': line[content_start:content_end], 'LEVEL': level}
+        log_message.traverse_tokens = traverse_tokens
+        log_message.content_tokens = log_message.content_ids = log_message.parent = None
+        return log_message
+
+    @classmethod
+    def released(cls, line: str, content_start: int, content_end: int) -> 'LogMessage':
+        """
+        a released log message, e.g. restored from a checkpoint, see content_span
+        """
+        log_message = cls.__new__(cls)
+        log_message.line = line
+        log_message._content_start, log_message._content_end = content_start, content_end
+        log_message.data_frame = log_message.content_tokens = log_message.content_ids = None
+        log_message.traverse_tokens = log_message.parent = None
+        return log_message
+
+    def content_span(self) -> tuple[int, int]:
+        """
+        start and end of CONTENT in line
+        """
+        return self._content_start, self._content_end
 
     def get_content(self) -> str:
-        if 'CONTENT' not in self.data_frame:
+        data_frame = self.data_frame  # read once, may be released by the inserting thread meanwhile
+        if data_frame is None:  # released, CONTENT is sliced from the origin line
+            return self.line[self._content_start:self._content_end]
+        if 'CONTENT' not in data_frame:
             raise ValueError('no field CONTENT in log data frame')
-        return self.data_frame['CONTENT']
+        return data_frame['CONTENT']
 
     def get_level(self) -> str:
+        if self.data_frame is None:
+            raise ValueError('log message has been released, no field LEVEL')
         if 'LEVEL' not in self.data_frame:
             raise ValueError('no field LEVEL in log datat frame')
         return self.data_frame['LEVEL']
@@ -182,6 +446,7 @@ class FeedBack:
     """
     expert feed back, including on-call engineers, GPT
     """
+    __slots__ = ('decision', 'ep', 'tp', 'p', 'reason', 'committer')
 
     def __init__(self, ep: float, tp: float, decision: int = -1, reason='no feedback yet'):
         """
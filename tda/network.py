@@ -0,0 +1,210 @@
+"""
+Network ingestion: an asyncio server accepting newline-delimited log lines over TCP and syslog-style datagrams over UDP.
+
+Received lines wait in a bounded queue, a consumer inserts them in batches into trie from a worker thread (inserting is
+CPU-bound, it must not block the event loop). When the queue is full:
+ - TCP: by default a connection waits until there's room again, its socket isn't read meanwhile, so TCP flow control
+   slows the sender down (backpressure). With drop=True lines are dropped instead.
+ - UDP: datagrams can't be slowed down, lines are always dropped.
+Every connection (TCP) or peer (UDP) has its own counters, see IngestServer.report.
+"""
+import asyncio
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import perf_counter, time
+from typing import Callable, Optional
+
+SYSLOG_PRI = re.compile(r'<\d{1,3}>')  # syslog priority prefix of a datagram, e.g. <134>
+
+
+class ConnectionStats:
+    __slots__ = ('peer', 'protocol', 'connected_at', 'lines', 'bytes', 'dropped', 'closed')
+
+    def __init__(self, peer: str, protocol: str):
+        self.peer = peer
+        self.protocol = protocol
+        self.connected_at = time()
+        self.lines = 0  # received
+        self.bytes = 0
+        self.dropped = 0  # received, but the queue was full
+        self.closed = False
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+class IngestServer:
+    """
+    see the module docstring
+    """
+
+    def __init__(self, ingest: Callable[[list[str]], None], host='0.0.0.0', tcp_port: Optional[int] = 0,
+                 udp_port: Optional[int] = None, queue_size=10000, drop=False, batch_size=500, line_limit=1 << 16):
+        """
+        ingest: inserts a batch of lines into trie, e.g. process_tda.ingest_lines. Called from one worker thread
+        tcp_port, udp_port: None to disable, 0 for any free port (see self.tcp_port and self.udp_port once ready)
+        drop: drop lines of TCP connections when the queue is full, instead of backpressure
+        line_limit: max bytes of a TCP line, longer ones are dropped
+        """
+        self.ingest = ingest
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.queue_size = queue_size
+        self.drop = drop
+        self.batch_size = batch_size
+        self.line_limit = line_limit
+        self.connections: list[ConnectionStats] = []
+        self.ingested = 0
+        self.latencies: deque[float] = deque(maxlen=100000)  # seconds from enqueued to inserted, recent lines
+        self.ready = Event()  # set once listening
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self._udp_peers: dict[str, ConnectionStats] = dict()
+        self._started_at = perf_counter()
+
+    async def serve(self):
+        """
+        serve until stop()
+        """
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.queue_size)
+        self._stopped = asyncio.Event()
+        servers, transport = [], None
+        if self.tcp_port is not None:
+            tcp = await asyncio.start_server(self._handle_tcp, self.host, self.tcp_port, limit=self.line_limit)
+            self.tcp_port = tcp.sockets[0].getsockname()[1]
+            servers.append(tcp)
+        if self.udp_port is not None:
+            transport, _ = await self._loop.create_datagram_endpoint(lambda: _SyslogProtocol(self),
+                                                                     local_addr=(self.host, self.udp_port))
+            self.udp_port = transport.get_extra_info('sockname')[1]
+        with ThreadPoolExecutor(1, thread_name_prefix='Network Ingest') as executor:
+            consumer = asyncio.create_task(self._consume(executor))
+            self._started_at = perf_counter()
+            self.ready.set()
+            await self._stopped.wait()
+            for server in servers:
+                server.close()
+            if transport is not None:
+                transport.close()
+            consumer.cancel()
+
+    def stop(self):
+        """
+        thread-safe, lines still in the queue are discarded
+        """
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def enqueue(self, stats: ConnectionStats, line: str) -> bool:
+        """
+        queue a line without waiting, False if dropped
+        """
+        stats.lines = stats.lines + 1
+        stats.bytes = stats.bytes + len(line)
+        try:
+            self._queue.put_nowait((perf_counter(), line))
+            return True
+        except asyncio.QueueFull:
+            stats.dropped = stats.dropped + 1
+            return False
+
+    async def _handle_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        stats = ConnectionStats(str(writer.get_extra_info('peername')), 'tcp')
+        self.connections.append(stats)
+        try:
+            while True:
+                try:
+                    data = await reader.readline()
+                except ValueError:  # longer than line_limit, the rest of it is discarded
+                    stats.dropped = stats.dropped + 1
+                    continue
+                if not data:
+                    break
+                line = data.decode('utf-8', errors='replace').rstrip('\r\n')
+                if self.drop or not self._queue.full():
+                    self.enqueue(stats, line)
+                    continue
+                stats.lines = stats.lines + 1
+                stats.bytes = stats.bytes + len(line)
+                await self._queue.put((perf_counter(), line))  # backpressure: this socket isn't read meanwhile
+        except ConnectionError:
+            pass
+        finally:
+            stats.closed = True
+            writer.close()
+
+    def datagram_stats(self, peer: str) -> ConnectionStats:
+        stats = self._udp_peers.get(peer)
+        if stats is None:
+            stats = self._udp_peers[peer] = ConnectionStats(peer, 'udp')
+            self.connections.append(stats)
+        return stats
+
+    async def _consume(self, executor: ThreadPoolExecutor):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._loop.run_in_executor(executor, self._ingest, batch)
+
+    def _ingest(self, batch: list[tuple[float, str]]):
+        self.ingest([line for _, line in batch])
+        inserted = perf_counter()
+        self.latencies.extend(inserted - enqueued for enqueued, _ in batch)
+        self.ingested = self.ingested + len(batch)
+
+    def report(self) -> dict:
+        """
+        lines/sec since serving, queue latency percentiles in milliseconds and counters of every connection
+        """
+        latencies = sorted(self.latencies)
+        elapsed = perf_counter() - self._started_at
+        return {
+            'ingested': self.ingested,
+            'dropped': sum(stats.dropped for stats in self.connections),
+            'queued': self._queue.qsize() if self._queue else 0,
+            'lines_per_sec': self.ingested / elapsed if elapsed else 0.0,
+            'latency_ms': {f'p{p}': percentile(latencies, p) * 1000 for p in (50, 95, 99)},
+            'connections': [stats.to_dict() for stats in self.connections],
+        }
+
+
+class _SyslogProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: IngestServer):
+        self.server = server
+
+    def datagram_received(self, data: bytes, addr):
+        stats = self.server.datagram_stats(f'{addr[0]}:{addr[1]}')
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            m = SYSLOG_PRI.match(line)
+            self.server.enqueue(stats, line[m.end():] if m else line)
+
+
+async def generate_load(host: str, port: int, lines: list[str], connections=4, repeat=1) -> float:
+    """
+    local load generator: send lines repeat times over each of connections TCP connections, as fast as the server reads
+    them. returns lines/sec sent
+    """
+    payload = ''.join(line.rstrip('\n') + '\n' for line in lines).encode()
+
+    async def send():
+        _, writer = await asyncio.open_connection(host, port)
+        for _ in range(repeat):
+            writer.write(payload)
+            await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    start = perf_counter()
+    await asyncio.gather(*(send() for _ in range(connections)))
+    return len(lines) * repeat * connections / (perf_counter() - start)
@@ -1,24 +1,48 @@
+import asyncio
+import os
 import re
+from queue import Empty, Queue
 from threading import Thread
-from time import sleep
-from typing import Optional
+from time import perf_counter, sleep
+from typing import Iterable, Optional, Union
 
 from anomaly_detection import detect_cdf
-from config import file_path, log_pattern_re, log_metadata
-from exceptions import LogError
-from log_structure import LogMessage
+from bulk import parse_file
+from checkpoint import load_checkpoint, save_checkpoint
+from config import file_path, log_pattern_re, log_metadata, nlp_batch_size, nlp_n_process, trie_batch_size, merge_interval
+from config import snapshot_interval, n_shards, follow, offsets_path, bulk_n_process, bulk_chunk_size
+from config import tcp_port, udp_port, ingest_queue_size, ingest_drop, checkpoint_path, checkpoint_interval
+from config import log_messages_capacity
+from log_structure import LogMessage, LogCluster, parse_lines
+from network import IngestServer
 from server_apis import render_pyecharts_tree
-from trie import Trie, sampling
-from utils import LogClusterCache
+from sharding import ShardedTrie
+from sources import LogSource
+from trie import Trie, frequent_tokens, sampling
+from utils import LogClusterCache, RingBuffer
 
-root: Optional[Trie] = None
+root: Optional[Union[Trie, ShardedTrie]] = None
 lcCache = LogClusterCache(200)  # lru cache of log clusters
-logMessages = []
+logMessages: RingBuffer[LogMessage] = RingBuffer(log_messages_capacity)  # most recent log messages, for Django API
+pendingMerges: Queue = Queue(maxsize=1)  # merge plans from merge_worker, applied by the thread inserting log messages
+lastPublished = 0.0  # perf_counter() of the last snapshot published by the inserting thread
 
 
 def reconstruct():
-    root.reconstruct()
-    render_pyecharts_tree("tree-reconstructed.html", root, 'TDA reconstructed')
+    with root.write_lock:
+        root.reconstruct()
+    publish()
+    render_pyecharts_tree("tree-reconstructed.html", root.snapshot, 'TDA reconstructed')
+
+
+def publish():
+    """
+    publish a snapshot of trie for readers (detection and Django APIs), with log clusters of lcCache as recently used ones
+    """
+    global lastPublished
+    with root.write_lock:
+        root.publish(lcCache.to_list())
+        lastPublished = perf_counter()
 
 
 def detect_worker():
@@ -27,49 +51,164 @@ def detect_worker():
         sleep(5)
         print(f'==============start detection (batch {batch})==============')
         batch = batch + 1
-        # start detection
-        detect_cdf(lcCache.to_list())
+        # start detection, on a snapshot: never blocks inserting
+        detect_cdf(list(root.snapshot.recent))
+        publish()  # feedback, also when there's nothing to insert anymore
+
+
+def checkpoint_worker():
+    while True:
+        sleep(checkpoint_interval)
+        size = save_checkpoint(root, checkpoint_path, lcCache.to_list())
+        print(f'checkpoint written to {checkpoint_path}, {size} bytes')
+
+
+def merge_worker():
+    while True:
+        sleep(merge_interval)
+        pendingMerges.put(root.plan_merges())  # blocks until the former plan is applied
+
+
+def apply_pending_merges():
+    """
+    swap a merge plan of merge_worker into trie, between two inserts
+    """
+    try:
+        pairs = pendingMerges.get_nowait()
+    except Empty:
+        return
+    for log_cluster, general in root.apply_merges(pairs):
+        lcCache.discard(log_cluster)
+
+
+def insert_log_message(log_message: LogMessage):
+    """
+    insert a parsed log message into trie, then update its log cluster and caches
+    """
+    with root.write_lock:
+        trie_node, log_cluster, match_type = root.insert_cached(log_message)
+        inserted(log_message, log_cluster)
+        maintain()
+        apply_pending_merges()
+    if perf_counter() - lastPublished >= snapshot_interval:
+        publish()
+
+
+def insert_log_messages(log_messages: list[LogMessage]):
+    """
+    batched insert_log_message, see Trie.insert_batch. Eviction and re-ranking run once after the whole batch: results of
+    the batch refer to log clusters as they were after inserting it
+    """
+    with root.write_lock:
+        for log_message, (trie_node, log_cluster, match_type) in zip(log_messages, root.insert_batch(log_messages)):
+            inserted(log_message, log_cluster)
+        maintain()
+        apply_pending_merges()
+    if perf_counter() - lastPublished >= snapshot_interval:
+        publish()
+
+
+def inserted(log_message: LogMessage, log_cluster: LogCluster):
+    """
+    bookkeeping after a log message has been inserted into trie and its log cluster
+    """
+    log_message.parent = log_cluster  # refer to its parent(type: LogCluster)
+
+    if log_cluster.feedback.decision != -1:
+        # todo already has feedback
+        pass
+
+    # LRU, add the most frequently used log templates into LRU. only those templates are used in detect().
+    #  Moreover, there may need another thread to process this detect simultaneously.
+    lcCache.insert(log_cluster)
+
+    logMessages.append(log_message)  # only the most recent ones are kept, see log_messages_capacity
+    log_message.release()  # only origin line and log cluster are read from now on
+
+
+def maintain():
+    """
+    evict over the limits of trie and re-rank most frequent tokens when due, after inserted() of one or a batch of log
+    messages. Should be called with root.write_lock held
+    """
+    # bounded trie, see max_clusters and max_trie_nodes in config.py
+    for evicted in root.evict_over_limits():
+        lcCache.discard(evicted)
+    # re-ranking epoch of most frequent tokens, see rerank_interval in config.py
+    if frequent_tokens.rerank_due():
+        root.rerank()
+
+
+def ingest_lines(pattern: re.Pattern, lines: Iterable[str]):
+    """
+    parse lines and insert them into trie, in input order
+    """
+    # with nlp_batch_size > 0, lines are tagged in chunks. one by one, log messages are tokenized only if they miss the
+    # hot line cache (see Trie.insert_cached)
+    lazy = trie_batch_size <= 0 and nlp_batch_size <= 0
+    ingest(parse_lines(pattern, lines, nlp_batch_size, nlp_n_process, lazy))
+
+
+def ingest(log_messages: Iterable[LogMessage]):
+    """
+    insert parsed log messages into trie, in input order
+    """
+    # with trie_batch_size > 0, log messages are inserted in batches. The result equals inserting them one by one
+    batch = []
+    for log_message in log_messages:
+        if trie_batch_size <= 0:
+            insert_log_message(log_message)
+            continue
+        batch.append(log_message)
+        if len(batch) >= trie_batch_size:
+            insert_log_messages(batch)
+            batch = []
+    if batch:
+        insert_log_messages(batch)
 
 
 def process():
     global root
-    root = Trie(log_metadata, None, 'root')
-
     pattern = re.compile(log_pattern_re)
-    sampling(pattern, file_path)
+    source = LogSource(file_path, follow, offsets_path)
+    sample_path = (source.paths() or [file_path])[0]  # oldest matching file
+    if n_shards > 0:  # workers sample and merge their own sub-tries, see sharding.py
+        root = ShardedTrie(n_shards, log_pattern_re, sample_path, log_messages=logMessages)
+    elif checkpoint_path and os.path.exists(checkpoint_path):  # warm restart, no sampling
+        root, recent = load_checkpoint(checkpoint_path)
+        for log_cluster in recent:
+            lcCache.insert(log_cluster)
+    else:
+        root = Trie(log_metadata, None, 'root')
+        sampling(pattern, sample_path)
 
     # thread for detection
     thr = Thread(target=detect_worker, name='Anomaly Detection Thread')
     thr.start()
-
-    # main thread, read logs
-    with open(file_path) as f:
-        for line in f:
-            # sleep(0.5)
-            # print(f'==============one line coming...==============\t\t{line}')
-
-            try:
-                log_message = LogMessage(pattern, line)
-            except (LogError, ValueError) as e:
-                print(e)
-                continue
-
-            trie_node, log_cluster, match_type = root.insert(log_message)
-            log_cluster.insert_and_update_template(log_message, match_type)
-            log_message.parent = log_cluster  # refer to its parent(type: LogCluster)
-
-            if log_cluster.feedback.decision != -1:
-                # todo already has feedback
-                pass
-
-            # LRU, add the most frequently used log templates into LRU. only those templates are used in detect().
-            #  Moreover, there may need another thread to process this detect simultaneously.
-            lcCache.insert(log_cluster)
-
-            # TODO: there may be a fixed size list for logMessages, for this object are only used in Django server API, only part of log messages are been shown
-            logMessages.append(log_message)  # all log messages
-
-    data = render_pyecharts_tree("tree_top_bottom.html", root)
+    if merge_interval > 0 and n_shards <= 0:
+        Thread(target=merge_worker, name='Template Merge Thread').start()
+    if checkpoint_path and checkpoint_interval > 0 and n_shards <= 0:
+        Thread(target=checkpoint_worker, name='Checkpoint Thread', daemon=True).start()
+
+    # main thread, read logs. Never ends in follow mode nor when serving the network
+    if tcp_port is not None or udp_port is not None:
+        ingest_batch = root.insert_lines if n_shards > 0 else lambda lines: ingest_lines(pattern, lines)
+        asyncio.run(IngestServer(ingest_batch, tcp_port=tcp_port, udp_port=udp_port, queue_size=ingest_queue_size,
+                                 drop=ingest_drop).serve())
+    elif n_shards > 0:
+        root.insert_lines(source)
+    elif bulk_n_process > 0 and not follow:  # offline backfill, offsets aren't recorded
+        for path in source.paths():
+            ingest(parse_file(path, log_pattern_re, bulk_n_process, bulk_chunk_size))
+    else:
+        ingest_lines(pattern, source)
+    if n_shards > 0:
+        root.close()
+    elif checkpoint_path:
+        save_checkpoint(root, checkpoint_path, lcCache.to_list())
+
+    publish()
+    data = render_pyecharts_tree("tree_top_bottom.html", root.snapshot)
     with open('structure.json', 'w') as f:
         f.write(str(data))
 
@@ -3,14 +3,18 @@ APIs exposed to Django server.
 generate json structure for rendering;
 data from expert feedbacks;
 """
+import json
 from datetime import datetime
+from uuid import uuid4
 
-from trie import Trie
-from pyecharts.charts import Tree
-from pyecharts import options as opts
+from snapshot import NodeSnapshot, TrieSnapshot
 
+RENDER_TYPES = ('graph', 'tree')
+RUN_ID = uuid4().hex[:8]  # versions restart from 0 with the process, ETags of a former run must not match
+_rendered: dict[str, tuple[int, str]] = dict()  # render_type -> (TrieSnapshot.modified, json of render_echarts_api)
 
-def gen_trie_graph(root: Trie, name: str, total_id: int, data: dict):
+
+def gen_trie_graph(root: NodeSnapshot, name: str, total_id: int, data: dict):
     """
     generate a trie json structure for the use of scaleAD-ui, vue lib echarts(type: "graph")
     return: cur_id, current node id; total_id: total number of id that has been used.
@@ -27,21 +31,21 @@ def gen_trie_graph(root: Trie, name: str, total_id: int, data: dict):
     data['nodes'].append({'id': cur_id, 'name': name, 'symbolSize': 20, 'category': 0})
     if root.isEnd:
         log_cluster_id = cur_id + 1
-        for log_cluster in root.logClusters:
+        for log_cluster in root.clusters:
             data['nodes'].append({'id': log_cluster_id, 'name': f'log_cluster({log_cluster.template})',
-                                  'value': len(log_cluster.logMessagesCache), 'symbolSize': 10, 'category': 1})
+                                  'value': len(log_cluster.log_messages), 'symbolSize': 10, 'category': 1})
             data['links'].append({'source': cur_id, 'target': log_cluster_id})
             log_cluster_id = log_cluster_id + 1
         return cur_id, log_cluster_id - 1
 
     total_id = cur_id
-    for name, child in root.children.items():
-        child_id, total_id = gen_trie_graph(child, name, total_id, data)
+    for child in root.children:
+        child_id, total_id = gen_trie_graph(child, child.name, total_id, data)
         data['links'].append({'source': cur_id, 'target': child_id})
     return cur_id, total_id
 
 
-def gen_trie_tree(root: Trie, name: str, debug=False):
+def gen_trie_tree(root: NodeSnapshot, name: str, debug=False):
     """
     visualize trie data structure for pyecharts type "tree".
     if debug==True, each leaf node will list all log messages under the log cluster,
@@ -53,28 +57,31 @@ def gen_trie_tree(root: Trie, name: str, debug=False):
         t = dict()
         t['name'] = root.name
         t['children'] = []
-        for log_cluster in root.logClusters:
+        for log_cluster in root.clusters:
             if debug:  # just for debug: see json structure details(structure.json) intuitively
-                items = [item.get_content() for item in log_cluster.logMessagesCache.to_list()]
+                items = log_cluster.get_log_messages()
                 t['children'] = [{'name': f'Cluster Name: {log_cluster.template}\n\tMetadata: {log_cluster.metadata}',
                                   'value': items}]
             else:
                 t['children'] = [{'name': f'{log_cluster.template}',
-                                  'value': len(log_cluster.logMessagesCache)}]
+                                  'value': len(log_cluster.log_messages)}]
         return t
     data = dict()
     data['name'] = name
     data['children'] = list()
-    for name, child in root.children.items():
-        data['children'].append(gen_trie_tree(child, name, debug))
+    for child in root.children:
+        data['children'].append(gen_trie_tree(child, child.name, debug))
     return data
 
 
-def render_pyecharts_tree(file_name: str, root: Trie, tree_name='TDA display'):
+def render_pyecharts_tree(file_name: str, snapshot: TrieSnapshot, tree_name='TDA display'):
     """
     render a tree display, based on pyecharts
     """
-    data = gen_trie_tree(root, tree_name, debug=True)
+    from pyecharts.charts import Tree
+    from pyecharts import options as opts
+
+    data = gen_trie_tree(snapshot.root, tree_name, debug=True)
     tree = (
         Tree()
         .add(
@@ -99,9 +106,10 @@ def render_pyecharts_tree(file_name: str, root: Trie, tree_name='TDA display'):
 
 # APIs below:
 
-def render_echarts_api(root: Trie, render_type='graph'):
+def render_echarts_api(snapshot: TrieSnapshot, render_type='graph'):
     """
     api exposed to Django server to render trie tree or graph
+    snapshot: root.snapshot, the last published snapshot of trie
     render_type: graph or tree
     """
     assert render_type == 'graph' or 'tree'
@@ -109,25 +117,73 @@ def render_echarts_api(root: Trie, render_type='graph'):
 
     if render_type == 'graph':
         data = {'nodes': list(), 'links': list(), 'categories': [{'name': 'Internal Nodes'}, {'name': 'Leaf Nodes'}]}
-        gen_trie_graph(root, 'root', -1, data)
+        gen_trie_graph(snapshot.root, 'root', -1, data)
     elif render_type == 'tree':
-        data = gen_trie_tree(root, 'Trie display', debug=False)
+        data = gen_trie_tree(snapshot.root, 'Trie display', debug=False)
     return data
 
 
-def expert_feedback_api(root: Trie):
+def trie_etag(snapshot: TrieSnapshot, kind: str) -> str:
+    return f'"{RUN_ID}-{kind}-{snapshot.modified}"'
+
+
+def render_echarts_json(snapshot: TrieSnapshot, render_type='graph') -> tuple[str, str]:
+    """
+    json of render_echarts_api and its ETag. Cached per render_type, rendered again only once trie changed
+    """
+    if render_type not in RENDER_TYPES:
+        return json.dumps(render_echarts_api(snapshot, render_type)), trie_etag(snapshot, str(render_type))
+    modified, data = _rendered.get(render_type, (-1, ''))
+    if modified != snapshot.modified:  # readers racing here render the same json, the last one is kept
+        modified, data = snapshot.modified, json.dumps(render_echarts_api(snapshot, render_type))
+        _rendered[render_type] = (modified, data)
+    return data, trie_etag(snapshot, render_type)
+
+
+def trie_diff_api(snapshot: TrieSnapshot, since: int) -> dict:
+    """
+    trie nodes and log clusters changed since version since (a former 'version' of this api), all of them if 0.
+    A listed node replaces the client's one: its children not listed in 'children' were removed. A log cluster is
+    listed along with its node, log clusters no longer in any node were removed. Node paths are names from root.
+    json format:
+    {
+        "version": 12, "since": 10,
+        "nodes": [{"path": [], "node_type": "root", "isEnd": false, "children": ["INFO"], "clusters": []}],
+        "clusters": [{"id": 0, "template": "...", "value": 42, "decision": -1}]
+    }
+    """
+    if since > snapshot.modified:  # a version of a former run
+        since = 0
+    nodes, clusters, stack = [], [], [([], snapshot.root)]
+    while stack:
+        path, node = stack.pop()
+        if node.version <= since:  # unchanged subtree
+            continue
+        nodes.append({'path': path, 'node_type': node.node_type, 'isEnd': node.isEnd,
+                      'children': [child.name for child in node.children],
+                      'clusters': [log_cluster.cluster_id for log_cluster in node.clusters]})
+        for log_cluster in node.clusters:
+            clusters.append({'id': log_cluster.cluster_id, 'template': log_cluster.template,
+                             'value': len(log_cluster.log_messages), 'decision': log_cluster.feedback.decision})
+        stack.extend((path + [child.name], child) for child in reversed(node.children))
+    return {'version': snapshot.modified, 'since': since, 'nodes': nodes, 'clusters': clusters}
+
+
+def expert_feedback_api(snapshot: TrieSnapshot):
     data = []
-    for log_cluster in root.search_clusters_recurse():
-        if log_cluster.feedback is None:
+    for log_cluster in snapshot.clusters:
+        feedback = log_cluster.feedback
+        if feedback is None:
             continue
         data.append({
+            'id': log_cluster.cluster_id,
             'log_template': log_cluster.template,
-            'level': log_cluster.feedback.decision,
-            'ep': log_cluster.feedback.ep,
-            'tp': log_cluster.feedback.tp,
+            'level': feedback.decision,
+            'ep': feedback.ep,
+            'tp': feedback.tp,
             'logs': log_cluster.get_log_messages(),
-            'desc': log_cluster.feedback.reason,
-            'committer': log_cluster.feedback.committer
+            'desc': feedback.reason,
+            'committer': feedback.committer
         })
     return data  # for debug
 
@@ -0,0 +1,371 @@
+"""
+Sharded ingestion: a reader (this process) routes log lines by LEVEL, the first trie level, to worker processes. Each
+worker owns a sub-trie of the lines routed to it and runs the usual single process ingestion on it (see
+process_tda.ingest_lines).
+
+A LEVEL holding more than a shard's share of the sampled lines (e.g. INFO, 80% of BGL) is hot: it is split among workers
+by its routing word, the first word of the digit-masked CONTENT. It stands for the prefix key of the second trie level,
+which the reader can't compute without tokenizing. Log messages of a template share their routing word unless the
+template starts with a wildcard, so log clusters rarely span two shards.
+
+ShardedTrie stands in for the root Trie in the reader process: workers send their published snapshots, and their merge
+is served as ShardedTrie.snapshot to detection and the Django APIs: sub-tries of a hot LEVEL are merged under one LEVEL
+node, nodes of the same name in several sub-tries are merged recursively. Feedback set on a merged cluster snapshot is
+sent to the worker owning the log cluster. With a snapshot, a worker sends the log messages inserted since its last one,
+as (line, cluster id) only: the reader keeps them as ShardMessage for the Django API of recent log messages.
+
+Log clusters of shards are not comparable one to one with a single process run: every shard re-ranks most frequent
+tokens by its own log messages, so a template may end up in more (or fewer) leaf nodes, i.e. log clusters. Templates
+only differ by a few ones starting with a wildcard, whose log messages may be routed to several shards and generalized
+separately, see unit_tests#test_sharded_throughput.
+
+The reader only matches the log pattern to find LEVEL and routing word, tokenization and inserting are done by workers.
+LEVELs and routing words of hot LEVELs are assigned to workers by their share in the sampled lines, routing words not
+sampled by a stable hash. Speedup is bounded by the share of the most frequent routing word, e.g. 'generating' is 36% of
+BGL_2k.
+"""
+import re
+import zlib
+from array import array
+from multiprocessing import Process, Queue
+from queue import Empty
+from threading import RLock, Thread
+from typing import Hashable, Iterable, Optional
+
+from config import log_metadata, merge_interval, shard_batch_size
+from exceptions import LogError
+from log_structure import FeedBack, mask_content
+from snapshot import EMPTY_SNAPSHOT, ClusterSnapshot, NodeSnapshot, TrieSnapshot
+from trie import Trie, sampling
+from utils import RingBuffer
+
+# commands sent to shard workers
+LINES = 'lines'
+FEEDBACK = 'feedback'
+PUBLISH = 'publish'
+RECONSTRUCT = 'reconstruct'
+STOP = 'stop'
+
+
+class MessageSnapshot:
+    """
+    a log message in a snapshot sent by a shard worker, only line and CONTENT are kept
+    """
+    __slots__ = ('line', 'content')
+
+    def __init__(self, line: str, content: str):
+        self.line = line
+        self.content = content
+
+    def get_content(self) -> str:
+        return self.content
+
+
+# parent of a ShardMessage whose log cluster left the trie of its shard, e.g. evicted, before being published
+UNKNOWN_CLUSTER = ClusterSnapshot(None, None, '', 0, None, FeedBack(decision=-1, ep=-1, tp=-1), dict(), (), array('i'),
+                                  dict())
+
+
+class ShardMessage:
+    """
+    a log message inserted by a shard worker, kept by the reader, see ShardedTrie.log_messages. Only line and the id of
+    its log cluster are kept, parent is its cluster snapshot in the last merged snapshot
+    """
+    __slots__ = ('line', 'cluster_id', '_trie')
+
+    def __init__(self, line: str, cluster_id: int, trie: 'ShardedTrie'):
+        self.line = line
+        self.cluster_id = cluster_id  # in the merged snapshot
+        self._trie = trie
+
+    @property
+    def parent(self) -> ClusterSnapshot:
+        return self._trie.cluster(self.cluster_id) or UNKNOWN_CLUSTER
+
+
+class ShardCluster:
+    """
+    stands in for the live log cluster of a merged cluster snapshot, writes are sent to the worker owning it
+    """
+    __slots__ = ('commands', 'cluster_id')
+
+    def __init__(self, commands: Queue, cluster_id: int):
+        self.commands = commands
+        self.cluster_id = cluster_id  # id in the sub-trie of the worker
+
+    def set_feedback(self, feedback: FeedBack):
+        self.commands.put((FEEDBACK, (self.cluster_id, feedback)))
+
+
+def plan_shards(counts: dict[Hashable, int], n_shards: int) -> dict[Hashable, int]:
+    """
+    assign routing keys (LEVELs, or (LEVEL, routing word) of hot LEVELs) to shards, most frequent first to the least
+    loaded shard
+    """
+    loads, shards = [0] * n_shards, dict()
+    for key, count in sorted(counts.items(), key=lambda item: -item[1]):
+        shard = loads.index(min(loads))
+        shards[key] = shard
+        loads[shard] = loads[shard] + count
+    return shards
+
+
+def routing_word(content: str) -> str:
+    """
+    first word of the digit-masked CONTENT, routes log messages of a hot LEVEL
+    """
+    words = mask_content(content).split(maxsplit=1)
+    return words[0] if words else ''
+
+
+def merge_nodes(nodes: list[NodeSnapshot]) -> NodeSnapshot:
+    """
+    one node snapshot of nodes of the same name from several sub-tries, their children of the same name merged too
+    """
+    if len(nodes) == 1:
+        return nodes[0]
+    children: dict[str, list[NodeSnapshot]] = dict()
+    for node in nodes:
+        for child in node.children:
+            children.setdefault(child.name, []).append(child)
+    return NodeSnapshot(nodes[0].name, nodes[0].node_type, nodes[0].isEnd,
+                        tuple(merge_nodes(group) for group in children.values()),
+                        tuple(c for node in nodes for c in node.clusters), max(node.version for node in nodes))
+
+
+def portable(snapshot: TrieSnapshot) -> TrieSnapshot:
+    """
+    copy of a snapshot that can be sent to another process: no live log clusters nor log messages
+    """
+    clusters = dict()
+
+    def copy_cluster(c: ClusterSnapshot) -> ClusterSnapshot:
+        if id(c) not in clusters:
+            log_messages = tuple(MessageSnapshot(m.line, m.get_content()) for m in c.log_messages)
+            clusters[id(c)] = c._replace(cluster=None, log_messages=log_messages)
+        return clusters[id(c)]
+
+    def copy_node(node: NodeSnapshot) -> NodeSnapshot:
+        return node._replace(children=tuple(copy_node(child) for child in node.children),
+                             clusters=tuple(copy_cluster(c) for c in node.clusters))
+
+    return TrieSnapshot(snapshot.version, copy_node(snapshot.root), tuple(copy_cluster(c) for c in snapshot.clusters),
+                        tuple(copy_cluster(c) for c in snapshot.recent))
+
+
+def shard_worker(shard: int, pattern_re: str, file_path: Optional[str], commands: Queue, results: Queue):
+    """
+    worker process owning a sub-trie, runs commands from the reader until STOP. Snapshots are sent as (shard, snapshot,
+    log messages inserted since the last snapshot as (line, cluster id)), then (shard, None, None) when stopped
+    """
+    import process_tda  # process_tda uses this module
+
+    pattern = re.compile(pattern_re)
+    root = process_tda.root = Trie(log_metadata, None, 'root')
+    if file_path:
+        sampling(pattern, file_path)  # same warm up as the other workers and a single process run
+    if merge_interval > 0:
+        Thread(target=process_tda.merge_worker, name='Template Merge Thread', daemon=True).start()
+
+    sent, cursor = root.snapshot.version, process_tda.logMessages.next_seq  # cursor: next log message to send
+    while True:
+        command, payload = commands.get()
+        if command == LINES:
+            process_tda.ingest_lines(pattern, payload)
+        elif command == FEEDBACK:
+            cluster_id, feedback = payload
+            log_cluster = root.clusters.get(cluster_id)
+            if log_cluster is not None:
+                log_cluster.set_feedback(feedback)
+        elif command == RECONSTRUCT:
+            with root.write_lock:
+                root.reconstruct()
+            process_tda.publish()
+        else:  # PUBLISH, STOP
+            process_tda.publish()
+        if root.snapshot.version != sent:
+            sent = root.snapshot.version
+            log_messages, cursor = process_tda.logMessages.page(cursor, process_tda.logMessages.capacity)
+            results.put((shard, portable(root.snapshot), [(m.line, m.parent.cluster_id) for _, m in log_messages]))
+        if command == STOP:
+            results.put((shard, None, None))
+            return
+
+
+class ShardedTrie:
+    """
+    root of a trie whose first level nodes are owned by worker processes, see the module docstring.
+    """
+
+    def __init__(self, n_shards: int, pattern_re: str, file_path: Optional[str] = None, batch_size=shard_batch_size,
+                 log_messages: Optional[RingBuffer] = None):
+        """
+        file_path: lines for warming up most frequent tokens and for planning shards, see sampling
+        log_messages: log messages inserted by workers are appended to it as ShardMessage, e.g. process_tda.logMessages
+        """
+        self.pattern = re.compile(pattern_re)
+        self.batch_size = batch_size
+        self.log_messages = log_messages
+        self.write_lock = RLock()  # guards the merged snapshot
+        self.snapshot: TrieSnapshot = EMPTY_SNAPSHOT
+        self._clusters: dict[int, ClusterSnapshot] = dict()  # cluster id -> cluster snapshot, of self.snapshot
+        self.shards: dict[str, int] = dict()  # LEVEL -> shard, of LEVELs that aren't hot
+        self.sub_shards: dict[str, dict[str, int]] = dict()  # hot LEVEL -> sampled routing word -> shard
+        self.loads = [0] * n_shards  # lines sent to each shard
+        self._snapshots: list[TrieSnapshot] = [EMPTY_SNAPSHOT] * n_shards  # last snapshot of each shard
+        # by shard: version of a node in shard snapshots -> version of the merged snapshot it was first merged into
+        self._versions: list[dict[int, int]] = [dict() for _ in range(n_shards)]
+        self._error: Optional[str] = None
+        if file_path:
+            self._plan(file_path, n_shards)
+
+        self._commands = [Queue() for _ in range(n_shards)]
+        self._results = Queue()
+        self._workers = [Process(target=shard_worker, args=(shard, pattern_re, file_path, commands, self._results),
+                                 name=f'TDA Shard {shard}')
+                         for shard, commands in enumerate(self._commands)]
+        for worker in self._workers:
+            worker.start()
+        self._collector = Thread(target=self._collect, name='Shard Snapshot Thread', daemon=True)
+        self._collector.start()
+
+    def _plan(self, file_path: str, n_shards: int, bath_size=1000):
+        level_counts, word_counts = dict(), dict()
+        with open(file_path) as f:
+            for line, _ in zip(f, range(bath_size)):
+                m = self.pattern.match(line)
+                if m:
+                    level, word = m['LEVEL'], routing_word(m['CONTENT'])
+                    level_counts[level] = level_counts.get(level, 0) + 1
+                    word_counts[level, word] = word_counts.get((level, word), 0) + 1
+        total = sum(level_counts.values())
+        hot = {level for level, count in level_counts.items() if n_shards > 1 and count * n_shards > total}
+        counts = {level: count for level, count in level_counts.items() if level not in hot}
+        counts.update((key, count) for key, count in word_counts.items() if key[0] in hot)
+        for key, shard in plan_shards(counts, n_shards).items():
+            if isinstance(key, tuple):
+                self.sub_shards.setdefault(key[0], dict())[key[1]] = shard
+            else:
+                self.shards[key] = shard
+
+    def shard_of(self, level: str, content: str) -> int:
+        words = self.sub_shards.get(level)
+        if words is not None:
+            word = routing_word(content)
+            shard = words.get(word)
+            return shard if shard is not None else zlib.crc32(word.encode()) % len(self.loads)
+        shard = self.shards.get(level)
+        if shard is None:  # not sampled, to the least loaded shard
+            shard = self.shards[level] = self.loads.index(min(self.loads))
+        return shard
+
+    def insert_lines(self, lines: Iterable[str]):
+        """
+        route lines to shard workers in batches. Lines of a shard are inserted in input order
+        """
+        batches = [[] for _ in self._commands]
+        for line in lines:
+            m = self.pattern.match(line)
+            if not m:
+                print(LogError(line, str(self.pattern)))
+                continue
+            shard = self.shard_of(m['LEVEL'], m['CONTENT'])
+            self.loads[shard] = self.loads[shard] + 1
+            batch = batches[shard]
+            batch.append(line)
+            if len(batch) >= self.batch_size:
+                self._commands[shard].put((LINES, batch))
+                batches[shard] = []
+        for shard, batch in enumerate(batches):
+            if batch:
+                self._commands[shard].put((LINES, batch))
+
+    def _broadcast(self, command: str):
+        for commands in self._commands:
+            commands.put((command, None))
+
+    def publish(self, recent: Iterable = ()) -> TrieSnapshot:
+        """
+        ask workers to publish, their snapshots are merged into self.snapshot as they arrive.
+        recent: ignored, every worker keeps its own recently used log clusters
+        """
+        self._broadcast(PUBLISH)
+        return self.snapshot
+
+    def reconstruct(self):
+        self._broadcast(RECONSTRUCT)
+
+    def cluster(self, cluster_id: int) -> Optional[ClusterSnapshot]:
+        """
+        cluster snapshot of cluster_id in the merged snapshot, None if not there (yet or any more)
+        """
+        return self._clusters.get(cluster_id)
+
+    def close(self):
+        """
+        insert the lines routed so far, then stop workers. self.snapshot is final afterwards
+        """
+        self._broadcast(STOP)
+        self._collector.join()
+        for worker in self._workers:
+            worker.join()
+        if self._error:
+            raise RuntimeError(self._error)
+
+    def _collect(self):
+        running = set(range(len(self._workers)))
+        while running:
+            try:
+                shard, snapshot, log_messages = self._results.get(timeout=1)
+            except Empty:
+                dead = [shard for shard in running if self._workers[shard].exitcode is not None]
+                if dead:
+                    self._error = f'shard workers {dead} exited unexpectedly'
+                    return
+                continue
+            if snapshot is None:
+                running.discard(shard)
+                continue
+            self._merge(shard, snapshot)
+            if self.log_messages is not None:
+                n_shards = len(self._workers)
+                for line, cluster_id in log_messages:
+                    self.log_messages.append(ShardMessage(line, cluster_id * n_shards + shard, self))
+
+    def _merge(self, shard: int, snapshot: TrieSnapshot):
+        """
+        merge the last snapshots of all shards. Cluster ids are made unique as (id in shard) * n_shards + shard, node
+        versions are made versions of merged snapshots
+        """
+        n_shards, commands = len(self._workers), self._commands[shard]
+        version = self.snapshot.version + 1  # only the collector thread merges
+        versions, merged_versions = self._versions[shard], dict()
+        versions.setdefault(snapshot.version, version)
+        clusters = dict()
+
+        def adopt_cluster(c: ClusterSnapshot) -> ClusterSnapshot:
+            if id(c) not in clusters:
+                clusters[id(c)] = c._replace(cluster=ShardCluster(commands, c.cluster_id),
+                                             cluster_id=c.cluster_id * n_shards + shard)
+            return clusters[id(c)]
+
+        def adopt_node(node: NodeSnapshot) -> NodeSnapshot:
+            merged_versions[node.version] = versions.get(node.version, version)
+            return node._replace(children=tuple(adopt_node(child) for child in node.children),
+                                 clusters=tuple(adopt_cluster(c) for c in node.clusters),
+                                 version=merged_versions[node.version])
+
+        root = adopt_node(snapshot.root)
+        self._versions[shard] = merged_versions  # versions of nodes gone from the shard are forgotten
+        with self.write_lock:
+            self._snapshots[shard] = TrieSnapshot(snapshot.version, root,
+                                                  tuple(adopt_cluster(c) for c in snapshot.clusters),
+                                                  tuple(adopt_cluster(c) for c in snapshot.recent))
+            snapshots = self._snapshots
+            children = merge_nodes([s.root for s in snapshots]).children
+            modified = max(s.root.version for s in snapshots)
+            by_id = {c.cluster_id: c for s in snapshots for c in s.clusters}
+            self.snapshot = TrieSnapshot(version, NodeSnapshot(root.name, 'root', False, children, (), modified),
+                                         tuple(by_id[cluster_id] for cluster_id in sorted(by_id)),
+                                         tuple(c for s in snapshots for c in s.recent))
+            self._clusters = by_id
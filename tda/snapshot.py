@@ -0,0 +1,68 @@
+"""
+Immutable snapshots of a trie, for threads reading it while log messages are inserted (anomaly detection, Django APIs).
+
+Concurrency model:
+ - writers hold the root's write_lock: inserting log messages (and the eviction, merge and re-ranking done between
+   inserts), replacing expert feedback (LogCluster.set_feedback) and publishing snapshots. The lock is held per log
+   message, so a writer from another thread waits at most one insert.
+ - readers never lock and never touch live trie nodes: they read root.snapshot, the last published TrieSnapshot, which
+   is never changed afterwards. A template and the log messages of a cluster snapshot are always from the same moment.
+ - the background merge planner (Trie.plan_merges) is the one exception reading live log clusters without the lock,
+   its plan is re-validated under the lock by Trie.apply_merges.
+ - Trie.publish copies only subtrees changed since the last publish (see Trie.changed), unchanged subtrees are shared
+   with the former snapshot. A node snapshot keeps the version of the publish that copied it, so the subtrees changed
+   since a version are the ones of a greater version, and TrieSnapshot.modified only changes with trie.
+"""
+from array import array
+from typing import NamedTuple, Optional
+
+from log_structure import FeedBack, LogCluster, LogMessage
+
+
+class ClusterSnapshot(NamedTuple):
+    cluster: LogCluster  # live log cluster, only to address writes, e.g. LogCluster.set_feedback. Don't read it
+    cluster_id: Optional[int]
+    template: str
+    version: int
+    recent_used_timestamp: Optional[int]
+    feedback: FeedBack  # replaced, never changed in place, see LogCluster.set_feedback
+    metadata: dict[str, str]
+    log_messages: tuple[LogMessage, ...]  # released log messages, only line and CONTENT are read
+    template_ids: array  # replaced, never changed in place, see LogCluster.set_template_ids
+    traverse_tokens: dict[str, str]  # replaced, never changed in place
+
+    def get_log_messages(self) -> list[str]:
+        return [log_message.get_content() for log_message in self.log_messages]
+
+
+class NodeSnapshot(NamedTuple):
+    name: str
+    node_type: str
+    isEnd: bool
+    children: tuple['NodeSnapshot', ...]
+    clusters: tuple[ClusterSnapshot, ...]
+    version: int  # of the publish that copied this node, i.e. the last one this subtree changed before
+
+
+class TrieSnapshot(NamedTuple):
+    version: int  # number of publishes so far
+    root: NodeSnapshot
+    clusters: tuple[ClusterSnapshot, ...]  # all log clusters, in id order
+    recent: tuple[ClusterSnapshot, ...]  # recently used log clusters given to Trie.publish, e.g. for anomaly detection
+
+    @property
+    def modified(self) -> int:
+        """
+        version of the last publish trie changed before, unlike version it doesn't change when nothing was inserted
+        """
+        return self.root.version
+
+
+def snapshot_cluster(log_cluster: LogCluster) -> ClusterSnapshot:
+    return ClusterSnapshot(log_cluster, log_cluster.cluster_id, log_cluster.template, log_cluster.version,
+                           log_cluster.recent_used_timestamp, log_cluster.feedback, log_cluster.metadata,
+                           tuple(log_cluster.logMessagesCache.to_list()), log_cluster.template_ids,
+                           log_cluster.traverse_tokens)
+
+
+EMPTY_SNAPSHOT = TrieSnapshot(0, NodeSnapshot('root', 'root', False, (), (), 0), (), ())
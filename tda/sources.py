@@ -0,0 +1,190 @@
+"""
+Log sources: lines of one or many log files, streamed in bounded memory.
+
+LogSource reads every file matching a glob pattern, oldest first. In follow mode it keeps reading appended lines like
+tail -f and picks up new matching files. Files are identified by (device, inode), not by path:
+ - rotation by renaming (app.log -> app.log.1, new app.log): the renamed file is read to its end, the new one from its
+   start. A file matched under several names is read once.
+ - truncation (copytruncate): the file is read again from its start.
+
+Offsets of lines handed to the consumer can be saved to a json file, a restart resumes from there. An offset counts a
+line once the consumer asks for the next one, so with per-line ingestion no line is lost nor ingested twice; batching
+consumers (nlp_batch_size, trie_batch_size, sharding) may ingest again the lines of the batch in flight.
+"""
+import json
+import os
+from glob import glob
+from time import sleep
+from typing import BinaryIO, Iterator, Optional
+
+FINGERPRINT_SIZE = 64  # first bytes of a file, tell a file from another one reusing its inode
+
+
+class FileCursor:
+    __slots__ = ('key', 'path', 'file', 'offset', 'fingerprint')
+
+    def __init__(self, key: str, path: str, file: BinaryIO, offset: int, fingerprint: bytes):
+        self.key = key  # 'device:inode'
+        self.path = path  # last path the file was matched by
+        self.file = file
+        self.offset = offset  # bytes consumed
+        self.fingerprint = fingerprint
+
+
+def file_key(stat: os.stat_result) -> str:
+    return f'{stat.st_dev}:{stat.st_ino}'
+
+
+def read_fingerprint(file: BinaryIO) -> bytes:
+    position = file.tell()
+    file.seek(0)
+    fingerprint = file.read(FINGERPRINT_SIZE)
+    file.seek(position)
+    return fingerprint
+
+
+class LogSource:
+    """
+    iterate over lines of log files matching a glob pattern, see the module docstring
+    """
+
+    def __init__(self, pattern: str, follow=False, offsets_path: Optional[str] = None, poll_interval=1.0,
+                 checkpoint_lines=1000):
+        """
+        pattern: a file path or a glob pattern, e.g. './data/Java/application.log*'
+        follow: keep waiting for appended lines and new files, like tail -f
+        offsets_path: json file offsets are saved to and resumed from, None to always read from the start
+        checkpoint_lines: lines between two saves of offsets, they are also saved while waiting and on close
+        """
+        self.pattern = pattern
+        self.follow = follow
+        self.offsets_path = offsets_path
+        self.poll_interval = poll_interval
+        self.checkpoint_lines = checkpoint_lines
+        self.cursors: dict[str, FileCursor] = dict()  # open files, by key
+        self.offsets: dict[str, dict] = self._load_offsets()  # by key: path, offset and fingerprint
+        self._unsaved = 0
+
+    def paths(self) -> list[str]:
+        """
+        matching file paths, oldest first
+        """
+        paths = [path for path in glob(self.pattern) if os.path.isfile(path)]
+        return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+    def _load_offsets(self) -> dict[str, dict]:
+        if not self.offsets_path or not os.path.exists(self.offsets_path):
+            return dict()
+        with open(self.offsets_path) as f:
+            return json.load(f)
+
+    def save_offsets(self):
+        if not self.offsets_path:
+            return
+        # forget files gone for good
+        self.offsets = {key: saved for key, saved in self.offsets.items()
+                        if key in self.cursors or os.path.exists(saved['path'])}
+        for cursor in self.cursors.values():
+            if len(cursor.fingerprint) < FINGERPRINT_SIZE:  # was shorter when opened
+                cursor.fingerprint = read_fingerprint(cursor.file)
+            self.offsets[cursor.key] = {'path': cursor.path, 'offset': cursor.offset,
+                                        'fingerprint': cursor.fingerprint.hex()}
+        tmp_path = f'{self.offsets_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.offsets, f)
+        os.replace(tmp_path, self.offsets_path)  # never leaves a partly written offsets file
+        self._unsaved = 0
+
+    def _open(self, path: str) -> Optional[FileCursor]:
+        try:
+            file = open(path, 'rb')
+        except OSError:  # removed meanwhile
+            return None
+        key = file_key(os.fstat(file.fileno()))
+        fingerprint = read_fingerprint(file)
+        saved = self.offsets.get(key)
+        offset = 0
+        if saved and fingerprint.startswith(bytes.fromhex(saved['fingerprint'])):
+            offset = saved['offset']
+        cursor = FileCursor(key, path, file, offset, fingerprint)
+        self._check_truncated(cursor)
+        file.seek(cursor.offset)
+        return cursor
+
+    @staticmethod
+    def _check_truncated(cursor: FileCursor):
+        """
+        truncated, or truncated and written again past the offset meanwhile (its first bytes changed)
+        """
+        fingerprint = read_fingerprint(cursor.file)
+        rewritten = not fingerprint.startswith(cursor.fingerprint) and not cursor.fingerprint.startswith(fingerprint)
+        if rewritten or os.fstat(cursor.file.fileno()).st_size < cursor.offset:
+            cursor.fingerprint = fingerprint
+            print(f'{cursor.path} truncated, read from its start')
+            cursor.offset = 0
+            cursor.file.seek(0)
+
+    def scan(self):
+        """
+        open files newly matching the pattern, close the ones read to their end which are no longer matched
+        """
+        matched = set()
+        for path in self.paths():
+            try:
+                key = file_key(os.stat(path))
+            except OSError:
+                continue
+            matched.add(key)
+            if key in self.cursors:
+                self.cursors[key].path = path  # renamed by rotation
+                continue
+            cursor = self._open(path)
+            if cursor is not None:
+                self.cursors[cursor.key] = cursor
+        for key in [key for key in self.cursors if key not in matched]:
+            cursor = self.cursors[key]
+            if cursor.offset >= os.fstat(cursor.file.fileno()).st_size:
+                cursor.file.close()
+                del self.cursors[key]
+
+    def _read(self, cursor: FileCursor) -> Iterator[str]:
+        """
+        lines of cursor's file up to its current end
+        """
+        self._check_truncated(cursor)
+        while True:
+            line = cursor.file.readline()
+            if not line:
+                return
+            if not line.endswith(b'\n') and self.follow:  # being written, wait for the rest of it
+                cursor.file.seek(cursor.offset)
+                return
+            yield line.decode('utf-8', errors='replace')
+            cursor.offset = cursor.offset + len(line)  # the consumer is done with line
+            self._unsaved = self._unsaved + 1
+            if self._unsaved >= self.checkpoint_lines:
+                self.save_offsets()
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            while True:
+                self.scan()
+                read = False
+                for cursor in list(self.cursors.values()):
+                    for line in self._read(cursor):
+                        read = True
+                        yield line
+                if read:
+                    continue
+                self.save_offsets()
+                if not self.follow:
+                    return
+                sleep(self.poll_interval)
+        finally:
+            self.close()
+
+    def close(self):
+        self.save_offsets()
+        for cursor in self.cursors.values():
+            cursor.file.close()
+        self.cursors.clear()
@@ -0,0 +1,137 @@
+"""
+Backends that compute traverse tokens of a log message, i.e. words used to choose internal trie nodes.
+Input of every backend is CONTENT with digit-bearing words already masked (see log_structure.mask_content),
+output is an ordered dict {token: tag}. Only keys are used in traverse functions, the order of keys matters in traverse_prefix.
+
+backend is selected by 'traverse_backend' in config.py
+"""
+import re
+from threading import Lock
+from typing import Iterator
+
+from utils import MemoCache
+
+_nlp = None  # trained spacy pipeline, loaded on first use by get_nlp()
+_nlp_lock = Lock()
+
+# refer to https://universaldependencies.org/u/pos/ , to exclude stopwords
+open_class_words = {'ADJ', 'ADV', 'INTJ', 'NOUN', 'PROPN', 'VERB'}
+# only POS tags (tagger + attribute_ruler) are read from the pipeline, skip the rest of components in batched tagging
+nlp_disabled_components = ['parser', 'lemmatizer', 'ner']
+
+# english closed class words, i.e. what spacy's open_class_words filter drops: determiners, pronouns, adpositions,
+# conjunctions, auxiliaries and particles
+stopwords = frozenset('''
+a an the this that these those some any each every no all both either neither such what which whatever whichever
+i me my mine myself we us our ours ourselves you your yours yourself yourselves he him his himself she her hers herself
+it its itself they them their theirs themselves who whom whose one
+about above across after against along among around at before behind below beneath beside besides between beyond by
+down during except for from in inside into near of off on onto out outside over past per since than through throughout
+till to toward towards under underneath until unto up upon via with within without
+and or but nor so yet if because although though unless whereas while whether as
+am is are was were be been being do does did doing done have has had having
+can could may might must shall should will would ought
+not n't 's 're 've 'd 'll there here
+'''.split())
+
+
+def get_nlp():
+    """
+    load the trained pipeline on first use, so that importing parsing and trie code doesn't pay for spacy
+    """
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                import en_core_web_sm
+                _nlp = en_core_web_sm.load()  # load a trained pipeline
+    return _nlp
+
+
+class TraverseBackend:
+    """
+    interface of traverse tokens backends. Subclasses implement extract, and may override extract_batch.
+    results are memoized on masked CONTENT, lines that differ only in parameters share one entry.
+    cached dicts are shared by log messages, treat them as read-only
+    """
+    name = ''
+
+    def __init__(self, cache_capacity: int):
+        self.cache = MemoCache(cache_capacity)
+
+    def extract(self, masked_content: str) -> dict[str, str]:
+        raise NotImplementedError
+
+    def extract_batch(self, masked_contents: list[str], batch_size: int, n_process: int) -> Iterator[dict[str, str]]:
+        return map(self.extract, masked_contents)
+
+    def get(self, masked_content: str) -> dict[str, str]:
+        traverse_tokens = self.cache.get(masked_content)
+        if traverse_tokens is None:
+            traverse_tokens = self.extract(masked_content)
+            self.cache.put(masked_content, traverse_tokens)
+        return traverse_tokens
+
+    def get_batch(self, masked_contents: list[str], batch_size: int = 256, n_process: int = 1) -> list[dict[str, str]]:
+        """
+        traverse tokens of masked CONTENTs in input order. Each distinct uncached CONTENT is extracted only once.
+        """
+        results = [self.cache.get(masked_content) for masked_content in masked_contents]
+        pending = list(dict.fromkeys(masked_content for masked_content, traverse_tokens in zip(masked_contents, results)
+                                     if traverse_tokens is None))
+        if not pending:
+            return results
+        extracted = dict(zip(pending, self.extract_batch(pending, batch_size, n_process)))
+        for masked_content, traverse_tokens in extracted.items():
+            self.cache.put(masked_content, traverse_tokens)
+        return [traverse_tokens if traverse_tokens is not None else extracted[masked_content]
+                for masked_content, traverse_tokens in zip(masked_contents, results)]
+
+
+class SpacyBackend(TraverseBackend):
+    """
+    filter out open class words tagged by spacy pipeline
+
+    FIXME: Spacy defect.
+     Filer out Open Class Words is not enough, eg.
+       '0x0b85eee0'                                --> PROPN;
+       'generating core.2275'                           --> [VERB, PROPN]
+       'machine[NOUN] check[NOUN]:[PUNCT] i[PRON]-[VERB]fetch[VERB]......................[PUNCT]0[NUM]'   Possible solution: filter out non-words? like '-' here
+     Only words(r'[A-Za-z]+') can be put into traverse tokens? so NLP is not necessary? see RegexBackend
+
+    TODO: There may be another way to fix this: remove PROPN from open_class_words?
+    """
+    name = 'spacy'
+
+    @staticmethod
+    def filter_doc(doc) -> dict[str, str]:
+        return {token.text: token.pos_ for token in doc if token.pos_ in open_class_words}
+
+    def extract(self, masked_content: str) -> dict[str, str]:
+        return self.filter_doc(get_nlp()(masked_content))
+
+    def extract_batch(self, masked_contents: list[str], batch_size: int, n_process: int) -> Iterator[dict[str, str]]:
+        docs = get_nlp().pipe(masked_contents, batch_size=batch_size, n_process=n_process, disable=nlp_disabled_components)
+        return map(self.filter_doc, docs)
+
+
+class RegexBackend(TraverseBackend):
+    """
+    spacy-free backend, only words(r'[A-Za-z]+') can be traverse tokens. Single letters and english stopwords are dropped,
+    which is what open class words filter mostly does on log messages.
+    """
+    name = 'regex'
+    tag = 'WORD'
+    word_re = re.compile(r'[A-Za-z]{2,}')
+
+    def extract(self, masked_content: str) -> dict[str, str]:
+        return {word: self.tag for word in self.word_re.findall(masked_content) if word.lower() not in stopwords}
+
+
+backends = {backend.name: backend for backend in (SpacyBackend, RegexBackend)}
+
+
+def create_backend(name: str, cache_capacity: int) -> TraverseBackend:
+    if name not in backends:
+        raise ValueError(f'unknown traverse backend: {name}, choose one of {list(backends)}')
+    return backends[name](cache_capacity)
@@ -1,15 +1,21 @@
+import heapq
+import json
 import re
-from typing import Tuple, Optional, Callable
+from threading import RLock
+from typing import Tuple, Optional, Callable, Iterable
 
 from thefuzz import fuzz
 
-from config import EXACT_MATCH, NO_MATCH, PARTIAL_MATCH
+from config import EXACT_MATCH, NO_MATCH, PARTIAL_MATCH, hot_line_cache_capacity, max_clusters, max_trie_nodes, spill_path
+from config import frequent_tokens_capacity, rerank_interval, top_n_candidates
 from config import TRA_TYPE_domain_knowledge, TRA_TYPE_most_frequent_tokens, TRA_TYPE_prefix_tokens
+from cluster_index import ClusterIndex, ClusterRegistry, subsumed_pairs, subsumes
 from exceptions import LogError
-from log_structure import LogMessage, LogCluster
+from log_structure import LogMessage, LogCluster, mask_content
+from snapshot import EMPTY_SNAPSHOT, NodeSnapshot, TrieSnapshot, snapshot_cluster
+from utils import HotLineCache, SpaceSaving
 
 K = 3  # 𝐾 most frequent tokens
-token_occurrences = []
 
 d = 3  # their first 𝑑 prefix tokens
 
@@ -20,13 +26,64 @@ DEFAULT_TOKENS = ['DEFAULT']
 theta_match = 70  # match threshold
 
 
+class FrequentTokens(SpaceSaving[str]):
+    """
+    online model of the most frequent traverse tokens, used by traverse_m_f. Counts are updated by every log message
+    routed into trie, in bounded memory (see SpaceSaving). Ranks are only refreshed by re-ranking epochs (see Trie.rerank),
+    so that routes of log messages stay stable in between.
+    """
+
+    def __init__(self, capacity: int, rerank_interval: int):
+        super().__init__(capacity)
+        self.rerank_interval = rerank_interval  # log messages between two re-ranking epochs, 0 for no epoch
+        self.ranks: dict[str, int] = dict()  # token -> rank of the current epoch, 0 is the most frequent
+        self.pending = 0  # log messages counted since the last epoch
+
+    def update(self, traverse_tokens: Iterable[str]):
+        for token in traverse_tokens:
+            self.add(token)
+        self.pending = self.pending + 1
+
+    def rerank_due(self) -> bool:
+        return 0 < self.rerank_interval <= self.pending
+
+    def rerank(self) -> bool:
+        """
+        start a new epoch with the current counts. returns True if ranks changed
+        """
+        ranks = {token: rank for rank, token in enumerate(self.top())}
+        changed = ranks != self.ranks
+        self.ranks, self.pending = ranks, 0
+        return changed
+
+    def most_frequent(self, tokens: Iterable[str], k: int) -> list[str]:
+        """
+        the k highest ranked of tokens, most frequent first. O(number of tokens)
+        """
+        ranks = self.ranks
+        return [token for _, token in heapq.nsmallest(k, ((ranks[token], token) for token in tokens if token in ranks))]
+
+    def state(self) -> tuple:
+        return super().state(), list(self.ranks.items()), self.pending
+
+    def load_state(self, state: tuple) -> None:
+        counters, ranks, self.pending = state
+        super().load_state(counters)
+        self.ranks = dict(ranks)
+
+    def clear(self) -> None:
+        super().clear()
+        self.ranks, self.pending = dict(), 0
+
+
+frequent_tokens = FrequentTokens(frequent_tokens_capacity, rerank_interval)
+
+
 def sampling(pattern: re.Pattern, file_path: str, bath_size=1000):
     """
-    choose first batch_size logs as samples, then extract most frequent tokens, returns a set
+    choose first batch_size logs as samples to warm up frequent_tokens, then start its first epoch
     """
     print('========sampling========')
-    sample_logs = []
-    token_occurrences_dict = dict()
     with open(file_path) as f:
         for line, _ in zip(f, range(bath_size)):
             try:
@@ -34,14 +91,9 @@ def sampling(pattern: re.Pattern, file_path: str, bath_size=1000):
             except LogError as e:
                 print(e)
                 continue
-
-            sample_logs.append(log)
             # there's no need to filter out open class words here.
-            token_occurrences_dict.update({token: token_occurrences_dict.get(token, 0) + 1 for token in log.traverse_tokens})
-
-    sample_logs = sorted(token_occurrences_dict.items(), key=lambda s: s[1], reverse=True)
-    sample_logs = [item[0] for item in sample_logs]
-    token_occurrences.extend(sample_logs)
+            frequent_tokens.update(log.traverse_tokens)
+    frequent_tokens.rerank()
 
 
 def traverse_d_k(log: LogMessage) -> list[str]:
@@ -55,16 +107,8 @@ def traverse_m_f(log_message: LogMessage) -> list[str]:
     """
     Traverse by most frequent tokens. English stopwords are discarded
     """
-    traverse_tokens = set(log_message.traverse_tokens)
-    frequent_tokens = []
-    count = K
-    for token in token_occurrences:
-        if count <= 0:
-            break
-        if token in traverse_tokens:
-            frequent_tokens.append(token)
-            count = count - 1
-    return [', '.join(frequent_tokens)] if frequent_tokens else None
+    tokens = frequent_tokens.most_frequent(log_message.traverse_tokens, K)
+    return [', '.join(tokens)] if tokens else None
 
 
 def traverse_prefix(log_message: LogMessage) -> list[str]:
@@ -97,18 +141,14 @@ def add_escape(value):
     return value.translate(trans)
 
 
-def match_exact(log_message: str, log_clusters: set[LogCluster]) -> Optional[LogCluster]:
-    for log_cluster in log_clusters:
-        # translate special characters in template. There's an interesting phenomenon shown in unit_tests#test_translation,
-        # that \t equals \\t in param 'pattern'.
-        template = re.escape(log_cluster.template)
-        template = template.replace(r'<\*>', r'.*')
-        if re.match(template, log_message):
-            return log_cluster
-    return None
+def match_exact(log_message: LogMessage, log_clusters: ClusterIndex) -> Optional[LogCluster]:
+    """
+    only log clusters that can match the log message's tokens are checked by their precompiled matchers, see ClusterIndex
+    """
+    return log_clusters.match_exact(log_message.get_content(), log_message.content_tokens)
 
 
-def match_partial(log_message: str, log_clusters: set[LogCluster]) -> (LogCluster, int):
+def match_partial(log_message: str, log_clusters: Iterable[LogCluster]) -> (LogCluster, int):
     """
     Partial Match. Use Levenshtein Distance instead of Jaccard similarity at present
     """
@@ -126,16 +166,31 @@ class Trie:
         self.name = name
         self.children: dict[str, Trie] = dict()
         self.isEnd = False
-        self.logClusters: set[LogCluster] = set()
+        self.logClusters: ClusterIndex = ClusterIndex()
         self.parent: Trie = parent  # parent trie node
-
-    def insert(self, log_message: LogMessage, funcs: dict[str, Callable] = None) -> Tuple["Trie", LogCluster, int]:
+        # root only: (masked CONTENT, LEVEL) -> log cluster, used by insert_cached
+        self.hotLines: Optional[HotLineCache] = HotLineCache(hot_line_cache_capacity) if parent is None else None
+        # root only: all log clusters of the trie, see attach/detach
+        self.clusters: Optional[ClusterRegistry] = ClusterRegistry() if parent is None else None
+        # root only: number of trie nodes, root included
+        self.nNodes: int = 1
+        # root only: held by writers, readers use the published snapshot instead. see snapshot.py
+        self.write_lock: Optional[RLock] = RLock() if parent is None else None
+        self.snapshot: Optional[TrieSnapshot] = EMPTY_SNAPSHOT if parent is None else None
+        self._revision = 0  # increased on every change in this subtree, see changed()
+        self._snapshot: Optional[NodeSnapshot] = None  # snapshot of this subtree at _snapshot_revision
+        self._snapshot_revision = -1
+        if parent is not None:
+            parent.get_root().nNodes += 1
+            parent.changed()
+
+    def route(self, log_message: LogMessage, funcs: dict[str, Callable] = None) -> "Trie":
         """
-        gross-grained insert via three traverse functions. Then exact inserted into a LogCluster instance.
-        returns internal leaf node and log cluster that matches.
+        gross-grained insert via three traverse functions, creating internal nodes on the way. returns the leaf node.
         """
         if funcs is None:
             funcs = traverse_funcs
+        frequent_tokens.update(log_message.traverse_tokens)
 
         trie_node = self
         # extract internal nodes
@@ -153,30 +208,128 @@ class Trie:
                 trie_node.isEnd = False
 
         trie_node.isEnd = True  # leaf node
+        return trie_node
+
+    def insert(self, log_message: LogMessage, funcs: dict[str, Callable] = None) -> Tuple["Trie", LogCluster, int]:
+        """
+        gross-grained insert via three traverse functions. Then exact inserted into a LogCluster instance.
+        returns internal leaf node and log cluster that matches.
+        """
+        trie_node = self.route(log_message, funcs)
 
         # leaf trie node, match a log cluster then update its template
         log_cluster, match_type = trie_node.match(log_message)
         if match_type == NO_MATCH:
-            trie_node.logClusters.add(log_cluster)  # add the log into trie node
-            log_cluster.parent = trie_node  # refer to its parent (type: Trie)
+            trie_node.attach(log_cluster)  # add the log into trie node
+        self.get_root().clusters.touch(log_cluster)
 
         return trie_node, log_cluster, match_type
 
-    def match(self, log_message: LogMessage) -> Tuple[LogCluster, int]:
+    def insert_cached(self, log_message: LogMessage) -> Tuple["Trie", LogCluster, int]:
+        """
+        insert + insert_and_update_template of a log message, with the hot line cache in front. Should be called on root.
+        On a cache hit the log message is an exact match of the cached log cluster, and is never tokenized, so it can be
+        created with lazy=True.
+        """
+        if not self.hotLines.capacity:
+            log_message.ensure_tokens()
+            trie_node, log_cluster, match_type = self.insert(log_message)
+            log_cluster.insert_and_update_template(log_message, match_type)
+            return trie_node, log_cluster, match_type
+
+        content = log_message.get_content()
+        key = (mask_content(content), log_message.get_level())
+        hit = self.hotLines.lookup(key, content)
+        if hit is not None:
+            # not routed, count traverse tokens of the same masked CONTENT, remembered with the log cluster
+            log_cluster, log_message.traverse_tokens = hit
+            frequent_tokens.update(log_message.traverse_tokens)
+            log_cluster.insert_and_update_template(log_message, EXACT_MATCH)
+            self.clusters.touch(log_cluster)
+            return log_cluster.parent, log_cluster, EXACT_MATCH
+
+        log_message.ensure_tokens()
+        trie_node, log_cluster, match_type = self.insert(log_message)
+        log_cluster.insert_and_update_template(log_message, match_type)
+        self.hotLines.remember(key, content, log_cluster, log_message.traverse_tokens)
+        return trie_node, log_cluster, match_type
+
+    def insert_batch(self, log_messages: list[LogMessage], funcs: dict[str, Callable] = None) \
+            -> list[Tuple["Trie", LogCluster, int]]:
+        """
+        insert a batch of log messages AND update templates of their log clusters, i.e. insert + insert_and_update_template
+        for each of them. Results are in input order and equal to inserting them one by one.
+        Log messages are grouped by leaf node, and each group is fuzzy scored against templates of its leaf in one
+        vectorized call (rapidfuzz process.cdist). Log clusters created or changed by earlier log messages of the batch are
+        scored one by one, so they are visible to later log messages.
+        """
+        import numpy as np
+        from rapidfuzz import fuzz as rapid_fuzz, process, utils as rapid_utils
+
+        leaves: dict[Trie, list[int]] = dict()  # leaf node -> indexes of log messages routed to it, in input order
+        for i, log_message in enumerate(log_messages):
+            log_message.ensure_tokens()
+            leaves.setdefault(self.route(log_message, funcs), []).append(i)
+
+        results: list[Optional[Tuple[Trie, LogCluster, int]]] = [None] * len(log_messages)
+        for trie_node, indexes in leaves.items():
+            snapshot = list(trie_node.logClusters)
+            columns = {log_cluster: (j, log_cluster.version) for j, log_cluster in enumerate(snapshot)}
+            scores = np.zeros((len(indexes), len(snapshot)))
+            if snapshot:
+                # same scorer as thefuzz.fuzz.token_set_ratio (for ascii CONTENT), scores are rounded to int below.
+                # scores under the cutoff are 0, which never changes a partial/no match decision
+                scores = process.cdist([log_messages[i].get_content() for i in indexes],
+                                       [log_cluster.template for log_cluster in snapshot],
+                                       scorer=rapid_fuzz.token_set_ratio, processor=rapid_utils.default_process,
+                                       score_cutoff=theta_match - 0.5, workers=-1)
+
+            for row, i in enumerate(indexes):
+                def partial_matcher(content: str, candidates: Iterable[LogCluster]) -> (LogCluster, int):
+                    best_log_cluster, max_score = None, 0
+                    for log_cluster in candidates:
+                        j, version = columns.get(log_cluster, (None, None))
+                        if j is not None and version == log_cluster.version:
+                            score = int(round(float(scores[row][j])))
+                        else:  # created or changed in this batch
+                            score = fuzz.token_set_ratio(content, log_cluster.template)
+                        best_log_cluster = log_cluster if score > max_score else best_log_cluster
+                        max_score = score if score > max_score else max_score
+                    return best_log_cluster, max_score
+
+                log_message = log_messages[i]
+                log_cluster, match_type = trie_node.match(log_message, partial_matcher)
+                if match_type == NO_MATCH:
+                    trie_node.attach(log_cluster)
+                self.clusters.touch(log_cluster)
+                log_cluster.insert_and_update_template(log_message, match_type)
+                results[i] = trie_node, log_cluster, match_type
+        return results
+
+    def match(self, log_message: LogMessage, partial_matcher: Callable = None) -> Tuple[LogCluster, int]:
         """
         three match strategy. if 'no match', should return true in order to add this new log cluster in the trie (leaf) node
+        partial_matcher: replaces match_partial, e.g. by precomputed scores in insert_batch
         """
         match_type = EXACT_MATCH
-        cluster = match_exact(log_message.get_content(), self.logClusters)  # exact match
+        cluster = match_exact(log_message, self.logClusters)  # exact match
         if not cluster:
-            cluster, score = match_partial(log_message.get_content(), self.logClusters)  # partial match
+            candidates = self.logClusters.candidates(log_message.get_content(), top_n_candidates)
+            cluster, score = (partial_matcher or match_partial)(log_message.get_content(), candidates)  # partial match
             match_type = PARTIAL_MATCH
             if score < theta_match:
                 # The template for this new log cluster is the log message itself, i.e., t_j = l_i
-                cluster = LogCluster(log_message.content_tokens)  # no match
+                cluster = LogCluster(log_message.content_tokens, log_message.traverse_tokens)  # no match
+                log_message.content_ids = cluster.template_ids  # tokens of the log message are interned now
                 match_type = NO_MATCH
         return cluster, match_type
 
+    def get_root(self) -> "Trie":
+        trie_node = self
+        while trie_node.parent:
+            trie_node = trie_node.parent
+        return trie_node
+
     def search_tries_by_level(self, level: int) -> list["Trie"]:
         """
         search all trie nodes in a level, e.g. domain knowledge, most frequently used. usually root node call this for the purpose of re-constructing the thie tree.
@@ -191,14 +344,27 @@ class Trie:
 
     def search_clusters_recurse(self) -> list[LogCluster]:
         """
-        search ALL log clusters recursively, if this trie isEnd == False, then search its all child nodes until isEnd == True, return all log clusters
+        search ALL log clusters under this trie node, in cluster id order.
+        looked up in the root's ClusterRegistry instead of walking the trie
         """
-        if self.isEnd:
-            return list(self.logClusters)
-        log_clusters = []
-        for name, child in self.children.items():
-            log_clusters.extend(child.search_clusters_recurse())
-        return log_clusters
+        return self.get_root().clusters.under(self)
+
+    def attach(self, log_cluster: LogCluster):
+        """
+        add a log cluster into this leaf node, and register it in root's ClusterRegistry
+        """
+        self.logClusters.add(log_cluster)
+        log_cluster.parent = self  # refer to its parent (type: Trie)
+        self.get_root().clusters.attach(log_cluster, self)
+        self.changed()
+
+    def detach(self, log_cluster: LogCluster):
+        """
+        remove a log cluster from this leaf node. It stays registered (keeps its id), e.g. to be attached to another leaf
+        """
+        self.logClusters.remove(log_cluster)
+        self.get_root().clusters.detach(log_cluster, self)
+        self.changed()
 
     def reconstruct(self, level=2):
         """
@@ -210,55 +376,212 @@ class Trie:
             for name, child in self.children.items():
                 child.reconstruct(level - 1)
 
-    def update_trie(self, traverse_func=traverse_prefix):
+    def update_trie(self, funcs: dict[str, Callable] = None):
         """
         update trie. a part of reconstruct.
-        search ALL log clusters under this trie node or its children recursively, then clear its all child nodes, finally re-construct its child nodes
-        traverse_func: assign traverse function
+        re-route ALL log clusters under this trie node or its children by traverse functions over the traverse tokens each
+        log cluster carries, so there's no nlp call. Only log clusters whose routing key changed are moved, then child nodes
+        left without log clusters are pruned.
+        funcs: traverse functions of the levels under this node, prefix tokens level by default
+        returns True if any log cluster moved
         """
-        log_clusters = self.search_clusters_recurse()  # gather all log clusters under this node recursively
+        if funcs is None:
+            funcs = {TRA_TYPE_prefix_tokens: traverse_prefix}
+        log_clusters = self.search_clusters_recurse()  # gather all log clusters under this node
         assert not self.isEnd
-        self.children = dict()  # clear all child trie nodes, then re-construct
+        moved = False
         for log_cluster in log_clusters:
+            path = [(token, traverse_type) for traverse_type, traverse_func in funcs.items()
+                    for token in traverse_func(log_cluster) or DEFAULT_TOKENS]
+            if self.path_to(log_cluster.parent) == [token for token, _ in path]:
+                continue
+            log_cluster.parent.detach(log_cluster)
             node = self
-            # generate a log message based on a template
-            log_message = LogMessage(template=log_cluster.template)
-            prefix_tokens = traverse_func(log_message)
-            for token in prefix_tokens:
+            for token, traverse_type in path:
                 if token not in node.children:
-                    node.children[token] = Trie(token, node, TRA_TYPE_prefix_tokens)
+                    node.children[token] = Trie(token, node, traverse_type)
                 node = node.children[token]
                 node.isEnd = False
             node.isEnd = True
-            node.logClusters.add(log_cluster)
+            node.attach(log_cluster)
+            moved = True
+        self.prune()
+        if moved:
+            self.get_root().hotLines.clear()  # routes changed, cached log clusters may have been moved to other leaf nodes
+        return moved
+
+    def rerank(self) -> bool:
+        """
+        re-ranking epoch of frequent_tokens. If ranks changed, the most frequent tokens level (and the prefix tokens level
+        under it) is rebuilt under every domain knowledge node, moving only log clusters whose route changed.
+        Should be called on root. returns True if any log cluster moved
+        """
+        if not frequent_tokens.rerank():
+            return False
+        funcs = {TRA_TYPE_most_frequent_tokens: traverse_m_f, TRA_TYPE_prefix_tokens: traverse_prefix}
+        moved = False
+        for child in list(self.children.values()):
+            moved = child.update_trie(funcs) or moved
+        return moved
+
+    def changed(self):
+        """
+        this node or a log cluster in it changed, its subtree (and so the ones of its ancestors) must be copied again by
+        the next publish
+        """
+        trie_node = self
+        while trie_node is not None:
+            trie_node._revision = trie_node._revision + 1
+            trie_node = trie_node.parent
+
+    def _snapshot_node(self, version: int) -> NodeSnapshot:
+        if self._snapshot_revision != self._revision:
+            revision = self._revision
+            self._snapshot = NodeSnapshot(self.name, self.node_type, self.isEnd,
+                                          tuple(child._snapshot_node(version) for child in self.children.values()),
+                                          tuple(snapshot_cluster(log_cluster) for log_cluster in self.logClusters),
+                                          version)
+            self._snapshot_revision = revision
+        return self._snapshot
+
+    def publish(self, recent: Iterable[LogCluster] = ()) -> TrieSnapshot:
+        """
+        publish an immutable snapshot of the trie for readers, as root.snapshot. Should be called on root.
+        Only subtrees changed since the last publish are copied.
+        recent: live log clusters to be looked up in the snapshot as TrieSnapshot.recent, e.g. recently used ones
+        """
+        with self.write_lock:
+            version = self.snapshot.version + 1
+            root = self._snapshot_node(version)
+            clusters, nodes = dict(), [root]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend(node.children)
+                clusters.update((cluster_snapshot.cluster, cluster_snapshot) for cluster_snapshot in node.clusters)
+            self.snapshot = TrieSnapshot(version, root,
+                                         tuple(sorted(clusters.values(), key=lambda c: (c.cluster_id is None, c.cluster_id or 0))),
+                                         tuple(clusters[log_cluster] for log_cluster in recent if log_cluster in clusters))
+            return self.snapshot
+
+    def path_to(self, trie_node: "Trie") -> Optional[list[str]]:
+        """
+        names of trie nodes from this node (exclusive) down to trie_node, None if trie_node isn't under this node
+        """
+        path = []
+        while trie_node is not None and trie_node is not self:
+            path.append(trie_node.name)
+            trie_node = trie_node.parent
+        return path[::-1] if trie_node is self else None
 
-    def extract_recently_used_templates(self):
+    def prune(self) -> bool:
+        """
+        remove child nodes that hold no log cluster in their subtree. returns True if this node's subtree is empty
+        """
+        for name, child in list(self.children.items()):
+            if child.prune():
+                del self.children[name]
+                self.get_root().nNodes -= 1
+                self.changed()
+        return not self.children and not self.logClusters
+
+    def prune_upwards(self):
+        """
+        remove this node and its ancestors (root excluded) as long as they hold no child node and no log cluster
+        """
+        trie_node, root = self, self.get_root()
+        while trie_node.parent is not None and not trie_node.children and not trie_node.logClusters:
+            del trie_node.parent.children[trie_node.name]
+            root.nNodes -= 1
+            trie_node.parent.changed()
+            trie_node = trie_node.parent
+
+    def evict(self, log_cluster: LogCluster):
+        """
+        remove a log cluster from the trie for good, then prune trie nodes left empty. Should be called on root.
+        """
+        leaf = log_cluster.parent
+        leaf.detach(log_cluster)
+        self.clusters.forget(log_cluster)
+        log_cluster.parent = None
+        log_cluster.release_template_ids()
+        leaf.prune_upwards()
+
+    def evict_over_limits(self, max_clusters: int = max_clusters, max_nodes: int = max_trie_nodes,
+                          spill_path: Optional[str] = spill_path) -> list[LogCluster]:
+        """
+        evict least recently used log clusters until there are at most max_clusters log clusters and max_nodes trie nodes
+        (0 for no limit). Should be called on root. Evicted log clusters are appended to spill_path as json lines if given.
+        returns evicted log clusters
+        """
+        evicted = []
+        while (max_clusters and len(self.clusters) > max_clusters) or (max_nodes and self.nNodes > max_nodes):
+            log_cluster = self.clusters.least_recently_used()
+            if log_cluster is None:
+                break
+            self.evict(log_cluster)
+            evicted.append(log_cluster)
+        if evicted and spill_path:
+            with open(spill_path, 'a') as f:
+                for log_cluster in evicted:
+                    f.write(json.dumps(log_cluster.to_dict(), default=str) + '\n')
+        return evicted
+
+    def extract_recently_used_templates(self) -> list[LogCluster]:
         """
         LRU strategy, limit the number of log templates considered for fitting the GEV distribution
         """
         log_clusters = self.search_clusters_recurse()
-        sorted(log_clusters, key=lambda log: log.recent_used_timestamp, reverse=True)
+        return sorted(log_clusters, key=lambda log: log.recent_used_timestamp, reverse=True)
 
     def remove_log_cluster(self, log_cluster: LogCluster):
-        self.logClusters.remove(log_cluster)
-
-    # Trie Update
+        self.detach(log_cluster)
 
+    def plan_merges(self) -> list[tuple[LogCluster, LogCluster]]:
+        """
+        merge pairs of log clusters in every leaf node, see merge_clusters. Should be called on root.
+        Only reads the trie, so it can run in a background thread while log messages are inserted; the plan is
+        re-validated by apply_merges
+        """
+        pairs = []
+        for leaf in self.clusters.leaves():
+            log_clusters = self.clusters.by_leaf(leaf)
+            if len(log_clusters) > 1:
+                pairs.extend(merge_clusters(log_clusters))
+        return pairs
+
+    def apply_merges(self, pairs: list[tuple[LogCluster, LogCluster]]) -> list[tuple[LogCluster, LogCluster]]:
+        """
+        merge each log cluster into its more general log cluster: messages and feedback are absorbed, then the subsumed
+        log cluster leaves the trie. Should be called on root, by the thread inserting log messages, so that the trie
+        changes at once between two inserts. Pairs outdated since planned (moved, evicted or templates changed so that
+        subsumption no longer holds) are skipped.
+        returns applied pairs
+        """
+        applied = []
+        for log_cluster, general in pairs:
+            leaf = log_cluster.parent
+            if leaf is None or general.parent is not leaf or not subsumes(general, log_cluster):
+                continue
+            general.absorb(log_cluster)
+            leaf.detach(log_cluster)
+            self.clusters.forget(log_cluster)
+            log_cluster.parent = None  # hot line cache entries of it become invalid
+            log_cluster.release_template_ids()
+            applied.append((log_cluster, general))
+        return applied
+
+    def merge_subsumed(self) -> list[tuple[LogCluster, LogCluster]]:
+        """
+        plan and apply template merges at once. Should be called on root
+        """
+        return self.apply_merges(self.plan_merges())
 
-def merge_clusters(log_clusters: list[LogCluster]):
-    def cmp(log_cluster: LogCluster):
-        items = re.findall(r'<\*>', log_cluster.template)
-        return len(items)
+    # Trie Update
 
-    sorted_log_clusters = sorted(log_clusters, key=cmp,
-                                 reverse=True)  # no arg 'cmp' in python 3+. refer to: https://blog.csdn.net/gongjianbo1992/article/details/107324871
 
-    # for log_cluster in sorted_log_clusters:
-    #     print(log_cluster.template)
-    for i in range(len(sorted_log_clusters) - 1):
-        # print(sorted_log_clusters[i].template)
-        template = sorted_log_clusters[i].template.replace('<*>', '.*')
-        template = template.replace('(', r'\(').replace(')', r'\)')
-        complied = re.compile(template)
-        if re.search(template, sorted_log_clusters[i + 1].template):
-            print('GOOD!')
+def merge_clusters(log_clusters: list[LogCluster]) -> list[tuple[LogCluster, LogCluster]]:
+    """
+    find log clusters whose template is subsumed by a more general template among log_clusters.
+    returns (log cluster, log cluster to merge it into) pairs, nothing is changed. see Trie.apply_merges
+    """
+    return subsumed_pairs(log_clusters)
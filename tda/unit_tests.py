@@ -1,11 +1,14 @@
+import os
 import re
+import sys
 import unittest
 
-from log_structure import LogMessage
-from trie import LogCluster, merge_clusters, Trie, traverse_m_f, token_occurrences
+from log_structure import LogMessage, serialize, tokenize
+from trie import LogCluster, merge_clusters, Trie, traverse_m_f, frequent_tokens, sampling
 import pandas as pd
 import process_tda as main
 import utils
+from exceptions import LogError
 
 df = pd.read_csv('../data/BGL/BGL_2k.log_templates.csv')
 
@@ -52,7 +55,6 @@ class TestPreprocess(unittest.TestCase):
     def test_merge_wildcards(self):
         template = '\t<*> Node card status: <*> <*> \t\t <*> <*> <*> <*> <*> <*> is <*> \t active. Midplane. PGOOD <*> <*> is clear. MPGOOD is OK. MPGOOD <*> <*> is clear. The 2.5 volt rail is OK. The 1.5 volt rail is <*>'
         template_tokens = re.split(r'(\s+)', template)
-        from log_structure import merge_adjacent_wildcards
         new_template_tokens = merge_adjacent_wildcards(template_tokens)
         print('\n')
         print(template)
@@ -101,6 +103,17 @@ class TestLogCluster(unittest.TestCase):
         assert m
         print(m)
 
+    def test_template_matcher_version(self):
+        from log_structure import tokenize
+        log_cluster = LogCluster(tokenize('generating core.12927'))
+        matcher, version = log_cluster.matcher, log_cluster.version
+        self.assertFalse(log_cluster.set_template(tokenize('generating core.12927')))
+        self.assertIs(log_cluster.matcher, matcher)
+        self.assertTrue(log_cluster.set_template(tokenize('generating <*>')))
+        self.assertEqual(log_cluster.version, version + 1)
+        self.assertTrue(log_cluster.matcher.fullmatch('generating core.2275'))
+        self.assertFalse(log_cluster.matcher.fullmatch('core generating core.2275'))
+
     def test_tokenize(self):
         from log_structure import tokenize
         content = 'generating core.12927'
@@ -131,6 +144,259 @@ class TestTrie(unittest.TestCase):
         main.process()
         main.reconstruct()
 
+    def test_cluster_registry(self):
+        from config import bgl_pattern
+        root = Trie('root', None, 'root')
+        with open('../data/BGL/BGL_2k.log') as f:
+            ingest_lines(root, re.compile(bgl_pattern), f.readlines())
+        log_clusters = list(root.clusters)
+        self.assertEqual([c.cluster_id for c in log_clusters], list(range(len(log_clusters))))
+        self.assertTrue(all(root.clusters.get(c.cluster_id) is c for c in log_clusters))
+        for level_node in root.children.values():
+            expected = {c for c in log_clusters if level_node.path_to(c.parent) is not None}
+            self.assertEqual(set(level_node.search_clusters_recurse()), expected)
+            for node in level_node.children.values():
+                self.assertEqual(set(node.search_clusters_recurse()),
+                                 {c for c in expected if node.path_to(c.parent) is not None})
+        ids = {c: c.cluster_id for c in log_clusters}
+        root.reconstruct()
+        self.assertEqual({c: c.cluster_id for c in root.clusters}, ids)
+
+    def test_candidates_ignore_case_and_punctuation(self):
+        from cluster_index import ClusterIndex
+        from log_structure import tokenize
+        index = ClusterIndex()
+        log_clusters = [LogCluster(tokenize(f'service {i} started on node-{i}')) for i in range(5)]
+        target = LogCluster(tokenize('Connection refused: host <*>'))
+        for log_cluster in log_clusters + [target]:
+            index.add(log_cluster)
+        self.assertEqual(index.candidates('CONNECTION REFUSED host 10.0.0.1', 2)[0], target)
+        self.assertEqual(index.candidates('unrelated words', 2), [log_clusters[-1], target])  # the most recent ones
+
+    def test_merge_subsumed(self):
+        from config import bgl_pattern
+        from log_structure import tokenize
+        general, specific, other = (LogCluster(tokenize(t)) for t in
+                                    ('generating <*>', 'generating core <*>', 'generating <*> done'))
+        specific.feedback.decision = 1
+        pairs = merge_clusters([specific, other, general])
+        self.assertEqual(set(pairs), {(specific, general), (other, general)})
+        general.absorb(specific)
+        self.assertEqual(general.feedback.decision, 1)
+
+        root = Trie('root', None, 'root')
+        with open('../data/BGL/BGL_2k.log') as f:
+            ingest_lines(root, re.compile(bgl_pattern), f.readlines())
+        n_clusters = len(root.clusters)
+        n_messages = sum(len(c.logMessagesCache) for c in root.clusters)
+        pairs = root.plan_merges()
+        for log_cluster, general in pairs:
+            self.assertIs(log_cluster.parent, general.parent)
+            self.assertFalse(general in dict(pairs))
+        applied = root.merge_subsumed()
+        self.assertEqual(len(applied), len(pairs))
+        self.assertEqual(len(root.clusters), n_clusters - len(applied))
+        self.assertEqual(root.plan_merges(), [])
+        for log_cluster, general in applied:
+            self.assertIsNone(log_cluster.parent)
+            self.assertNotIn(log_cluster, general.parent.logClusters)
+            self.assertTrue(all(general.matcher.fullmatch(content) for content in general.get_log_messages()))
+        self.assertLessEqual(sum(len(c.logMessagesCache) for c in root.clusters), n_messages)
+        print(f'{len(applied)} of {n_clusters} log clusters merged')
+
+    def test_evict_over_limits(self):
+        import json
+        import tempfile
+        from config import bgl_pattern
+
+        def nodes(trie_node):
+            return 1 + sum(nodes(child) for child in trie_node.children.values())
+
+        def empty_nodes(trie_node):
+            empty = int(trie_node.parent is not None and not trie_node.children and not trie_node.logClusters)
+            return empty + sum(empty_nodes(child) for child in trie_node.children.values())
+
+        pattern = re.compile(bgl_pattern)
+        with open('../data/BGL/BGL_2k.log') as f:
+            lines = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp:
+            spill = os.path.join(tmp, 'evicted.jsonl')
+            root, evicted = Trie('root', None, 'root'), []
+            for line in lines:
+                try:
+                    log_message = LogMessage(pattern, line)
+                except (LogError, ValueError):
+                    continue
+                _, log_cluster, match_type = root.insert(log_message)
+                log_cluster.insert_and_update_template(log_message, match_type)
+                evicted.extend(root.evict_over_limits(max_clusters=20, max_nodes=40, spill_path=spill))
+                self.assertLessEqual(len(root.clusters), 20)
+                self.assertLessEqual(root.nNodes, 40)
+            self.assertEqual(root.nNodes, nodes(root))
+            self.assertEqual(empty_nodes(root), 0)
+            self.assertTrue(evicted)
+            self.assertTrue(all(c.parent is None and root.clusters.get(c.cluster_id) is None for c in evicted))
+            with open(spill) as f:
+                spilled = [json.loads(line) for line in f]
+            self.assertEqual([item['id'] for item in spilled], [c.cluster_id for c in evicted])
+            print(f'{len(evicted)} log clusters evicted, {len(root.clusters)} kept in {root.nNodes} trie nodes')
+
+    def test_vocabulary_under_eviction(self):
+        """
+        tokens only held by evicted log clusters are dropped from the vocabulary: it grows with the log clusters kept in
+        the trie, not with the log clusters seen
+        """
+        from config import bgl_pattern
+        from vocabulary import vocabulary
+        pattern = re.compile(bgl_pattern)
+        with open('../data/BGL/BGL_2k.log') as f:
+            lines = f.readlines()
+        growth = []
+        for max_clusters in (0, 20):
+            size, root, peak = len(vocabulary), Trie('root', None, 'root'), 0
+            for line in lines:
+                ingest_lines(root, pattern, [line])
+                root.evict_over_limits(max_clusters=max_clusters, max_nodes=0, spill_path=None)
+                peak = max(peak, len(vocabulary) - size)
+                held = {token_id for c in root.clusters for token_id in c.template_ids}
+                self.assertLessEqual(len(vocabulary) - size, len(held))
+            growth.append(peak)
+            for log_cluster in list(root.clusters):
+                root.evict(log_cluster)
+            self.assertEqual(len(vocabulary), size)
+        print(f'vocabulary growth: {growth[0]} tokens without eviction, at most {growth[1]} with 20 log clusters kept')
+        self.assertLess(growth[1], growth[0])
+
+    def test_insert_log_messages_evicts_after_batch(self):
+        """
+        batched inserts evict once per batch, after every log message of the batch is recorded: no evicted log cluster
+        is left in the lru cache of log clusters
+        """
+        from config import bgl_pattern
+        from log_structure import parse_lines
+        pattern = re.compile(bgl_pattern)
+        with open('../data/BGL/BGL_2k.log') as f:
+            log_messages = list(parse_lines(pattern, f.readlines()))
+        main.root, main.lcCache, calls = Trie('root', None, 'root'), utils.LogClusterCache(200), []
+        evict_over_limits = main.root.evict_over_limits
+
+        def evict_over_20():
+            calls.append(1)
+            return evict_over_limits(max_clusters=20, max_nodes=0, spill_path=None)
+
+        main.root.evict_over_limits = evict_over_20
+        for i in range(0, len(log_messages), 100):
+            main.insert_log_messages(log_messages[i:i + 100])
+            self.assertLessEqual(len(main.root.clusters), 20)
+            self.assertTrue(all(main.root.clusters.get(c.cluster_id) is c for c in main.lcCache._cache))
+        self.assertEqual(len(calls), (len(log_messages) + 99) // 100)
+
+    def test_space_saving(self):
+        import random
+        random.seed(0)
+        stream = [f'token{int(random.paretovariate(1.2))}' for _ in range(20000)]
+        truth = dict()
+        for token in stream:
+            truth[token] = truth.get(token, 0) + 1
+        exact, sketch = utils.SpaceSaving(len(truth)), utils.SpaceSaving(50)
+        for token in stream:
+            exact.add(token)
+            sketch.add(token)
+        self.assertEqual({token: exact.count(token) for token in truth}, truth)
+        self.assertEqual(len(sketch), 50)
+        for token in sketch.top():
+            self.assertLessEqual(sketch.count(token) - sketch.error(token), truth[token])
+            self.assertGreaterEqual(sketch.count(token), truth[token])
+        # heavy hitters, more frequent than stream length / capacity, are always monitored
+        self.assertTrue(all(token in sketch.top() for token, n in truth.items() if n > len(stream) / 50))
+
+    def test_rerank(self):
+        from config import bgl_pattern, TRA_TYPE_most_frequent_tokens
+        from trie import traverse_prefix
+        frequent_tokens.clear()  # no sampling, every log message is routed to the DEFAULT most frequent tokens node
+        root = Trie('root', None, 'root')
+        with open('../data/BGL/BGL_2k.log') as f:
+            ingest_lines(root, re.compile(bgl_pattern), f.readlines())
+        log_clusters = {c: c.template for c in root.clusters}
+        self.assertEqual({node.name for node in root.search_tries_by_level(2)}, {'DEFAULT'})
+        self.assertTrue(root.rerank())
+        self.assertEqual({c: c.template for c in root.clusters}, log_clusters)
+        for log_cluster in log_clusters:
+            level_node = log_cluster.parent
+            while level_node.parent.parent is not None:
+                level_node = level_node.parent
+            expected = (traverse_m_f(log_cluster) or ['DEFAULT']) + (traverse_prefix(log_cluster) or ['DEFAULT'])
+            self.assertEqual(level_node.path_to(log_cluster.parent), expected)
+        self.assertTrue(all(node.node_type == TRA_TYPE_most_frequent_tokens for node in root.search_tries_by_level(2)))
+        self.assertFalse(root.rerank())  # no new counts, same ranks
+        frequent_tokens.clear()
+
+    def test_concurrent_snapshots(self):
+        """
+        insert log messages while a detection thread sets feedback and an API thread renders snapshots
+        """
+        import json
+        from threading import Event, Thread
+        from config import bgl_pattern
+        from log_structure import FeedBack
+        from server_apis import render_echarts_api, expert_feedback_api
+        main.root = Trie('root', None, 'root')
+        pattern = re.compile(bgl_pattern)
+        done, errors = Event(), []
+
+        def check(snapshot):
+            leaves, nodes = [], [snapshot.root]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend(node.children)
+                leaves.extend(node.clusters)
+            ids = [c.cluster_id for c in snapshot.clusters]
+            if sorted(ids) != ids or len(set(ids)) != len(ids) or {id(c) for c in leaves} != {id(c) for c in snapshot.clusters}:
+                raise AssertionError(f'inconsistent snapshot {snapshot.version}')
+
+        def reader(read):
+            try:
+                while not done.is_set():
+                    read(main.root.snapshot)
+            except Exception as e:
+                errors.append(e)
+
+        def detect(snapshot):
+            for c in snapshot.recent:
+                if c.feedback.decision == -1:
+                    c.cluster.set_feedback(FeedBack(decision=0, ep=0.5, tp=0.5))
+
+        def render(snapshot):
+            check(snapshot)
+            json.dumps(render_echarts_api(snapshot, 'graph'))
+            json.dumps(render_echarts_api(snapshot, 'tree'))
+            json.dumps(expert_feedback_api(snapshot))
+
+        threads = [Thread(target=reader, args=(detect,), daemon=True), Thread(target=reader, args=(render,), daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            with open('../data/BGL/BGL_2k.log') as f:
+                for line in f:
+                    try:
+                        main.insert_log_message(LogMessage(pattern, line))
+                    except (LogError, ValueError):
+                        continue
+                    main.publish()
+        finally:
+            done.set()  # readers stop even if inserting fails
+            for thread in threads:
+                thread.join(timeout=10)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(errors, [])
+
+        main.publish()
+        detect(main.root.snapshot)
+        snapshot = main.root.publish()
+        check(snapshot)
+        self.assertEqual([c.cluster for c in snapshot.clusters], list(main.root.clusters))
+        self.assertTrue(all(c.feedback.decision == 0 for c in snapshot.recent))
+
 
 def test_cdf():
     data = [42, 109, 92, 721, 1, 18, 1, 17, 2, 1, 1, 2, 2, 7, 3, 3, 2, 5, 4, 1, 2, 1, 1, 5, 2, 1, 1, 121, 3, 9, 5, 30,
@@ -171,4 +437,796 @@ def test_cdf():
 
     ax3.scatter(x, tp, label='tp', s=5)
 
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+def grouping_accuracy(predicted: list, truth: list) -> float:
+    """
+    loghub grouping accuracy: a log message is parsed correctly if its predicted cluster holds exactly the log messages
+    of its ground truth event
+    """
+    predicted_groups, truth_groups = dict(), dict()
+    for i, (p, t) in enumerate(zip(predicted, truth)):
+        predicted_groups.setdefault(p, set()).add(i)
+        truth_groups.setdefault(t, set()).add(i)
+    correct = sum(len(group) for group in predicted_groups.values() if truth_groups[truth[next(iter(group))]] == group)
+    return correct / len(truth)
+
+
+def structured_ground_truth(path: str) -> dict[int, str]:
+    """
+    line index (0 based) -> EventId, from a loghub *_structured.csv
+    """
+    import csv
+    with open(f'{path}_structured.csv', newline='') as f:
+        return {int(row['LineId']) - 1: row['EventId'] for row in csv.DictReader(f)}
+
+
+def spacy_model_installed() -> bool:
+    """
+    spacy and its trained pipeline en_core_web_sm are optional, tests of the spacy traverse backend need both
+    """
+    try:
+        import spacy
+    except ImportError:
+        return False
+    return spacy.util.is_package('en_core_web_sm')
+
+
+def ingest_lines(root: Trie, pattern: re.Pattern, lines: list[str]) -> dict[int, LogCluster]:
+    """
+    insert lines one by one, returns line index -> the log cluster its log message belongs to after insert
+    """
+    clusters = dict()
+    for i, line in enumerate(lines):
+        try:
+            log_message = LogMessage(pattern, line)
+        except (LogError, ValueError):
+            continue
+        _, log_cluster, match_type = root.insert(log_message)
+        log_cluster.insert_and_update_template(log_message, match_type)
+        clusters[i] = log_cluster
+    return clusters
+
+
+def merge_adjacent_wildcards(template_tokens: list[str]) -> [list[str], str]:
+    """
+    merge adjacent <*>s, string based reference of generalize_template.
+    spaces between '<*>' should be replaced. e.g. ['<*>', ' ', ' \t\t', '<*>'] ---> ['<*>']
+    """
+    template = re.sub(r'<\*>(\s|(<\*>))*<\*>', '<*>', serialize(template_tokens))
+    return tokenize(template), template
+
+
+def extract_template(log_message: LogMessage, tokenized_template: list[str]) -> list[str]:
+    """
+    extract a new template between the incoming log cluster and existed template
+    """
+    log_message = log_message.content_tokens
+    # identify the common set of tokens shared by both t_i and l_i
+    common_token_set = set(log_message) & set(tokenized_template)
+    common_token_set.discard('')
+    # choose the list that has more tokens between 𝑡ˆ and 𝑙ˆ
+    new_tokenized_template = log_message if len(log_message) > len(tokenized_template) else tokenized_template
+    new_tokenized_template = list(new_tokenized_template)
+    # replace any token in the longer list that is not in the common token set with the placeholder "<*>"
+    for i in range(len(new_tokenized_template)):
+        if new_tokenized_template[i] not in common_token_set:
+            new_tokenized_template[i] = '<*>'
+    return new_tokenized_template
+
+
+class TestLogSource(unittest.TestCase):
+    def test_follow_rotation_and_resume(self):
+        import tempfile
+        from threading import Timer
+        from sources import LogSource
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path, offsets_path = os.path.join(tmp, 'app.log'), os.path.join(tmp, 'offsets.json')
+
+            def append(text: str, path=log_path):
+                with open(path, 'a') as f:
+                    f.write(text)
+
+            append('line 1\nline 2\nline 3\n')
+            lines = iter(LogSource(os.path.join(tmp, 'app.log*'), True, offsets_path, poll_interval=0.01))
+            self.assertEqual([next(lines) for _ in range(3)], ['line 1\n', 'line 2\n', 'line 3\n'])
+            append('line 4')  # partly written
+            Timer(0.05, append, (' done\n',)).start()
+            self.assertEqual(next(lines), 'line 4 done\n')
+            # rotation by renaming, the unread line of the renamed file comes first
+            append('line 5\n')
+            os.rename(log_path, f'{log_path}.1')
+            append('new 1\n')
+            self.assertEqual([next(lines), next(lines)], ['line 5\n', 'new 1\n'])
+            # copytruncate, while waiting for new lines
+            Timer(0.05, os.truncate, (log_path, 0)).start()
+            Timer(0.1, append, ('new 2 rewritten\n',)).start()
+            self.assertEqual(next(lines), 'new 2 rewritten\n')
+            lines.close()  # offsets saved, the last line is not acknowledged by asking for the next one
+
+            # restart: only the unacknowledged line is read again
+            self.assertEqual(list(LogSource(os.path.join(tmp, 'app.log*'), offsets_path=offsets_path)),
+                             ['new 2 rewritten\n'])
+            self.assertEqual(list(LogSource(os.path.join(tmp, 'app.log*'), offsets_path=offsets_path)), [])
+            append('new 3\n')
+            append('line 6\n', f'{log_path}.1')
+            self.assertEqual(sorted(LogSource(os.path.join(tmp, 'app.log*'), offsets_path=offsets_path)),
+                             ['line 6\n', 'new 3\n'])
+
+
+class TestBenchmark(unittest.TestCase):
+    bgl_path = '../data/BGL/BGL_2k.log'
+
+    def test_nlp_batch_throughput(self):
+        """
+        compare per-line nlp tagging with batched nlp.pipe tagging on BGL_2k. Both must yield the same traverse tokens
+        and build the same trie.
+        """
+        from time import perf_counter
+        from config import bgl_pattern
+        from log_structure import parse_lines
+        pattern = re.compile(bgl_pattern)
+        with open(self.bgl_path) as f:
+            lines = f.readlines()
+
+        results = {}
+        for name, batch_size, n_process in [('per-line', 0, 1), ('batched', 256, 1), ('batched x2 process', 256, 2)]:
+            start = perf_counter()
+            log_messages = list(parse_lines(pattern, lines, batch_size, n_process))
+            elapsed = perf_counter() - start
+            root = Trie('root', None, 'root')
+            for log_message in log_messages:
+                _, log_cluster, match_type = root.insert(log_message)
+                log_cluster.insert_and_update_template(log_message, match_type)
+            results[name] = ([log_message.traverse_tokens for log_message in log_messages], len(root.search_clusters_recurse()))
+            print(f'{name}: {len(log_messages)} lines in {elapsed:.3f}s, {len(log_messages) / elapsed:.0f} lines/sec')
+
+        self.assertEqual(results['per-line'], results['batched'])
+        self.assertEqual(results['per-line'], results['batched x2 process'])
+
+    def test_traverse_tokens_cache(self):
+        """
+        hit rate of the digit-masked traverse tokens cache. Cached results must equal uncached backend results.
+        """
+        if not spacy_model_installed():
+            self.skipTest('spacy model en_core_web_sm is not installed')
+        from config import bgl_pattern, hdfs_pattern
+        from log_structure import parse_lines, mask_content, set_traverse_backend
+        for path, log_pattern in [(self.bgl_path, bgl_pattern), ('../data/HDFS/HDFS_2k.log', hdfs_pattern)]:
+            backend = set_traverse_backend('spacy')
+            with open(path) as f:
+                log_messages = list(parse_lines(re.compile(log_pattern), f))
+            print(f'{path}: {len(log_messages)} lines, hits {backend.cache.hits}, '
+                  f'misses {backend.cache.misses}, hit rate {backend.cache.hit_rate():.2%}')
+            for log_message in log_messages[::50]:
+                self.assertEqual(log_message.traverse_tokens, backend.extract(mask_content(log_message.get_content())))
+
+    def test_traverse_backends(self):
+        """
+        lines/sec and resulting number of log clusters of every traverse tokens backend on all bundled datasets
+        """
+        if not spacy_model_installed():
+            self.skipTest('spacy model en_core_web_sm is not installed')
+        from time import perf_counter
+        import config
+        from log_structure import parse_lines, set_traverse_backend
+        from traverse_backends import backends
+        datasets = {
+            'BGL': (self.bgl_path, config.bgl_pattern),
+            'HDFS': ('../data/HDFS/HDFS_2k.log', config.hdfs_pattern),
+            'Thunderbird': ('../data/Thunderbird/Thunderbird_2k.log', config.thunderbird_pattern),
+            'Java': ('../data/Java/application.log.2024-01-04.0', config.java_pattern),
+            'Jenkins': ('../data/Jenkins/jenkins-test.log', config.jenkins_pattern),
+        }
+        for dataset, (path, log_pattern) in datasets.items():
+            pattern = re.compile(log_pattern)
+            for name in backends:
+                set_traverse_backend(name)
+                frequent_tokens.clear()
+                start = perf_counter()
+                sampling(pattern, path)
+                root = Trie('root', None, 'root')
+                with open(path) as f:
+                    lines = 0
+                    for log_message in parse_lines(pattern, f):
+                        _, log_cluster, match_type = root.insert(log_message)
+                        log_cluster.insert_and_update_template(log_message, match_type)
+                        lines = lines + 1
+                elapsed = perf_counter() - start
+                print(f'{dataset:<12}{name:<8}{lines / elapsed:>10.0f} lines/sec{len(root.search_clusters_recurse()):>6} clusters')
+        set_traverse_backend(config.traverse_backend)
+
+    def test_startup_time(self):
+        """
+        import time of tda modules in a fresh interpreter. Heavy models and remote clients are created on first use,
+        so importing trie and parsing code must not load spacy, llama_index or openai.
+        """
+        import subprocess
+        import sys
+        heavy_modules = ['spacy', 'en_core_web_sm', 'llama_index', 'openai', 'scipy', 'pyecharts']
+        for module in ['log_structure', 'trie', 'feedback_expert', 'rag.process', 'process_tda']:
+            code = (f'import sys, time\n'
+                    f'sys.path[:0] = [".", ".."]\n'
+                    f'start = time.perf_counter()\n'
+                    f'import {module}\n'
+                    f'print(time.perf_counter() - start)\n'
+                    f'print(",".join(m for m in {heavy_modules} if m in sys.modules))')
+            output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+            elapsed, loaded = output.split('\n')[:2]
+            print(f'import {module}: {float(elapsed) * 1000:.1f} ms, heavy modules loaded: [{loaded}]')
+            self.assertEqual(loaded, '')
+
+    def test_retained_message_memory(self):
+        """
+        bytes per retained log message (after release()) on the bgl2 workload, or BGL_2k when bgl2 isn't there,
+        compared with an unreleased one. Released log messages must retain less
+        """
+        import tracemalloc
+        from itertools import islice
+        from config import bgl_pattern, bgl2_pattern
+        from log_structure import parse_lines
+        path, pattern = '../data/bgl2', re.compile(bgl2_pattern)
+        if not os.path.exists(path):
+            path, pattern = self.bgl_path, re.compile(bgl_pattern)
+        limit = 200000  # lines per measurement, total bgl2 has 4747963 lines
+        per_message = dict()
+        for release in (False, True):
+            with open(path) as f:
+                tracemalloc.start()
+                retained = []
+                for log_message in islice(parse_lines(pattern, f), limit):
+                    if release:
+                        log_message.release()
+                    retained.append(log_message)
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            per_message[release] = current / len(retained)
+            print(f'{path} release={release}: {len(retained)} messages, {per_message[release]:.0f} bytes per retained '
+                  f'message, peak {peak / 2 ** 20:.1f} MiB')
+        self.assertLess(per_message[True], per_message[False])
+
+    def test_leaf_exact_match_cost(self):
+        """
+        exact match cost per line as log clusters accumulate under one leaf: ClusterIndex vs scanning all clusters
+        """
+        from time import perf_counter
+        from cluster_index import ClusterIndex
+        from log_structure import tokenize
+        for n in (10, 100, 1000, 5000):
+            index = ClusterIndex()
+            for i in range(n):
+                index.add(LogCluster(tokenize(f'event{i} happened on node <*> after <*> retries')))
+            contents = [f'event{i} happened on node R{i}-M0 after {i % 7} retries' for i in range(0, n, max(1, n // 100))]
+            start = perf_counter()
+            for content in contents:
+                self.assertIsNotNone(index.match_exact(content, tokenize(content)))
+            indexed = (perf_counter() - start) / len(contents)
+            start = perf_counter()
+            for content in contents:
+                self.assertIsNotNone(next(c for c in index if c.matcher.fullmatch(content)))
+            scanned = (perf_counter() - start) / len(contents)
+            print(f'{n:>5} clusters: index {indexed * 1e6:8.1f} us/line, scan {scanned * 1e6:8.1f} us/line')
+
+    def test_partial_match_pruning(self):
+        """
+        fuzzy comparisons per line and grouping accuracy on loghub ground truth, with and without inverted index pruning.
+        Leaves of the trie rarely hold more than top_n log clusters, so they are also measured with busy leaves: log
+        messages only routed by LEVEL, where pruning does remove candidates
+        """
+        import config
+        import trie
+        datasets = {
+            'BGL': (self.bgl_path, config.bgl_pattern),
+            'HDFS': ('../data/HDFS/HDFS_2k.log', config.hdfs_pattern),
+            'Thunderbird': ('../data/Thunderbird/Thunderbird_2k.log', config.thunderbird_pattern),
+        }
+        layouts = {
+            'trie': trie.traverse_funcs,
+            'busy leaves': {config.TRA_TYPE_domain_knowledge: trie.traverse_d_k},
+        }
+        match_partial, top_n_candidates = trie.match_partial, trie.top_n_candidates
+        comparisons = 0
+
+        def counting_match_partial(log_message, log_clusters):
+            nonlocal comparisons
+            log_clusters = list(log_clusters)
+            comparisons = comparisons + len(log_clusters)
+            return match_partial(log_message, log_clusters)
+
+        trie.match_partial = counting_match_partial
+        try:
+            for dataset, (path, log_pattern) in datasets.items():
+                pattern = re.compile(log_pattern)
+                truth = structured_ground_truth(path)
+                with open(path) as f:
+                    lines = f.readlines()
+                frequent_tokens.clear()
+                sampling(pattern, path)
+                for layout, funcs in layouts.items():
+                    trie.traverse_funcs = funcs
+                    results = dict()
+                    for top_n in (0, 10, 3):
+                        trie.top_n_candidates, comparisons = top_n, 0
+                        clusters = ingest_lines(Trie('root', None, 'root'), pattern, lines)
+                        ids = [i for i in clusters if i in truth]
+                        accuracy = grouping_accuracy([clusters[i] for i in ids], [truth[i] for i in ids])
+                        results[top_n] = comparisons / len(clusters), accuracy
+                        print(f'{dataset:<12}{layout:<12}top_n={top_n:<3}{results[top_n][0]:8.2f} comparisons/line'
+                              f'  grouping accuracy {accuracy:.4f} ({accuracy - results[0][1]:+.4f})')
+                        # pruning never scores more clusters than scoring all, at a small cost in accuracy at most
+                        self.assertLessEqual(results[top_n][0], results[0][0])
+                        self.assertGreaterEqual(accuracy, results[0][1] - 0.01)
+        finally:
+            trie.match_partial, trie.top_n_candidates = match_partial, top_n_candidates
+            trie.traverse_funcs = layouts['trie']
+
+    def test_insert_batch(self):
+        """
+        Trie.insert_batch must give the same log clusters and match types as inserting one by one, and be faster
+        """
+        from time import perf_counter
+        from config import bgl_pattern
+        from log_structure import parse_lines
+        pattern = re.compile(bgl_pattern)
+        frequent_tokens.clear()
+        sampling(pattern, self.bgl_path)
+        with open(self.bgl_path) as f:
+            lines = f.readlines()
+
+        sequential, root = [], Trie('root', None, 'root')
+        start = perf_counter()
+        for log_message in parse_lines(pattern, lines):
+            _, log_cluster, match_type = root.insert(log_message)
+            log_cluster.insert_and_update_template(log_message, match_type)
+            sequential.append((log_cluster, match_type))
+        elapsed = perf_counter() - start
+        print(f'sequential: {len(sequential) / elapsed:.0f} lines/sec')
+
+        for batch_size in (64, 512):
+            batched, batch_root = [], Trie('root', None, 'root')
+            log_messages = list(parse_lines(pattern, lines))
+            start = perf_counter()
+            for i in range(0, len(log_messages), batch_size):
+                batched.extend((log_cluster, match_type) for _, log_cluster, match_type
+                               in batch_root.insert_batch(log_messages[i:i + batch_size]))
+            elapsed = perf_counter() - start
+            print(f'batch size {batch_size}: {len(batched) / elapsed:.0f} lines/sec')
+            # log clusters are different objects, compare final templates and match types line by line
+            self.assertEqual([(c.template, t) for c, t in sequential], [(c.template, t) for c, t in batched])
+
+    def test_hot_line_cache(self):
+        """
+        hot line cache hit rate and throughput on BGL_2k and HDFS_2k. Hits skip tokenization and must build the same templates.
+        """
+        from time import perf_counter
+        from config import bgl_pattern, hdfs_pattern
+        import log_structure
+        from log_structure import parse_lines
+        backend_get, backend_calls = log_structure.traverse_backend.get, 0
+
+        def counting_get(masked_content):
+            nonlocal backend_calls
+            backend_calls = backend_calls + 1
+            return backend_get(masked_content)
+
+        for path, log_pattern in [(self.bgl_path, bgl_pattern), ('../data/HDFS/HDFS_2k.log', hdfs_pattern)]:
+            pattern = re.compile(log_pattern)
+            frequent_tokens.clear()
+            sampling(pattern, path)
+            with open(path) as f:
+                lines = f.readlines()
+            templates = []
+            for lazy in (False, True):
+                root = Trie('root', None, 'root')
+                backend_calls = 0
+                log_structure.traverse_backend.get = counting_get
+                start = perf_counter()
+                try:
+                    for log_message in parse_lines(pattern, lines, lazy=lazy):
+                        if lazy:
+                            root.insert_cached(log_message)
+                        else:
+                            _, log_cluster, match_type = root.insert(log_message)
+                            log_cluster.insert_and_update_template(log_message, match_type)
+                    elapsed = perf_counter() - start
+                finally:
+                    del log_structure.traverse_backend.get
+                if lazy:
+                    self.assertEqual(backend_calls, root.hotLines.misses)  # hits don't compute traverse tokens
+                templates.append(sorted(log_cluster.template for log_cluster in root.search_clusters_recurse()))
+                print(f'{path} hot line cache={lazy}: {len(lines) / elapsed:.0f} lines/sec'
+                      + (f', hit rate {root.hotLines.hit_rate():.2%}' if lazy else ''))
+            self.assertEqual(templates[0], templates[1])
+
+    def test_hot_line_cache_keys(self):
+        """
+        a masked CONTENT only hits log clusters whose template matches the CONTENT itself
+        """
+        from log_structure import mask_content, tokenize
+        hot_lines = utils.HotLineCache(10)
+        literal, general = LogCluster(tokenize('core  error')), LogCluster(tokenize('core <*> error'))
+        hot_lines.remember((mask_content('core  error'), 'INFO'), 'core  error', literal, {})
+        self.assertIsNone(hot_lines.lookup((mask_content('core 5 error'), 'INFO'), 'core 5 error'))
+        self.assertIs(hot_lines.lookup(('core  error', 'INFO'), 'core  error')[0], literal)
+        hot_lines.remember((mask_content('core 5 error'), 'INFO'), 'core 5 error', general, {})
+        self.assertIs(hot_lines.lookup((mask_content('core 7 error'), 'INFO'), 'core 7 error')[0], general)
+
+    def test_incremental_reconstruct(self):
+        """
+        reconstruct re-routes log clusters by their cached traverse tokens: no traverse tokens extraction, no log cluster
+        lost, and a second reconstruct moves nothing
+        """
+        from time import perf_counter
+        from config import bgl_pattern
+        import log_structure
+        from log_structure import parse_lines
+        pattern = re.compile(bgl_pattern)
+        frequent_tokens.clear()
+        sampling(pattern, self.bgl_path)
+        root = Trie('root', None, 'root')
+        with open(self.bgl_path) as f:
+            for log_message in parse_lines(pattern, f):
+                _, log_cluster, match_type = root.insert(log_message)
+                log_cluster.insert_and_update_template(log_message, match_type)
+        log_clusters = set(root.search_clusters_recurse())
+        backend = log_structure.traverse_backend
+        lookups = backend.cache.hits + backend.cache.misses
+        for i in range(2):
+            start = perf_counter()
+            root.reconstruct()
+            print(f'reconstruct {i}: {len(log_clusters)} log clusters in {(perf_counter() - start) * 1000:.2f} ms')
+            self.assertEqual(backend.cache.hits + backend.cache.misses, lookups)
+            self.assertEqual(set(root.search_clusters_recurse()), log_clusters)
+            for log_cluster in log_clusters:
+                self.assertIn(log_cluster, log_cluster.parent.logClusters)
+
+    def test_generalize_template(self):
+        """
+        token id template update against extract_template + merge_adjacent_wildcards, on the (template, log message)
+        pairs of every non exact match of BGL_2k: same templates, and time per update
+        """
+        from time import perf_counter
+        from config import bgl_pattern, EXACT_MATCH
+        from log_structure import parse_lines, generalize_template
+        from array import array
+        from vocabulary import vocabulary, UNKNOWN_ID
+        pattern = re.compile(bgl_pattern)
+        frequent_tokens.clear()
+        sampling(pattern, self.bgl_path)
+        root, updates, held = Trie('root', None, 'root'), [], []
+        with open(self.bgl_path) as f:
+            for log_message in parse_lines(pattern, f):
+                _, log_cluster, match_type = root.insert(log_message)
+                if match_type != EXACT_MATCH:
+                    updates.append((log_cluster.template_ids, log_message))
+                    # replayed below, ids must not be dropped and reused by later template updates meanwhile
+                    ids = array('i', [i for i in log_message.get_content_ids() if i != UNKNOWN_ID])
+                    held.extend((log_cluster.template_ids, ids))
+                    vocabulary.acquire(log_cluster.template_ids)
+                    vocabulary.acquire(ids)
+                log_cluster.insert_and_update_template(log_message, match_type)
+
+        rounds = 100
+        decoded = [(vocabulary.decode(template_ids), log_message) for template_ids, log_message in updates]
+        start = perf_counter()
+        for _ in range(rounds):
+            expected = [merge_adjacent_wildcards(extract_template(log_message, tokenized_template))[0]
+                        for tokenized_template, log_message in decoded]
+        string_based = perf_counter() - start
+        start = perf_counter()
+        for _ in range(rounds):
+            generalized = [generalize_template(template_ids, log_message.get_content_ids())
+                           for template_ids, log_message in updates]
+        token_based = perf_counter() - start
+        self.assertEqual([vocabulary.decode(template_ids if ids is None else ids)
+                          for (template_ids, _), ids in zip(updates, generalized)], expected)
+        for ids in held:
+            vocabulary.release(ids)
+        unchanged = sum(ids is None for ids in generalized)
+        n = rounds * len(updates)
+        print(f'{len(updates)} template updates ({unchanged} unchanged): '
+              f'serialize/regex/tokenize {string_based / n * 1e6:.2f} us, token ids {token_based / n * 1e6:.2f} us')
+        # template tokens as a list of strings (each log cluster holding its own strings) vs an array of shared ids
+        log_clusters = root.search_clusters_recurse()
+        as_strings = sum(sys.getsizeof(c.tokenized_template) + sum(map(sys.getsizeof, c.tokenized_template))
+                         for c in log_clusters)
+        as_ids = sum(sys.getsizeof(c.template_ids) for c in log_clusters)
+        print(f'{len(log_clusters)} templates: {as_strings} bytes as token strings, {as_ids} bytes as token ids '
+              f'(+ {len(vocabulary)} shared vocabulary tokens)')
+
+    def test_sharded_throughput(self):
+        """
+        lines/sec of sharded ingestion by number of worker processes on BGL_2k x 20. INFO (80% of lines) is split among
+        shards by routing word, so loads are balanced and throughput grows with shards given as many CPUs. The merged
+        snapshot holds the log clusters of all shards under one node per LEVEL, and every log message inserted by workers
+        is kept by the reader with its log cluster.
+        Log clusters differ by number of shards: every shard re-ranks most frequent tokens by its own log messages, so a
+        template may be split among a different number of leaf nodes. Templates differ by a few ones starting with a
+        wildcard, whose log messages may have several routing words, i.e. shards, and are generalized separately
+        """
+        from time import perf_counter
+        from config import bgl_pattern
+        from sharding import ShardedTrie
+        with open(self.bgl_path) as f:
+            lines = f.readlines() * 20
+
+        throughput, templates = dict(), dict()
+        for n_shards in (1, 2, 4):
+            log_messages = utils.RingBuffer(len(lines))
+            root = ShardedTrie(n_shards, bgl_pattern, self.bgl_path, log_messages=log_messages)
+            start = perf_counter()
+            root.insert_lines(lines)
+            root.close()
+            elapsed = perf_counter() - start
+            snapshot = root.snapshot
+            throughput[n_shards] = len(lines) / elapsed
+            print(f'{n_shards} shards: {len(lines)} lines in {elapsed:.3f}s, {throughput[n_shards]:.0f} lines/sec, '
+                  f'lines per shard {root.loads}, {len(snapshot.clusters)} log clusters, '
+                  f'{len({c.template for c in snapshot.clusters})} templates')
+            levels = [node.name for node in snapshot.root.children]
+            self.assertEqual(len(levels), len(set(levels)))
+            self.assertEqual(set(levels), set(root.shards) | set(root.sub_shards))
+            ids = [c.cluster_id for c in snapshot.clusters]
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertGreater(sum(len(c.log_messages) for c in snapshot.clusters), 0)
+            self.assertEqual(len(log_messages), sum(root.loads))
+            self.assertTrue(all(m.parent.cluster_id == m.cluster_id for _, m in log_messages.page(0, len(lines))[0]))
+            templates[n_shards] = {c.template for c in snapshot.clusters}
+            self.assertLessEqual(len(templates[n_shards] ^ templates[1]), 0.05 * len(templates[1]))
+            if n_shards == 2:
+                self.assertLess(max(root.loads), 0.6 * len(lines))
+        if (os.cpu_count() or 1) >= 2:
+            self.assertGreater(throughput[2], 1.3 * throughput[1])
+        else:
+            print(f'{os.cpu_count()} CPU: throughput by shards not compared')
+
+    def test_bulk_throughput(self):
+        """
+        wall-clock time and lines/sec of parsing BGL_2k x 20 from memory-mapped chunks by worker count, against reading
+        it line by line. Bulk log messages are only tokenized when inserted, the time to tokenize them all is reported
+        too. Log messages must come in input order with the same tokens, and bulk parsing must be faster given 2 CPUs
+        """
+        import tempfile
+        from time import perf_counter
+        from config import bgl_pattern
+        from bulk import chunk_bounds, parse_file
+        from log_structure import parse_lines
+        with open(self.bgl_path) as f:
+            lines = [line.rstrip('\n') + '\n' for line in f] * 20  # the last line has no line break
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as f:
+            f.writelines(lines)
+            f.flush()
+            self.assertEqual(chunk_bounds(f.name, 1 << 16)[-1][1], os.path.getsize(f.name))
+
+            start = perf_counter()
+            expected = [(m.line, m.get_level(), m.traverse_tokens, m.content_tokens)
+                        for m in parse_lines(re.compile(bgl_pattern), lines)]
+            line_by_line = len(expected) / (perf_counter() - start)
+            print(f'line by line: {len(expected)} lines, {line_by_line:.0f} lines/sec')
+            throughput = dict()
+            for n_process in (1, 2, 4):
+                start = perf_counter()
+                log_messages = list(parse_file(f.name, bgl_pattern, n_process, 1 << 16))
+                elapsed = perf_counter() - start
+                throughput[n_process] = len(log_messages) / elapsed
+                start = perf_counter()
+                for log_message in log_messages:
+                    log_message.ensure_tokens()
+                tokenized = perf_counter() - start
+                print(f'bulk x{n_process} process: {len(log_messages)} lines in {elapsed:.3f}s, '
+                      f'{throughput[n_process]:.0f} lines/sec ({throughput[n_process] / line_by_line:.2f}x line by '
+                      f'line), tokenizing them all takes {tokenized:.3f}s more')
+                self.assertEqual([(m.line, m.get_level(), m.traverse_tokens, m.content_tokens) for m in log_messages],
+                                 expected)
+        n_cpu = os.cpu_count() or 1
+        if n_cpu < 2:  # workers and parent share the CPU, bulk parsing can only be slower
+            self.skipTest(f'{n_cpu} CPU: bulk and line by line throughput not compared')
+        self.assertGreater(throughput[min(n_cpu, 4)], line_by_line)
+
+    def test_network_ingest(self):
+        """
+        sustained lines/sec and queue latency percentiles of TCP ingestion under a local load generator, with
+        backpressure: nothing is dropped. Then UDP datagrams with syslog priorities
+        """
+        import asyncio
+        import socket
+        from threading import Thread
+        from time import perf_counter, sleep
+        from config import bgl_pattern
+        from network import IngestServer, generate_load
+        with open(self.bgl_path) as f:
+            lines = f.readlines()
+        root, pattern = Trie('root', None, 'root'), re.compile(bgl_pattern)
+        server = IngestServer(lambda batch: ingest_lines(root, pattern, batch), '127.0.0.1', 0, 0, queue_size=1000)
+        Thread(target=asyncio.run, args=(server.serve(),), daemon=True).start()
+        server.ready.wait()
+
+        start = perf_counter()
+        offered = asyncio.run(generate_load('127.0.0.1', server.tcp_port, lines, connections=4, repeat=5))
+        while server.ingested < len(lines) * 20:
+            sleep(0.01)
+        elapsed = perf_counter() - start
+        report = server.report()
+        print(f"offered {offered:.0f} lines/sec (socket buffers included), ingested {report['ingested']} lines at "
+              f"{report['ingested'] / elapsed:.0f} lines/sec, queue latency {report['latency_ms']}")
+        self.assertEqual(report['dropped'], 0)
+        self.assertEqual([(c['lines'], c['closed']) for c in report['connections']], [(len(lines) * 5, True)] * 4)
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            for line in lines[:10]:
+                udp.sendto(f'<134>{line}'.encode(), ('127.0.0.1', server.udp_port))
+        while server.ingested < len(lines) * 20 + 10:
+            sleep(0.01)
+        self.assertEqual(server.report()['connections'][-1]['lines'], 10)
+        server.stop()
+
+    def test_checkpoint_restore(self):
+        """
+        checkpoint size, save and restore time of a trie of all bundled datasets. The restored trie must have the same
+        log clusters, feedback and most frequent tokens, and route new log messages the same way
+        """
+        import tempfile
+        from time import perf_counter
+        import config
+        from checkpoint import load_checkpoint, save_checkpoint
+        from log_structure import FeedBack
+        datasets = [(self.bgl_path, config.bgl_pattern), ('../data/HDFS/HDFS_2k.log', config.hdfs_pattern),
+                    ('../data/Thunderbird/Thunderbird_2k.log', config.thunderbird_pattern),
+                    ('../data/Java/application.log.2024-01-04.0', config.java_pattern),
+                    ('../data/Jenkins/jenkins-test.log', config.jenkins_pattern)]
+        frequent_tokens.clear()
+        sampling(re.compile(config.bgl_pattern), self.bgl_path)
+        root = Trie('root', None, 'root')
+        for path, log_pattern in datasets:
+            with open(path) as f:
+                ingest_lines(root, re.compile(log_pattern), f.readlines())
+        root.rerank()
+        next(iter(root.clusters)).set_feedback(FeedBack(decision=1, ep=0.9, tp=0.5, reason='expert'))
+
+        def state(trie: Trie) -> list:
+            return [(c.cluster_id, c.template, c.version, c.traverse_tokens, c.metadata, c.feedback.decision,
+                     c.feedback.reason, trie.path_to(c.parent), c.get_log_messages()) for c in trie.clusters]
+
+        expected, tokens = state(root), frequent_tokens.state()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'tda.ckpt')
+            start = perf_counter()
+            size = save_checkpoint(root, path, list(root.clusters)[:10])
+            saved = perf_counter() - start
+            frequent_tokens.clear()
+            start = perf_counter()
+            restored, recent = load_checkpoint(path)
+            loaded = perf_counter() - start
+        print(f'{len(expected)} log clusters, {restored.nNodes} trie nodes: checkpoint {size} bytes, '
+              f'saved in {saved:.3f}s, restored in {loaded:.3f}s')
+        self.assertEqual(state(restored), expected)
+        self.assertEqual(frequent_tokens.state(), tokens)
+        self.assertEqual(restored.clusters.recent_ids(), root.clusters.recent_ids())
+        self.assertEqual([c.cluster_id for c in recent], list(range(10)))
+
+        with open(self.bgl_path) as f:
+            lines = f.readlines()
+        pattern = re.compile(config.bgl_pattern)
+        self.assertEqual([c.cluster_id for c in ingest_lines(restored, pattern, lines).values()],
+                         [c.cluster_id for c in ingest_lines(root, pattern, lines).values()])
+        frequent_tokens.clear()
+
+    def test_log_messages_pages(self):
+        """
+        time of a /logs/ page, plain and filtered by decision, after ever more log messages: it must not grow with them.
+        Pages of a buffer being written to must be in order, each log message once, and consistent with its sequence number
+        """
+        from threading import Thread
+        from time import perf_counter
+        from utils import RingBuffer
+        buffer = RingBuffer(10000)
+        for total in (10000, 100000, 1000000):
+            while buffer.next_seq < total:
+                buffer.append(buffer.next_seq % 3)
+            start = perf_counter()
+            page, cursor = buffer.page(buffer.oldest, 100)
+            plain = perf_counter() - start
+            start = perf_counter()
+            filtered, _ = buffer.page(buffer.oldest, 100, lambda decision: decision == 1)
+            elapsed = perf_counter() - start
+            print(f'{total} log messages: page in {plain * 1e6:.0f}us, filtered page in {elapsed * 1e6:.0f}us')
+            self.assertEqual(len(buffer), 10000)
+            self.assertEqual([seq for seq, _ in page], list(range(total - 10000, total - 9900)))
+            self.assertEqual(cursor, total - 9900)
+            self.assertTrue(all(seq % 3 == decision == 1 for seq, decision in filtered))
+        self.assertEqual(buffer.page(0, 100), buffer.page(buffer.oldest, 100))
+
+        def write():
+            for _ in range(200000):
+                buffer.append(buffer.next_seq % 3)
+
+        writer = Thread(target=write)
+        writer.start()
+        cursor = buffer.oldest
+        while writer.is_alive() or cursor < buffer.next_seq:
+            page, next_cursor = buffer.page(cursor, 1000)
+            for seq, decision in page:
+                self.assertEqual(seq % 3, decision)
+            seqs = [seq for seq, _ in page]
+            self.assertEqual(seqs, sorted(set(seqs)))
+            self.assertTrue(all(seq >= cursor for seq in seqs))
+            cursor = next_cursor
+        writer.join()
+
+    def test_sharded_log_messages(self):
+        """
+        /logs/ in sharded mode: log messages inserted by shard workers are kept by the reader, and filtered by the expert
+        decision set on their merged log cluster
+        """
+        from time import sleep
+        from config import bgl_pattern
+        from log_structure import FeedBack
+        from sharding import ShardedTrie
+        with open(self.bgl_path) as f:
+            lines = f.readlines()
+        log_messages = utils.RingBuffer(len(lines))
+        root = ShardedTrie(2, bgl_pattern, self.bgl_path, log_messages=log_messages)
+        try:
+            root.insert_lines(lines)
+            root.publish()
+            for _ in range(100):  # snapshots are merged by the collector thread
+                if root.snapshot.clusters:
+                    break
+                sleep(0.1)
+            anomaly = max(root.snapshot.clusters, key=lambda c: len(c.log_messages))
+            anomaly.cluster.set_feedback(FeedBack(decision=1, ep=0.5, tp=0.5))  # seen with the next snapshot
+        finally:
+            root.close()
+        self.assertEqual(len(log_messages), len(lines))
+        page, _ = log_messages.page(log_messages.oldest, len(lines), lambda m: m.parent.feedback.decision == 1)
+        self.assertTrue(page)
+        self.assertTrue(all(m.cluster_id == anomaly.cluster_id for _, m in page))
+
+    def test_trie_render_cache(self):
+        """
+        time of rendering /trie/ against serving the cached json, and size of a diff after a few inserts against the
+        whole trie. The diff applied to the former whole trie must give the current one
+        """
+        from time import perf_counter
+        import config
+        from server_apis import render_echarts_json, trie_diff_api
+        frequent_tokens.clear()
+        sampling(re.compile(config.bgl_pattern), self.bgl_path)
+        root = Trie('root', None, 'root')
+        with open(self.bgl_path) as f:
+            ingest_lines(root, re.compile(config.bgl_pattern), f.readlines())
+        snapshot = root.publish()
+        start = perf_counter()
+        data, etag = render_echarts_json(snapshot, 'graph')
+        rendered = perf_counter() - start
+        republished = root.publish()  # nothing changed
+        start = perf_counter()
+        self.assertEqual(render_echarts_json(republished, 'graph'), (data, etag))
+        cached = perf_counter() - start
+        print(f'graph of {len(snapshot.clusters)} log clusters: rendered in {rendered * 1000:.2f}ms, '
+              f'cached in {cached * 1000:.2f}ms')
+
+        def apply(state: dict, diff: dict) -> dict:
+            nodes, clusters = dict(state['nodes']), dict(state['clusters'])
+            for node in diff['nodes']:
+                path = tuple(node['path'])
+                nodes = {p: n for p, n in nodes.items()
+                         if p[:len(path)] != path or len(p) == len(path) or p[len(path)] in node['children']}
+                nodes[path] = node
+            clusters.update((c['id'], c) for c in diff['clusters'])
+            kept = {cluster_id for node in nodes.values() for cluster_id in node['clusters']}
+            return {'nodes': nodes, 'clusters': {i: c for i, c in clusters.items() if i in kept}}
+
+        empty = {'nodes': dict(), 'clusters': dict()}
+        state = apply(empty, trie_diff_api(snapshot, 0))
+        with open('../data/HDFS/HDFS_2k.log') as f:
+            ingest_lines(root, re.compile(config.hdfs_pattern), f.readlines()[:20])
+        current = root.publish()
+        diff = trie_diff_api(current, snapshot.modified)
+        print(f'diff of {len(diff["nodes"])} trie nodes and {len(diff["clusters"])} log clusters, whole trie: '
+              f'{len(state["nodes"])} trie nodes and {len(state["clusters"])} log clusters')
+        self.assertGreater(current.modified, snapshot.modified)
+        self.assertLess(len(diff['nodes']), len(state['nodes']))
+        self.assertEqual(apply(state, diff), apply(empty, trie_diff_api(current, 0)))
+        self.assertNotEqual(render_echarts_json(current, 'graph')[1], etag)
+        frequent_tokens.clear()
@@ -1,7 +1,7 @@
 import re
 from collections import OrderedDict
 from io import TextIOWrapper
-from typing import Generic, Hashable, Optional, TypeVar
+from typing import Callable, Generic, Hashable, Iterator, Optional, TypeVar
 
 patterns = [
     r'(\d+[\.-])+\d+',  # time. eg, 2005-06-14-09.11.51.127157
@@ -10,13 +10,12 @@ patterns = [
 DEFAULT_VALUE = 0
 
 
-def read_line(file_path: str) -> list:
-    # TODO a better iterator that is friendly with memory
-    lines = []
+def read_line(file_path: str) -> Iterator[str]:
+    """
+    lines of a file, one at a time. See sources.LogSource for many files, tail -f and resuming
+    """
     with open(file_path) as file:
-        for line in file:
-            lines.append(line)
-    return lines
+        yield from file
 
 
 def plot_cdf(data, cdfs, tps):
@@ -65,6 +64,9 @@ class LruCache(Generic[T]):
     def clear(self) -> None:
         self._cache.clear()
 
+    def discard(self, key: T) -> None:
+        self._cache.pop(key, None)
+
     def __len__(self) -> int:
         return len(self._cache)
 
@@ -82,19 +84,224 @@ class LogClusterCache(LruCache):
 
     def insert(self, key: 'LogCluster') -> None:
         if len(self._cache) >= self.capacity:
-            log_cluster, _ = self._cache.popitem(last=False)
-            # TODO: consider if this log cluster should be removed from trie
-            # parent = log_cluster.parent  # trie leaf node
-            # assert parent is not None and parent.isEnd
-            # parent.remove_log_cluster(log_cluster)
+            # log clusters are not removed from trie here, trie evicts them by its own limits, see Trie.evict_over_limits
+            self._cache.popitem(last=False)
 
         self._cache[key] = DEFAULT_VALUE
         self._cache.move_to_end(key)
 
 
+class MemoCache(LruCache):
+    """
+    bounded lru cache that maps a key to a computed value, with hit/miss counters
+    """
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default=None):
+        if key not in self._cache:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    def put(self, key: Hashable, value) -> None:
+        if key not in self._cache and len(self._cache) >= self.capacity:
+            self._cache.popitem(last=False)
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self) -> None:
+        super().clear()
+        self.hits, self.misses = 0, 0
+
+
+class HotLineCache(MemoCache):
+    """
+    (masked CONTENT, LEVEL) -> (log cluster, its template version, its leaf node, traverse tokens), for the last log
+    message inserted with this key. An entry is only valid while the log cluster keeps that template and leaf.
+    An entry is keyed by the masked CONTENT only if the template has a wildcard and matches the masked CONTENT itself,
+    and a hit by that key is checked again against the CONTENT (a digit word may have been masked inside literal text of
+    the template). Otherwise, e.g. for templates without wildcard or with literal numbers, it is keyed by (CONTENT, LEVEL)
+    and only hit by the very same CONTENT.
+    """
+
+    def _valid(self, key: Hashable) -> Optional[tuple]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        log_cluster, version, leaf, _ = entry
+        if log_cluster.version != version or log_cluster.parent is not leaf:
+            return None
+        self._cache.move_to_end(key)
+        return entry
+
+    def lookup(self, key: tuple[str, str], content: str) -> Optional[tuple['LogCluster', dict[str, str]]]:
+        """
+        (log cluster, traverse tokens of the masked CONTENT) remembered for key or for (content, LEVEL), None if missing
+        or no longer valid
+        """
+        entry = self._valid(key)
+        if entry is not None and content != key[0] and entry[0].matcher.fullmatch(content) is None:
+            entry = None
+        if entry is None and content != key[0]:
+            entry = self._valid((content, key[1]))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0], entry[3]
+
+    def remember(self, key: tuple[str, str], content: str, log_cluster: 'LogCluster', traverse_tokens: dict[str, str]):
+        if not log_cluster.nWildcard or log_cluster.matcher.fullmatch(key[0]) is None:
+            if log_cluster.matcher.fullmatch(content) is None:
+                return
+            key = (content, key[1])
+        self.put(key, (log_cluster, log_cluster.version, log_cluster.parent, traverse_tokens))
+
+
 class LogMessagesCache(LruCache):
     def __init__(self, capacity: int):
         super().__init__(capacity)
 
     def __str__(self):
         return [log_message.get_content() for log_message in self.to_list()]
+
+
+class SpaceSaving(Generic[T]):
+    """
+    Space-Saving heavy hitters (Metwally et al., 2005): approximate counts of the most frequent keys of a stream, in at
+    most capacity counters whatever the number of distinct keys. A key that isn't monitored replaces the one with the
+    least count, inheriting that count (overestimated by at most its error).
+    counters are grouped by count, so that an update is O(1)
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._counts: dict[T, int] = dict()  # in order of being monitored, which breaks ties in top()
+        self._errors: dict[T, int] = dict()
+        self._buckets: dict[int, dict[T, None]] = dict()  # count -> keys, in order of reaching that count
+        self._min = 0
+
+    def add(self, key: T) -> None:
+        if self.capacity <= 0:
+            return
+        count = self._counts.get(key)
+        if count is not None:
+            self._unbucket(key, count)
+        elif len(self._counts) < self.capacity:
+            count = self._errors[key] = 0
+        else:
+            count = self._min
+            victim = next(iter(self._buckets[count]))
+            self._unbucket(victim, count)
+            del self._counts[victim], self._errors[victim]
+            self._errors[key] = count
+        count = count + 1
+        self._counts[key] = count
+        self._buckets.setdefault(count, dict())[key] = None
+        if count == 1 or self._min not in self._buckets:
+            self._min = count
+
+    def _unbucket(self, key: T, count: int) -> None:
+        del self._buckets[count][key]
+        if not self._buckets[count]:
+            del self._buckets[count]
+
+    def count(self, key: T) -> int:
+        return self._counts.get(key, 0)
+
+    def error(self, key: T) -> int:
+        return self._errors.get(key, 0)
+
+    def top(self) -> list[T]:
+        """
+        monitored keys, most frequent first
+        """
+        return sorted(self._counts, key=self._counts.get, reverse=True)
+
+    def state(self) -> tuple:
+        """
+        copy of the counters as builtin types, see load_state
+        """
+        return (list(self._counts.items()), list(self._errors.items()),
+                [(count, list(keys)) for count, keys in self._buckets.items()], self._min)
+
+    def load_state(self, state: tuple) -> None:
+        counts, errors, buckets, self._min = state
+        self._counts, self._errors = dict(counts), dict(errors)
+        self._buckets = {count: dict.fromkeys(keys) for count, keys in buckets}
+
+    def clear(self) -> None:
+        self._counts.clear()
+        self._errors.clear()
+        self._buckets.clear()
+        self._min = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+
+class RingBuffer(Generic[T]):
+    """
+    the capacity most recent items, numbered by sequence numbers from 0 on. Appending overwrites the oldest item once
+    full, so memory doesn't grow with the number of items ever appended.
+    One writer, readers don't lock: a slot is marked invalid while being overwritten, and a reader checks the sequence
+    number of a slot before and after reading its item (see get).
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._items: list[Optional[T]] = [None] * capacity
+        self._seqs: list[int] = [-1] * capacity  # sequence number of the item in each slot, -1 while overwritten
+        self.next_seq = 0  # sequence number of the next item appended
+
+    def append(self, item: T) -> int:
+        seq = self.next_seq
+        slot = seq % self.capacity
+        self._seqs[slot] = -1
+        self._items[slot] = item
+        self._seqs[slot] = seq
+        self.next_seq = seq + 1
+        return seq
+
+    @property
+    def oldest(self) -> int:
+        """
+        sequence number of the oldest item still kept
+        """
+        return max(0, self.next_seq - self.capacity)
+
+    def get(self, seq: int) -> Optional[T]:
+        """
+        item of sequence number seq, None if not appended yet or already overwritten
+        """
+        slot = seq % self.capacity
+        if self._seqs[slot] != seq:
+            return None
+        item = self._items[slot]
+        return item if self._seqs[slot] == seq else None
+
+    def page(self, cursor: int, limit: int, predicate: Callable[[T], bool] = None) -> tuple[list[tuple[int, T]], int]:
+        """
+        at most limit (sequence number, item) from cursor on, oldest first, only items matching predicate if given.
+        Scans at most capacity items. returns them and the cursor of the next page
+        """
+        page, seq, end = [], max(cursor, self.oldest), self.next_seq
+        while seq < end and len(page) < limit:
+            item = self.get(seq)
+            if item is not None and (predicate is None or predicate(item)):
+                page.append((seq, item))
+            seq = seq + 1
+        return page, seq
+
+    def __len__(self) -> int:
+        return self.next_seq - self.oldest
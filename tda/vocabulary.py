@@ -0,0 +1,113 @@
+"""
+Token vocabulary shared by all log clusters: template tokens are interned to compact integer ids, so that templates are
+stored as array('i') of ids, and template updates and candidate lookups compare integers instead of strings.
+
+Only template tokens are interned, i.e. tokens of log messages that create a log cluster (parameters included), or
+that are built by merging wildcards. Tokens of other log messages are looked up without being added (UNKNOWN_ID).
+Ids are reference counted by the templates of log clusters in the trie (see acquire/release): a token is dropped once
+no template holds it any more, e.g. a block id after its log cluster was generalized, evicted or merged, and its id is
+reused. So the vocabulary is bounded by the trie limits, see max_clusters in config.py.
+
+Per id flags tell whitespace tokens and tokens containing <*>, so wildcard detection needs no string scan.
+"""
+from array import array
+from typing import Iterable
+
+WILDCARD = '<*>'
+WILDCARD_ID = 0
+EMPTY_ID = 1  # '', first(last) token of a CONTENT starting(ending) with whitespace, see log_structure.tokenize
+UNKNOWN_ID = -1  # token of a log message which is not in the vocabulary
+
+SPACE = 1  # token is whitespace
+WILD = 2  # token contains <*>
+WILD_HEAD = 4  # token starts with <*>
+WILD_TAIL = 8  # token ends with <*>
+
+
+def token_flags(token: str) -> int:
+    if token.isspace():
+        return SPACE
+    if WILDCARD not in token:
+        return 0
+    return WILD | (WILD_HEAD if token.startswith(WILDCARD) else 0) | (WILD_TAIL if token.endswith(WILDCARD) else 0)
+
+
+class Vocabulary:
+    def __init__(self):
+        self.ids: dict[str, int] = dict()
+        self.tokens: list[str] = []
+        self.flags = bytearray()  # id -> token_flags
+        self.refs: list[int] = []  # id -> occurrences in acquired templates
+        self._free: list[int] = []  # ids of dropped tokens, reused by intern
+        self._unheld: list[int] = []  # ids interned since the last acquire, dropped by it if still not held
+        for token in (WILDCARD, ''):  # never dropped
+            self.refs[self.intern(token)] = 1
+        self._unheld.clear()
+
+    def intern(self, token: str) -> int:
+        token_id = self.ids.get(token)
+        if token_id is None:
+            if self._free:
+                token_id = self._free.pop()
+                self.tokens[token_id], self.flags[token_id], self.refs[token_id] = token, token_flags(token), 0
+            else:
+                token_id = len(self.tokens)
+                self.tokens.append(token)
+                self.flags.append(token_flags(token))
+                self.refs.append(0)
+            self.ids[token] = token_id
+            self._unheld.append(token_id)
+        return token_id
+
+    def acquire(self, token_ids: array):
+        """
+        hold the ids of a template, see LogCluster.set_template_ids. Tokens interned meanwhile but held by no template,
+        e.g. intermediate tokens of generalize_template, are dropped
+        """
+        refs = self.refs
+        for token_id in token_ids:
+            refs[token_id] += 1
+        for token_id in self._unheld:
+            if not refs[token_id]:
+                self._drop(token_id)
+        self._unheld.clear()
+
+    def release(self, token_ids: array):
+        """
+        stop holding the ids of a template, tokens no longer held by any template are dropped
+        """
+        refs = self.refs
+        for token_id in token_ids:
+            refs[token_id] -= 1
+            if not refs[token_id]:
+                self._drop(token_id)
+
+    def _drop(self, token_id: int):
+        del self.ids[self.tokens[token_id]]
+        self._free.append(token_id)
+
+    def encode(self, tokens: Iterable[str]) -> array:
+        """
+        ids of template tokens, new tokens are interned
+        """
+        return array('i', map(self.intern, tokens))
+
+    def lookup(self, tokens: Iterable[str]) -> array:
+        """
+        ids of log message tokens, UNKNOWN_ID for tokens not in the vocabulary. Nothing is interned
+        """
+        get = self.ids.get
+        return array('i', [get(token, UNKNOWN_ID) for token in tokens])
+
+    def decode(self, token_ids: Iterable[int]) -> list[str]:
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in token_ids]
+
+    def __len__(self) -> int:
+        """
+        number of tokens in the vocabulary, dropped ones excluded
+        """
+        return len(self.ids)
+
+
+vocabulary = Vocabulary()